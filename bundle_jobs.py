@@ -0,0 +1,234 @@
+"""
+Background ZIP bundle jobs.
+
+Instead of holding an HTTP connection open while a large bundle streams, a
+client creates a job, polls its progress and downloads the finished archive
+(with Range support, so an interrupted download resumes where it stopped).
+Artifacts are built by background tasks into `artifact_dir` and expire after
+`ttl` seconds. The job id is a hash of the bundle contents and compression
+settings, so identical requests share one job and one artifact, and a finished
+artifact is still found after a restart. Job records are only touched on the
+event loop; worker threads just do the disk I/O.
+"""
+
+import asyncio
+import hashlib
+import json
+import logging
+import os
+import tempfile
+import time
+from concurrent.futures import Executor
+from pathlib import Path
+from typing import Any, BinaryIO, Dict, List, Optional, Set, Tuple
+
+from zip_stream import BundleFile, iter_zip_stream
+
+
+logger = logging.getLogger(__name__)
+
+
+# A .zip.part that has not been written to for this long belongs to a build that
+# died (crash, restart) and is removed, at startup and by the periodic cleanup
+STALE_PART_AGE = 600.0
+
+
+class BundleJob:
+    def __init__(self, job_id: str, artifact_path: Path, files_total: int):
+        self.id = job_id
+        self.artifact_path = artifact_path
+        self.status = "queued"  # queued -> running -> done | failed
+        self.files_total = files_total
+        self.files_done = 0
+        self.bytes_written = 0
+        self.error: Optional[str] = None
+        self.created_at = time.time()
+        self.finished_at: Optional[float] = None
+
+    def to_dict(self, ttl: float) -> Dict[str, Any]:
+        return {
+            "job_id": self.id,
+            "status": self.status,
+            "files_total": self.files_total,
+            "files_done": self.files_done,
+            "bytes_written": self.bytes_written,
+            "error": self.error,
+            "created_at": self.created_at,
+            "finished_at": self.finished_at,
+            "expires_at": self.finished_at + ttl if self.finished_at and self.status == "done" else None,
+        }
+
+
+class BundleJobManager:
+    """
+    Builds bundle artifacts in the background, at most `max_concurrent` at a time.
+    """
+
+    def __init__(
+        self,
+        artifact_dir: Path,
+        ttl: float,
+        max_concurrent: int,
+        executor: Optional[Executor] = None,
+        read_ahead: int = 4,
+    ):
+        self.artifact_dir = artifact_dir
+        self.ttl = ttl
+        self.executor = executor
+        self.read_ahead = read_ahead
+        self._jobs: Dict[str, BundleJob] = {}
+        self._tasks: Dict[str, asyncio.Task] = {}
+        self._semaphore = asyncio.Semaphore(max(1, max_concurrent))
+        self._cleanup_task: Optional[asyncio.Task] = None
+
+    async def start(self) -> None:
+        await asyncio.to_thread(self.artifact_dir.mkdir, parents=True, exist_ok=True)
+        await self._remove_expired()
+        self._cleanup_task = asyncio.create_task(self._cleanup_loop())
+
+    async def stop(self) -> None:
+        tasks = list(self._tasks.values()) + ([self._cleanup_task] if self._cleanup_task else [])
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+        self._tasks.clear()
+        self._cleanup_task = None
+
+    def artifact_path(self, job_id: str) -> Path:
+        return self.artifact_dir / f"{job_id}.zip"
+
+    def _open_part(self, job_id: str) -> Tuple[Path, BinaryIO]:
+        # Unique name: job dedup is per process, and two processes building the same
+        # bundle must not truncate each other's output. Matched by the stale-part sweep.
+        fd, name = tempfile.mkstemp(dir=self.artifact_dir, prefix=f"{job_id}.", suffix=".zip.part")
+        os.fchmod(fd, 0o644)  # mkstemp creates 0600; the artifact may be served by nginx
+        return Path(name), os.fdopen(fd, "wb")
+
+    @staticmethod
+    def _job_id(files: List[BundleFile], mode: str, compresslevel: int) -> str:
+        material = []
+        for bundle_file in files:
+            try:
+                st = bundle_file.path.stat()
+                version = [st.st_size, st.st_mtime_ns]
+            except OSError:
+                version = None
+            material.append([str(bundle_file.path), bundle_file.arcname, version])
+        payload = json.dumps({"files": material, "mode": mode, "level": compresslevel}, sort_keys=True)
+        return hashlib.sha256(payload.encode("utf-8")).hexdigest()[:32]
+
+    def _artifact_stat(self, job_id: str) -> Optional[os.stat_result]:
+        try:
+            return self.artifact_path(job_id).stat()
+        except OSError:
+            return None
+
+    async def get(self, job_id: str) -> Optional[BundleJob]:
+        """Returns the job, rebuilding a 'done' record from disk if only the artifact survived a restart."""
+        job = self._jobs.get(job_id)
+        if job is not None:
+            return job
+        st = await asyncio.to_thread(self._artifact_stat, job_id)
+        job = self._jobs.get(job_id)  # submitted while the stat ran
+        if job is not None:
+            return job
+        if st is None or st.st_mtime + self.ttl < time.time():
+            return None
+        job = BundleJob(job_id, self.artifact_path(job_id), files_total=0)
+        job.status = "done"
+        job.bytes_written = st.st_size
+        job.finished_at = st.st_mtime
+        self._jobs[job_id] = job
+        return job
+
+    async def submit(self, files: List[BundleFile], mode: str, compresslevel: int) -> BundleJob:
+        """Returns the existing job for an identical bundle, or starts building a new one."""
+        job_id = await asyncio.to_thread(self._job_id, files, mode, compresslevel)
+        job = await self.get(job_id)
+        if job is not None and job.status != "failed":
+            if job.status != "done" or await asyncio.to_thread(job.artifact_path.is_file):
+                return job
+        job = self._jobs.get(job_id)  # another submit may have started it during the check
+        if job is not None and job.status in ("queued", "running"):
+            return job
+
+        job = BundleJob(job_id, self.artifact_path(job_id), files_total=len(files))
+        self._jobs[job_id] = job
+        self._tasks[job_id] = asyncio.create_task(self._build(job, files, mode, compresslevel))
+        self._tasks[job_id].add_done_callback(lambda _t: self._tasks.pop(job_id, None))
+        return job
+
+    async def _build(self, job: BundleJob, files: List[BundleFile], mode: str, compresslevel: int) -> None:
+        loop = asyncio.get_running_loop()
+        part_path = None
+        async with self._semaphore:
+            job.status = "running"
+            logger.info(f"Building bundle {job.id} ({job.files_total} files)")
+
+            def on_file_done(count: int) -> None:
+                job.files_done = count
+
+            out = None
+            try:
+                part_path, out = await loop.run_in_executor(self.executor, self._open_part, job.id)
+                async for data in iter_zip_stream(
+                    files, mode=mode, compresslevel=compresslevel, executor=self.executor,
+                    read_ahead=self.read_ahead, on_file_done=on_file_done
+                ):
+                    if data:
+                        await loop.run_in_executor(self.executor, out.write, data)
+                        job.bytes_written += len(data)
+                await loop.run_in_executor(self.executor, out.close)
+                out = None
+                await loop.run_in_executor(self.executor, os.replace, part_path, job.artifact_path)
+                job.status = "done"
+                logger.info(f"Bundle {job.id} ready: {job.bytes_written} bytes")
+            except asyncio.CancelledError:
+                job.status = "failed"
+                job.error = "Cancelled"
+                raise
+            except Exception as e:
+                logger.exception(f"Bundle {job.id} failed")
+                job.status = "failed"
+                job.error = str(e)
+            finally:
+                job.finished_at = time.time()
+                if out is not None:
+                    out.close()
+                if job.status != "done" and part_path is not None:
+                    part_path.unlink(missing_ok=True)
+
+    async def _cleanup_loop(self, interval: float = 60.0) -> None:
+        while True:
+            await asyncio.sleep(interval)
+            try:
+                await self._remove_expired()
+            except Exception:
+                logger.exception("Bundle artifact cleanup failed")
+
+    async def _remove_expired(self) -> None:
+        now = time.time()
+        for job_id, job in list(self._jobs.items()):
+            if job.finished_at and job.finished_at + self.ttl < now:
+                del self._jobs[job_id]
+        building = {job_id for job_id, job in self._jobs.items() if job.status == "running"}
+        await asyncio.to_thread(self._remove_expired_files, building)
+
+    def _remove_expired_files(self, building: Set[str]) -> None:
+        now = time.time()
+        for artifact in self.artifact_dir.glob("*.zip"):
+            try:
+                if artifact.stat().st_mtime + self.ttl < now:
+                    artifact.unlink()
+                    logger.info(f"Removed expired bundle artifact {artifact.name}")
+            except OSError:
+                pass
+        for part in self.artifact_dir.glob("*.zip.part"):
+            if part.name.split(".", 1)[0] in building:
+                continue
+            try:
+                if part.stat().st_mtime + STALE_PART_AGE < now:
+                    part.unlink()
+                    logger.info(f"Removed abandoned partial bundle {part.name}")
+            except OSError:
+                pass
@@ -0,0 +1,182 @@
+"""
+Bounded, non-blocking pool of headless LibreOffice workers.
+
+Conversions used to run through subprocess.run() inside async handlers,
+freezing the event loop for the whole conversion. Jobs now go through an
+asyncio priority queue served by a fixed number of workers. Each worker owns
+its own LibreOffice user profile (so instances never fight over the profile
+lock, and the profile stays warm between jobs) and runs soffice as an asyncio
+subprocess with a per-job timeout. A job whose caller gives up is killed, and
+a full queue is reported with ConversionPoolBusy so the API can answer 503.
+
+Profiles live in `<profile_root>/<pid>_worker_<i>`, so several processes
+(uvicorn --workers, the warm_previews CLI) can share one profile root; soffice
+runs with --nolockcheck and must never see a profile another process uses.
+"""
+
+import asyncio
+import itertools
+import logging
+import os
+import shutil
+from pathlib import Path
+from typing import List, Optional
+
+
+logger = logging.getLogger(__name__)
+
+
+class ConversionPoolBusy(Exception):
+    """Raised when the conversion queue is full."""
+
+
+class _Job:
+    def __init__(self, source: Path, output_dir: Path, convert_to: str, timeout: float):
+        self.source = source
+        self.output_dir = output_dir
+        self.convert_to = convert_to
+        self.timeout = timeout
+        self.future: asyncio.Future = asyncio.get_running_loop().create_future()
+
+
+class ConversionPool:
+    """
+    Runs LibreOffice `--convert-to` jobs on `workers` concurrent soffice processes.
+    Lower `priority` values are served first.
+    """
+
+    def __init__(self, soffice_path: Optional[str], workers: int, max_queue: int, profile_root: Path):
+        self.soffice_path = soffice_path
+        self.workers = max(1, workers)
+        self.max_queue = max_queue
+        self.profile_root = profile_root
+        self._queue: Optional[asyncio.PriorityQueue] = None
+        self._tasks: List[asyncio.Task] = []
+        self._seq = itertools.count()
+
+    @property
+    def queue_depth(self) -> int:
+        return self._queue.qsize() if self._queue is not None else 0
+
+    async def start(self) -> None:
+        if self._tasks:
+            return
+        self._queue = asyncio.PriorityQueue()
+        await asyncio.to_thread(self._remove_orphaned_profiles)
+        for i in range(self.workers):
+            profile_dir = self._profile_dir(i)
+            await asyncio.to_thread(profile_dir.mkdir, parents=True, exist_ok=True)
+            self._tasks.append(asyncio.create_task(self._worker(i, profile_dir)))
+        logger.info(f"LibreOffice conversion pool started with {self.workers} workers (queue limit {self.max_queue})")
+
+    async def stop(self) -> None:
+        for task in self._tasks:
+            task.cancel()
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+        self._tasks = []
+        for i in range(self.workers):
+            await asyncio.to_thread(shutil.rmtree, self._profile_dir(i), True)
+        if self._queue is not None:
+            while not self._queue.empty():
+                _, _, job = self._queue.get_nowait()
+                if not job.future.done():
+                    job.future.set_exception(RuntimeError("LibreOffice conversion pool is shutting down."))
+        logger.info("LibreOffice conversion pool stopped")
+
+    def _profile_dir(self, index: int) -> Path:
+        return self.profile_root / f"{os.getpid()}_worker_{index}"
+
+    def _remove_orphaned_profiles(self) -> None:
+        # Profiles of processes that died without stop()
+        if not self.profile_root.is_dir():
+            return
+        for profile_dir in self.profile_root.iterdir():
+            pid, sep, _ = profile_dir.name.partition("_worker_")
+            if not sep or not pid.isdigit() or int(pid) == os.getpid():
+                continue
+            try:
+                os.kill(int(pid), 0)
+            except ProcessLookupError:
+                shutil.rmtree(profile_dir, ignore_errors=True)
+            except OSError:
+                pass  # alive, owned by another user
+
+    async def convert(self, source: Path, output_dir: Path, convert_to: str, timeout: float, priority: int = 0) -> None:
+        """
+        Converts `source` into `output_dir` with soffice `--convert-to <convert_to>`.
+        Raises ConversionPoolBusy if the queue is full and RuntimeError if the
+        conversion fails or times out. Cancelling the caller cancels the job.
+        """
+        if not self.soffice_path:
+            raise RuntimeError("LibreOffice binary path is not configured or found.")
+        if not self._tasks:
+            raise RuntimeError("LibreOffice conversion pool is not running.")
+        if self._queue.qsize() >= self.max_queue:
+            raise ConversionPoolBusy(f"Conversion queue is full ({self.max_queue} jobs waiting).")
+
+        job = _Job(source, output_dir, convert_to, timeout)
+        self._queue.put_nowait((priority, next(self._seq), job))
+        await job.future
+
+    async def _worker(self, index: int, profile_dir: Path) -> None:
+        while True:
+            _, _, job = await self._queue.get()
+            try:
+                if job.future.done():  # cancelled while waiting in the queue
+                    continue
+                await self._run(job, profile_dir)
+            except asyncio.CancelledError:
+                if not job.future.done():
+                    job.future.cancel()
+                raise
+            except Exception as e:
+                logger.exception(f"LibreOffice worker {index} failed on {job.source.name}")
+                if not job.future.done():
+                    job.future.set_exception(RuntimeError(f"Unexpected error during LibreOffice execution for {job.source.name}: {e}"))
+            finally:
+                self._queue.task_done()
+
+    async def _run(self, job: _Job, profile_dir: Path) -> None:
+        cmd = [
+            self.soffice_path, f"-env:UserInstallation={profile_dir.resolve().as_uri()}",
+            "--headless", "--nolockcheck", "--nodefault", "--norestore", "--invisible",
+            "--convert-to", job.convert_to,
+            "--outdir", str(job.output_dir), str(job.source)
+        ]
+        process = await asyncio.create_subprocess_exec(
+            *cmd, stdout=asyncio.subprocess.PIPE, stderr=asyncio.subprocess.PIPE
+        )
+        communicate = asyncio.ensure_future(process.communicate())
+        try:
+            done, _ = await asyncio.wait({communicate, job.future}, timeout=job.timeout, return_when=asyncio.FIRST_COMPLETED)
+        except asyncio.CancelledError:  # pool shutting down
+            process.kill()
+            raise
+
+        if communicate not in done:
+            process.kill()
+            await asyncio.gather(communicate, return_exceptions=True)
+            if not job.future.done():
+                error_msg = f"LibreOffice conversion timed out for {job.source.name} after {job.timeout}s."
+                logger.error(error_msg)
+                job.future.set_exception(RuntimeError(error_msg))
+            else:
+                logger.info(f"LibreOffice conversion of {job.source.name} cancelled by caller")
+            return
+
+        stdout, stderr = communicate.result()
+        stdout_text = stdout.decode(errors="replace")
+        stderr_text = stderr.decode(errors="replace")
+        if process.returncode != 0:
+            error_msg = (f"LibreOffice conversion failed for {job.source.name} (exit code {process.returncode}).\n"
+                         f"Stderr: {stderr_text[:1000]}\nStdout: {stdout_text[:1000]}")
+            logger.error(error_msg)
+            if not job.future.done():
+                job.future.set_exception(RuntimeError(error_msg))
+            return
+
+        if stderr_text:
+            logger.info(f"LibreOffice STDERR for {job.source.name} conversion: {stderr_text[:1000]}")
+        if not job.future.done():
+            job.future.set_result(None)
+
@@ -0,0 +1,100 @@
+"""
+Shared, app-lifetime HTTP client for talking to Elasticsearch.
+
+Every search/download endpoint used to open its own ``httpx.AsyncClient`` per
+request, paying a fresh TCP connect each time and throwing keep-alive away.
+Instead, each FastAPI app creates one pooled client at startup (see
+``es_lifespan``) and every handler borrows it through ``get_es_client()``.
+
+Pool behaviour is tunable through environment variables:
+
+    ES_MAX_CONNECTIONS            total connections in the pool (default 100)
+    ES_MAX_KEEPALIVE_CONNECTIONS  idle connections kept open (default 20)
+    ES_KEEPALIVE_EXPIRY           seconds an idle connection is kept (default 30)
+    ES_HTTP2                      "1"/"true" to negotiate HTTP/2 (needs `h2`)
+    ES_TIMEOUT                    default request timeout in seconds (default 10)
+"""
+
+import logging
+import os
+from contextlib import asynccontextmanager
+from typing import AsyncIterator, Optional
+
+import httpx
+
+
+logger = logging.getLogger(__name__)
+
+
+ES_MAX_CONNECTIONS = int(os.getenv("ES_MAX_CONNECTIONS", "100"))
+ES_MAX_KEEPALIVE_CONNECTIONS = int(os.getenv("ES_MAX_KEEPALIVE_CONNECTIONS", "20"))
+ES_KEEPALIVE_EXPIRY = float(os.getenv("ES_KEEPALIVE_EXPIRY", "30"))
+ES_HTTP2 = os.getenv("ES_HTTP2", "false").lower() in ("1", "true", "yes")
+ES_TIMEOUT = float(os.getenv("ES_TIMEOUT", "10"))
+
+
+_client: Optional[httpx.AsyncClient] = None
+
+
+def _http2_available() -> bool:
+    try:
+        import h2  # noqa: F401  (pip install httpx[http2])
+    except ImportError:
+        return False
+    return True
+
+
+async def init_es_client() -> httpx.AsyncClient:
+    """
+    Creates the shared pooled client. Safe to call more than once; the
+    existing client is returned if it is still open.
+    """
+    global _client
+    if _client is not None and not _client.is_closed:
+        return _client
+
+    http2 = ES_HTTP2
+    if http2 and not _http2_available():
+        logger.warning("ES_HTTP2 is enabled but the 'h2' package is not installed. Falling back to HTTP/1.1.")
+        http2 = False
+
+    limits = httpx.Limits(
+        max_connections=ES_MAX_CONNECTIONS,
+        max_keepalive_connections=ES_MAX_KEEPALIVE_CONNECTIONS,
+        keepalive_expiry=ES_KEEPALIVE_EXPIRY,
+    )
+    _client = httpx.AsyncClient(limits=limits, timeout=ES_TIMEOUT, http2=http2)
+    logger.info(
+        f"Elasticsearch client started (max_connections={ES_MAX_CONNECTIONS}, "
+        f"keepalive={ES_MAX_KEEPALIVE_CONNECTIONS}/{ES_KEEPALIVE_EXPIRY}s, http2={http2})"
+    )
+    return _client
+
+
+async def close_es_client() -> None:
+    """Closes the shared client and releases every pooled connection."""
+    global _client
+    if _client is not None:
+        await _client.aclose()
+        logger.info("Elasticsearch client closed")
+    _client = None
+
+
+def get_es_client() -> httpx.AsyncClient:
+    """
+    Returns the shared client. Raises RuntimeError if the app was started
+    without ``es_lifespan`` (or ``init_es_client`` was never awaited).
+    """
+    if _client is None or _client.is_closed:
+        raise RuntimeError("Elasticsearch client is not initialised. Was the app started with es_lifespan?")
+    return _client
+
+
+@asynccontextmanager
+async def es_lifespan(app) -> AsyncIterator[None]:
+    """FastAPI lifespan that opens the shared client at startup and closes it at shutdown."""
+    await init_es_client()
+    try:
+        yield
+    finally:
+        await close_es_client()
@@ -0,0 +1,143 @@
+"""
+Conditional file responses for document downloads and previews.
+
+FileResponse already serves Range / If-Range requests (206 / 416) and uses the
+ASGI pathsend extension when the server offers it. On top of that this adds
+strong validators (ETag from size + mtime, Last-Modified) with 304 answers to
+If-None-Match / If-Modified-Since. Optionally the transfer can be handed to
+nginx through X-Accel-Redirect, which then sendfile()s the file itself.
+"""
+
+import asyncio
+import os
+from email.utils import formatdate, parsedate_to_datetime
+from pathlib import Path
+from typing import Callable, Dict, Optional
+from urllib.parse import quote
+
+from fastapi import Request
+from fastapi.responses import FileResponse, Response
+
+
+# When set (e.g. "/_files"), responses carry `X-Accel-Redirect: <prefix><absolute path>`
+# and no body, for an nginx `internal` location that aliases the filesystem root.
+X_ACCEL_REDIRECT_PREFIX = os.getenv("X_ACCEL_REDIRECT_PREFIX", "").rstrip("/")
+# nginx opens the file only after our response has gone out, so `release` is
+# delayed by this many seconds after an X-Accel handoff. Once nginx has the file
+# open, removing it no longer matters; a handoff slower than this gives up the
+# guarantee `release` stands for (e.g. a preview cache entry may be evicted).
+X_ACCEL_RELEASE_DELAY = float(os.getenv("X_ACCEL_RELEASE_DELAY", "30"))
+DOCUMENT_CACHE_CONTROL = os.getenv("DOCUMENT_CACHE_CONTROL", "private, max-age=0, must-revalidate")
+
+
+def file_etag(st: os.stat_result) -> str:
+    """Strong ETag for the current version of a file."""
+    return f'"{st.st_size:x}-{st.st_mtime_ns:x}"'
+
+
+def _etag_in(header: str, etag: str) -> bool:
+    # If-None-Match uses weak comparison, so W/"x" matches "x"
+    if header.strip() == "*":
+        return True
+    candidates = [tag.strip() for tag in header.split(",")]
+    return any(tag.removeprefix("W/") == etag for tag in candidates)
+
+
+class ReleasingFileResponse(FileResponse):
+    """FileResponse that calls `release` once it is done with the file, also when the client goes away."""
+
+    def __init__(self, *args, release: Callable[[], None], **kwargs):
+        super().__init__(*args, **kwargs)
+        self._release = release
+
+    async def __call__(self, scope, receive, send) -> None:
+        try:
+            await super().__call__(scope, receive, send)
+        finally:
+            self._release()
+
+
+def is_not_modified(request: Request, etag: str, st: os.stat_result) -> bool:
+    if_none_match = request.headers.get("if-none-match")
+    if if_none_match is not None:  # takes precedence over If-Modified-Since
+        return _etag_in(if_none_match, etag)
+    if_modified_since = request.headers.get("if-modified-since")
+    if if_modified_since:
+        try:
+            since = parsedate_to_datetime(if_modified_since)
+        except (TypeError, ValueError):
+            return False
+        return int(st.st_mtime) <= since.timestamp()
+    return False
+
+
+async def conditional_file_response(
+    request: Request,
+    path: Path,
+    media_type: str,
+    filename: Optional[str] = None,
+    content_disposition_type: str = "attachment",
+    etag: Optional[str] = None,
+    cache_control: str = DOCUMENT_CACHE_CONTROL,
+    release: Optional[Callable[[], None]] = None,
+) -> Response:
+    """
+    Serves `path` with ETag / Last-Modified validators, answering 304 when the
+    client's copy is current and Range requests with partial content. `etag`
+    overrides the size+mtime ETag (e.g. with a content hash from the index).
+    `release` is called once the file is no longer needed (e.g. to unpin a
+    preview cache entry), however the response ends; with X-Accel-Redirect,
+    X_ACCEL_RELEASE_DELAY seconds after the handoff.
+    """
+    try:
+        response = await _conditional_file_response(
+            request, path, media_type, filename, content_disposition_type, etag, cache_control, release
+        )
+    except BaseException:
+        if release:
+            release()
+        raise
+    if release and response.headers.get("X-Accel-Redirect"):
+        asyncio.get_running_loop().call_later(X_ACCEL_RELEASE_DELAY, release)
+    elif release and not isinstance(response, ReleasingFileResponse):
+        release()  # nothing left to read from the file
+    return response
+
+
+async def _conditional_file_response(
+    request: Request,
+    path: Path,
+    media_type: str,
+    filename: Optional[str],
+    content_disposition_type: str,
+    etag: Optional[str],
+    cache_control: str,
+    release: Optional[Callable[[], None]],
+) -> Response:
+    st = await asyncio.to_thread(os.stat, path)
+    etag = etag or file_etag(st)
+    headers: Dict[str, str] = {
+        "ETag": etag,
+        "Last-Modified": formatdate(st.st_mtime, usegmt=True),
+        "Cache-Control": cache_control,
+    }
+
+    if request.method in ("GET", "HEAD") and is_not_modified(request, etag, st):
+        return Response(status_code=304, headers=headers)
+
+    if X_ACCEL_REDIRECT_PREFIX or release is None:
+        response = FileResponse(
+            path, media_type=media_type, headers=headers, filename=filename,
+            stat_result=st, content_disposition_type=content_disposition_type,
+        )
+    else:
+        response = ReleasingFileResponse(
+            path, media_type=media_type, headers=headers, filename=filename,
+            stat_result=st, content_disposition_type=content_disposition_type, release=release,
+        )
+    if X_ACCEL_REDIRECT_PREFIX:
+        # nginx does the Range handling and the zero-copy transfer
+        accel_headers = {k: v for k, v in response.headers.items() if k not in ("content-length", "accept-ranges")}
+        accel_headers["X-Accel-Redirect"] = X_ACCEL_REDIRECT_PREFIX + quote(Path(path).resolve().as_posix())
+        return Response(headers=accel_headers, media_type=media_type)
+    return response
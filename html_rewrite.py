@@ -0,0 +1,88 @@
+"""
+Streaming rewrite of <img src> attributes in converted HTML previews.
+
+The document is fed through html.parser in chunks and re-emitted token by
+token, so memory use stays flat no matter how large the HTML is. Only the
+`src` of <img> tags is touched; everything else is written back as it came in.
+"""
+
+import html
+from html.parser import HTMLParser
+from pathlib import Path
+from typing import Callable, List, Optional, TextIO, Tuple
+
+
+HTML_READ_CHUNK = 64 * 1024
+
+
+class _ImageSrcRewriter(HTMLParser):
+    def __init__(self, rewrite: Callable[[str], Optional[str]], out: TextIO):
+        super().__init__(convert_charrefs=False)
+        self._rewrite = rewrite
+        self._out = out
+        self.rewritten = 0
+
+    def _img_tag(self, attrs: List[Tuple[str, Optional[str]]], self_closing: bool) -> Optional[str]:
+        changed = False
+        new_attrs = []
+        for name, value in attrs:
+            if name == "src" and value:
+                new_value = self._rewrite(value)
+                if new_value is not None:
+                    value, changed = new_value, True
+            new_attrs.append((name, value))
+        if not changed:
+            return None
+        self.rewritten += 1
+        parts = [name if value is None else f'{name}="{html.escape(value, quote=True)}"' for name, value in new_attrs]
+        return "<img " + " ".join(parts) + (" />" if self_closing else ">")
+
+    def handle_starttag(self, tag, attrs):
+        rebuilt = self._img_tag(attrs, self_closing=False) if tag == "img" else None
+        self._out.write(rebuilt or self.get_starttag_text())
+
+    def handle_startendtag(self, tag, attrs):
+        rebuilt = self._img_tag(attrs, self_closing=True) if tag == "img" else None
+        self._out.write(rebuilt or self.get_starttag_text())
+
+    def handle_endtag(self, tag):
+        self._out.write(f"</{tag}>")
+
+    def handle_data(self, data):
+        self._out.write(data)
+
+    def handle_entityref(self, name):
+        self._out.write(f"&{name};")
+
+    def handle_charref(self, name):
+        self._out.write(f"&#{name};")
+
+    def handle_comment(self, data):
+        self._out.write(f"<!--{data}-->")
+
+    def handle_decl(self, decl):
+        self._out.write(f"<!{decl}>")
+
+    def handle_pi(self, data):
+        self._out.write(f"<?{data}>")
+
+    def unknown_decl(self, data):
+        self._out.write(f"<![{data}]>")
+
+
+def rewrite_image_sources(
+    source: Path, dest: Path, rewrite: Callable[[str], Optional[str]], chunk_size: int = HTML_READ_CHUNK
+) -> int:
+    """
+    Copies the HTML file `source` to `dest`, replacing each <img src> with
+    `rewrite(src)` (None keeps it as is). Returns the number of rewritten tags.
+    """
+    with open(source, "r", encoding="utf-8", errors="replace") as src, open(dest, "w", encoding="utf-8") as out:
+        parser = _ImageSrcRewriter(rewrite, out)
+        while True:
+            chunk = src.read(chunk_size)
+            if not chunk:
+                break
+            parser.feed(chunk)
+        parser.close()
+        return parser.rewritten
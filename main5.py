@@ -6,24 +6,39 @@
 
 # Add these imports at the top of your Python file
 import base64
-import io
 from bs4 import BeautifulSoup # pip install beautifulsoup4
 from urllib.parse import unquote # To handle URL-encoded filenames if any
 import os
 import shutil # For shutil.which to find libreoffice
 import mimetypes
-import subprocess
+import re
+import hashlib
+import functools
 import tempfile
 from pathlib import Path
-from typing import List, Optional
+from typing import AsyncIterator, Dict, List, Optional, Tuple
 
-import zipfile
 import httpx
-from fastapi import FastAPI, Query, HTTPException,Form
+from fastapi import FastAPI, Query, HTTPException,Form,Request
 from fastapi.middleware.cors import CORSMiddleware
-from fastapi.responses import FileResponse, HTMLResponse,StreamingResponse
+from fastapi.responses import HTMLResponse,StreamingResponse,JSONResponse
 import logging
 import json
+import asyncio
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import asynccontextmanager
+from datetime import datetime
+
+from es_client import es_lifespan, get_es_client
+from preview_cache import PreviewCache
+from conversion_pool import ConversionPool, ConversionPoolBusy
+from bundle_jobs import BundleJobManager
+from file_responses import conditional_file_response
+from html_rewrite import rewrite_image_sources
+from pdf_pages import (
+    PagedPreviewUnavailable, extract_page_pdf, pdf_page_count, render_page_png, render_page_thumbnail, render_thumbnails,
+)
+from zip_stream import COMPRESSION_MODES, BundleFile, iter_zip_stream, unique_arcname
 
 # ... (your existing imports: os, shutil, mimetypes, subprocess, tempfile, Path, etc.)
 # ... (FastAPI imports, Settings, logger, etc.)
@@ -67,7 +82,71 @@ if not LIBREOFFICE_PATH:
         "DOC/DOCX to HTML conversion will fail."
     )
 
-app = FastAPI() # Your FastAPI app instance
+# Converted previews are kept on disk, keyed by path + mtime + size, so each file
+# is only converted once per version. Worker processes and the warm_previews CLI
+# can share the directory: pins and evictions are coordinated with flock() on
+# local files, so it must not be on NFS.
+PREVIEW_CACHE_DIR = Path(os.getenv("PREVIEW_CACHE_DIR", os.path.join(tempfile.gettempdir(), "doc_preview_cache")))
+PREVIEW_CACHE_QUOTA_MB = int(os.getenv("PREVIEW_CACHE_QUOTA_MB", "2048"))
+preview_cache = PreviewCache(PREVIEW_CACHE_DIR, PREVIEW_CACHE_QUOTA_MB * 1024 * 1024)
+HTML_PREVIEW_NAME = "preview.html"
+PDF_PREVIEW_NAME = "preview.pdf"
+# DOC/DOCX previews either link their images (served from the preview cache under
+# stable URLs, so browsers cache them) or inline them as Base64 like before.
+HTML_PREVIEW_IMAGE_MODES = ("linked", "inline")
+HTML_PREVIEW_IMAGES = os.getenv("HTML_PREVIEW_IMAGES", "linked")
+PREVIEW_ASSETS_DIR = "assets"
+PREVIEW_ASSET_URL = os.getenv("PREVIEW_ASSET_URL", "/api/previews").rstrip("/")
+PREVIEW_KEY_RE = re.compile(r"^[0-9a-f]{64}$")
+PREVIEW_ASSET_NAME_RE = re.compile(r"^[0-9a-f]{16}(\.[A-Za-z0-9]{1,10})?$")
+
+# LibreOffice conversions run on a bounded pool of soffice workers, each with its
+# own user profile, instead of blocking the event loop with subprocess.run().
+LIBREOFFICE_WORKERS = int(os.getenv("LIBREOFFICE_WORKERS", str(max(1, (os.cpu_count() or 2) // 2))))
+LIBREOFFICE_MAX_QUEUE = int(os.getenv("LIBREOFFICE_MAX_QUEUE", "32"))
+LIBREOFFICE_PROFILE_DIR = Path(os.getenv("LIBREOFFICE_PROFILE_DIR", os.path.join(tempfile.gettempdir(), "lo_profiles")))
+HTML_CONVERSION_TIMEOUT = 120
+PDF_CONVERSION_TIMEOUT = 180
+conversion_pool = ConversionPool(LIBREOFFICE_PATH, LIBREOFFICE_WORKERS, LIBREOFFICE_MAX_QUEUE, LIBREOFFICE_PROFILE_DIR)
+
+# Search-driven prefetch (see /api/previews/prefetch): conversions below interactive
+# priority, started only while the queue has fewer than PREFETCH_MAX_QUEUE jobs
+PREFETCH_PRIORITY = 10
+PREFETCH_MAX_DOCS = int(os.getenv("PREFETCH_MAX_DOCS", "5"))
+PREFETCH_MAX_QUEUE = int(os.getenv("PREFETCH_MAX_QUEUE", str(LIBREOFFICE_WORKERS)))
+_prefetch_sessions: Dict[str, List[asyncio.Task]] = {}
+_background_tasks = set()
+
+
+# Bundle downloads validate, stat and read files on this pool (NFS-friendly), never on the event loop
+BUNDLE_IO_WORKERS = int(os.getenv("BUNDLE_IO_WORKERS", "8"))
+BUNDLE_READ_AHEAD = int(os.getenv("BUNDLE_READ_AHEAD", "4"))
+bundle_io_executor = ThreadPoolExecutor(max_workers=BUNDLE_IO_WORKERS, thread_name_prefix="bundle_io")
+
+# Background bundle jobs write finished archives here; they expire after the TTL
+BUNDLE_ARTIFACT_DIR = Path(os.getenv("BUNDLE_ARTIFACT_DIR", os.path.join(tempfile.gettempdir(), "doc_bundles")))
+BUNDLE_ARTIFACT_TTL = int(os.getenv("BUNDLE_ARTIFACT_TTL", "3600"))
+BUNDLE_JOB_WORKERS = int(os.getenv("BUNDLE_JOB_WORKERS", "2"))
+bundle_jobs = BundleJobManager(
+    BUNDLE_ARTIFACT_DIR, BUNDLE_ARTIFACT_TTL, BUNDLE_JOB_WORKERS,
+    executor=bundle_io_executor, read_ahead=BUNDLE_READ_AHEAD
+)
+
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    async with es_lifespan(app):
+        await conversion_pool.start()
+        await bundle_jobs.start()
+        try:
+            yield
+        finally:
+            await bundle_jobs.stop()
+            await conversion_pool.stop()
+            bundle_io_executor.shutdown(wait=False, cancel_futures=True)
+
+
+app = FastAPI(lifespan=lifespan) # Your FastAPI app instance
 
 
 # --- CORS ---
@@ -121,6 +200,32 @@ def is_path_secure_and_valid(client_path_str: str, allowed_roots: List[Path]) ->
 
     return resolved_path
 
+async def validate_bundle_files(candidates: List[Tuple[str, Optional[str]]]) -> List[BundleFile]:
+    """
+    Validates (path, FileExtension) candidates concurrently on the bundle I/O pool.
+    Returns BundleFiles with unique archive names, in the original order; invalid
+    paths are logged and skipped.
+    """
+    loop = asyncio.get_running_loop()
+
+    async def check(path_str: str) -> Optional[Path]:
+        try:
+            return await loop.run_in_executor(bundle_io_executor, is_path_secure_and_valid, path_str, ALLOWED_DOCUMENT_ROOTS)
+        except Exception as e:
+            logger.error(f"Skipping file {path_str}: {e}")
+            return None
+
+    resolved = await asyncio.gather(*(check(path_str) for path_str, _ in candidates))
+
+    bundle_files = []
+    used_names = set()
+    for (_, file_extension), valid_path in zip(candidates, resolved):
+        if valid_path is not None:
+            # Use `arcname` to store the file with just its name, not the full server path
+            bundle_files.append(BundleFile(valid_path, unique_arcname(valid_path.name, used_names), file_extension))
+    return bundle_files
+
+
 def embed_images_as_base64(html_content: str, base_path: Path) -> str:
     """
     Parses HTML content, finds local image references, and embeds them as Base64.
@@ -172,11 +277,11 @@ def embed_images_as_base64(html_content: str, base_path: Path) -> str:
 
 
 # *** UPDATED *** convert_to_html_with_libreoffice
-def convert_to_html_with_libreoffice(source_file: Path, output_dir: Path, embed_images: bool = True) -> str: # Returns HTML string
+async def run_libreoffice_html_conversion(source_file: Path, output_dir: Path, priority: int = 0) -> Path:
     """
-    Converts a document to HTML using LibreOffice.
-    Optionally embeds images as Base64.
-    Raises exceptions on failure. Returns the HTML content as a string.
+    Converts a document to HTML using LibreOffice (through the conversion pool).
+    Raises exceptions on failure (ConversionPoolBusy if the pool is saturated).
+    Returns the path of the generated HTML file; its images sit next to it.
     """
     if not LIBREOFFICE_PATH:
         raise RuntimeError("LibreOffice binary path is not configured or found.")
@@ -185,33 +290,11 @@ def convert_to_html_with_libreoffice(source_file: Path, output_dir: Path, embed_
 
     # LibreOffice will create files in output_dir.
     # We expect an HTML file and potentially image files/subdirectories.
-    
-    cmd = [
-        LIBREOFFICE_PATH, "--headless", "--nolockcheck", "--nodefault",
-        "--norestore", "--invisible",
-        "--convert-to", "html:HTML (StarWriter)", # This filter usually handles images better
-        # Forcing a specific HTML export filter might be needed if images are problematic
-        # e.g. "html:XHTML Writer File" might behave differently with images
-        "--outdir", str(output_dir), str(source_file)
-    ]
-
-    try:
-        process = subprocess.run(cmd, check=True, timeout=120, capture_output=True, text=True, errors='replace')
-        if process.stderr:
-             logger.info(f"LibreOffice STDERR for {source_file.name} conversion: {process.stderr[:1000]}") # Log stderr
-    except subprocess.TimeoutExpired as e:
-        error_msg = f"LibreOffice conversion timed out for {source_file.name}. Stderr: {e.stderr}"
-        logger.error(error_msg)
-        raise RuntimeError(error_msg) from e
-    except subprocess.CalledProcessError as e:
-        error_msg = (f"LibreOffice conversion failed for {source_file.name} (exit code {e.returncode}).\n"
-                     f"Stderr: {e.stderr[:1000]}\nStdout: {e.stdout[:1000]}")
-        logger.error(error_msg)
-        raise RuntimeError(error_msg) from e
-    except Exception as e:
-        error_msg = f"Unexpected error during LibreOffice execution for {source_file.name}: {e}"
-        logger.error(error_msg)
-        raise RuntimeError(error_msg) from e
+    # "html:HTML (StarWriter)" usually handles images better;
+    # e.g. "html:XHTML Writer File" might behave differently with images
+    await conversion_pool.convert(
+        source_file, output_dir, "html:HTML (StarWriter)", timeout=HTML_CONVERSION_TIMEOUT, priority=priority
+    )
 
     # Find the generated HTML file. LibreOffice typically names it based on the source stem.
     # It might also create subfolders like 'filename_html_SOMEHASH' or just 'filename.html'
@@ -239,23 +322,424 @@ def convert_to_html_with_libreoffice(source_file: Path, output_dir: Path, embed_
         logger.warning(f"Expected HTML file '{expected_html_filename}' not found. Using first found: '{html_file_path.name}'")
 
     logger.info(f"LibreOffice successfully converted '{source_file.name}' to '{html_file_path}'.")
-    
+    return html_file_path
+
+
+async def convert_to_html_with_libreoffice(source_file: Path, output_dir: Path, embed_images: bool = True, priority: int = 0) -> str: # Returns HTML string
+    """
+    Converts a document to HTML using LibreOffice (through the conversion pool).
+    Optionally embeds images as Base64.
+    Raises exceptions on failure (ConversionPoolBusy if the pool is saturated).
+    Returns the HTML content as a string.
+    """
+    html_file_path = await run_libreoffice_html_conversion(source_file, output_dir, priority=priority)
+
     with open(html_file_path, "r", encoding="utf-8", errors="replace") as f:
         html_content = f.read()
 
     if embed_images:
         logger.info(f"Attempting to embed images for {html_file_path.name} from base directory {html_file_path.parent}")
         # The base path for resolving relative image URLs is the directory containing the HTML file.
-        html_content_with_embedded_images = embed_images_as_base64(html_content, html_file_path.parent)
+        # BeautifulSoup parsing is CPU-bound, keep it off the event loop.
+        html_content_with_embedded_images = await asyncio.to_thread(embed_images_as_base64, html_content, html_file_path.parent)
         return html_content_with_embedded_images
     
     return html_content
 
+async def convert_to_pdf_with_libreoffice(source_file: Path, output_dir: Path, priority: int = 0) -> Path:
+    """
+    Converts a document (PPT/PPTX and friends) to PDF using LibreOffice (through the conversion pool).
+    Raises exceptions on failure. Returns the path of the generated PDF.
+    """
+    if not LIBREOFFICE_PATH:
+        raise RuntimeError("LibreOffice binary path is not configured or found.")
+
+    # Specific PDF export filter
+    await conversion_pool.convert(
+        source_file, output_dir, "pdf:writer_pdf_Export", timeout=PDF_CONVERSION_TIMEOUT, priority=priority
+    )
+
+    pdf_filename = source_file.stem + ".pdf"
+    converted_pdf_path = output_dir / pdf_filename
+
+    if not converted_pdf_path.is_file():
+        # Fallback: search for any .pdf file
+        pdf_files = list(output_dir.glob("*.pdf"))
+        if not pdf_files:
+            raise FileNotFoundError("LibreOffice PDF conversion failed: No PDF file found.")
+        converted_pdf_path = pdf_files[0]
+        logger.warning(f"Expected PDF file '{pdf_filename}' not found. Using first found: '{converted_pdf_path.name}'")
+
+    logger.info(f"Successfully converted '{source_file.name}' to PDF: '{converted_pdf_path}'")
+    return converted_pdf_path
+
+
+def link_preview_images(html_file_path: Path, entry_dir: Path, asset_url: str) -> int:
+    """
+    Moves the images LibreOffice extracted next to `html_file_path` into the
+    preview entry's assets directory and writes HTML_PREVIEW_NAME with each
+    <img src> pointing at `asset_url`/<name>. The HTML is rewritten in a single
+    streaming pass. Returns the number of rewritten image tags.
+    """
+    base_path = html_file_path.parent.resolve()
+    assets_dir = entry_dir / PREVIEW_ASSETS_DIR
+    assets_dir.mkdir(exist_ok=True)
+    linked = {}
+
+    def rewrite(src: str) -> Optional[str]:
+        if src.startswith(('http:', 'https:', 'data:')):
+            return None
+        image_path = (base_path / unquote(src)).resolve()
+        if str(image_path) in linked:
+            return linked[str(image_path)]
+        if not image_path.is_relative_to(base_path):
+            logger.warning(f"Skipping image due to potential path traversal: {src} from base {base_path}")
+            return None
+        if not image_path.is_file():
+            logger.warning(f"Image not found for linking: {image_path} (original src: {src})")
+            return None
+        # Stable per entry: the entry itself never changes once published
+        name = hashlib.sha256(str(image_path.relative_to(base_path)).encode("utf-8")).hexdigest()[:16] + image_path.suffix.lower()
+        os.replace(image_path, assets_dir / name)
+        linked[str(image_path)] = f"{asset_url}/{name}"
+        return linked[str(image_path)]
+
+    count = rewrite_image_sources(html_file_path, entry_dir / HTML_PREVIEW_NAME, rewrite)
+    logger.info(f"Linked {len(linked)} images ({count} tags) for {html_file_path.name}")
+    return count
+
+
+async def build_html_preview(source_file: Path, entry_dir: Path, priority: int = 0, asset_url: Optional[str] = None) -> None:
+    """
+    Preview-cache producer, saved as HTML_PREVIEW_NAME. Images are embedded as
+    Base64, or, when `asset_url` is given, kept in the entry and linked under it.
+    """
+    lo_output_dir = entry_dir / "lo"
+    lo_output_dir.mkdir()
+    if asset_url:
+        html_file_path = await run_libreoffice_html_conversion(source_file, lo_output_dir, priority=priority)
+        await asyncio.to_thread(link_preview_images, html_file_path, entry_dir, asset_url)
+    else:
+        html_content = await convert_to_html_with_libreoffice(source_file, lo_output_dir, embed_images=True, priority=priority)
+        await asyncio.to_thread((entry_dir / HTML_PREVIEW_NAME).write_text, html_content, encoding="utf-8")
+    await asyncio.to_thread(shutil.rmtree, lo_output_dir, True)  # images are inlined or moved to assets
+
+
+async def build_pdf_preview(source_file: Path, entry_dir: Path, priority: int = 0) -> None:
+    """Preview-cache producer: LibreOffice PDF export, saved as PDF_PREVIEW_NAME."""
+    lo_output_dir = entry_dir / "lo"
+    lo_output_dir.mkdir()
+    converted_pdf_path = await convert_to_pdf_with_libreoffice(source_file, lo_output_dir, priority=priority)
+    os.replace(converted_pdf_path, entry_dir / PDF_PREVIEW_NAME)
+    await asyncio.to_thread(shutil.rmtree, lo_output_dir, True)
+
+
+async def preview_key(source_file: Path, kind: str) -> str:
+    """PreviewCache key of `source_file`; the stat runs in a worker thread, as roots may be on NFS."""
+    return await asyncio.to_thread(PreviewCache.make_key, source_file, kind)
+
+
+async def get_cached_preview(
+    source_file: Path, kind: str, priority: int = 0, detachable: bool = False, pin: bool = False
+) -> Path:
+    """
+    Returns the cached preview file for `source_file`, converting it first if
+    needed. `kind` is "html" (images inlined), "html-linked" (images served
+    from the cache) or "pdf". Concurrent viewers share one conversion;
+    `detachable` callers (prefetch) cancel it if nobody else is waiting.
+    With `pin` the caller must release_preview() the file when done with it.
+    """
+    key = await preview_key(source_file, kind)
+    if kind == "pdf":
+        name = PDF_PREVIEW_NAME
+        builder = build_pdf_preview
+    else:
+        name = HTML_PREVIEW_NAME
+        asset_url = f"{PREVIEW_ASSET_URL}/{key}/assets" if kind == "html-linked" else None
+        builder = functools.partial(build_html_preview, asset_url=asset_url)
+
+    async def producer(entry_dir: Path) -> None:
+        await builder(source_file, entry_dir, priority=priority)
+
+    entry_dir = await preview_cache.get_or_create(key, producer, detachable=detachable, pin=pin)
+    return entry_dir / name
+
+
+def release_preview(preview_file: Path) -> None:
+    """Unpins the cache entry of a file returned with pin=True, so it can be evicted again."""
+    preview_cache.release(preview_file.parent)
+
+
+def preview_kind_for(source_file: Path) -> Optional[str]:
+    """Preview cache kind `get_document` uses for a default view of `source_file`, if it converts."""
+    extension = source_file.suffix.lower()
+    if extension in (".doc", ".docx"):
+        return "html" if HTML_PREVIEW_IMAGES == "inline" else "html-linked"
+    if extension in (".ppt", ".pptx"):
+        return "pdf"
+    return None
+
+
+def cancel_prefetch(session_id: str) -> int:
+    tasks = _prefetch_sessions.pop(session_id, [])
+    for task in tasks:
+        task.cancel()
+    return sum(1 for task in tasks if not task.done())
+
+
+async def _prefetch_preview(source_file: Path, kind: str) -> None:
+    try:
+        await get_cached_preview(source_file, kind, priority=PREFETCH_PRIORITY, detachable=True)
+        logger.info(f"Prefetched {kind} preview for {source_file.name}")
+    except ConversionPoolBusy:
+        logger.debug(f"Prefetch of {source_file.name} dropped, conversion queue is full")
+    except (RuntimeError, FileNotFoundError) as e:
+        logger.warning(f"Prefetch of {source_file.name} failed: {e}")
+
+
+@app.post("/api/previews/prefetch", status_code=202)
+async def prefetch_previews(payload: dict):
+    """
+    Warms the preview cache for documents a user is likely to open next (sent
+    by the search service for the top hits of a result page). Conversions run
+    below interactive priority, only while the conversion queue is nearly idle,
+    and at most PREFETCH_MAX_DOCS per call. A new call for the same
+    `session_id` cancels what the previous one still had pending.
+    """
+    session_id = payload.get("session_id")
+    paths = payload.get("paths") or []
+    if not isinstance(paths, list):
+        raise HTTPException(status_code=400, detail="paths must be a list of SystemPath values.")
+
+    cancelled = cancel_prefetch(str(session_id)) if session_id else 0
+    if not LIBREOFFICE_PATH:
+        return {"scheduled": 0, "cancelled": cancelled}
+
+    tasks = []
+    for path_str in paths[:PREFETCH_MAX_DOCS]:
+        if conversion_pool.queue_depth + len(tasks) >= PREFETCH_MAX_QUEUE:
+            break  # out of budget, interactive views come first
+        try:
+            source_file = await asyncio.to_thread(is_path_secure_and_valid, str(path_str), ALLOWED_DOCUMENT_ROOTS)
+        except HTTPException:
+            continue
+        kind = preview_kind_for(source_file)
+        if kind is None or await asyncio.to_thread(preview_cache.lookup, await preview_key(source_file, kind)) is not None:
+            continue
+        tasks.append(asyncio.create_task(_prefetch_preview(source_file, kind)))
+
+    if session_id and tasks:
+        session_tasks = _prefetch_sessions.setdefault(str(session_id), [])
+        session_tasks.extend(tasks)
+        for task in tasks:
+            task.add_done_callback(lambda t, sid=str(session_id): _forget_prefetch_task(sid, t))
+    else:
+        for task in tasks:
+            _background_tasks.add(task)
+            task.add_done_callback(_background_tasks.discard)
+    return {"scheduled": len(tasks), "cancelled": cancelled}
+
+
+def _forget_prefetch_task(session_id: str, task: asyncio.Task) -> None:
+    tasks = _prefetch_sessions.get(session_id)
+    if tasks is not None and task in tasks:
+        tasks.remove(task)
+        if not tasks:
+            del _prefetch_sessions[session_id]
+
+
+@app.get("/api/previews/{key}/assets/{name}")
+async def get_preview_asset(request: Request, key: str, name: str):
+    """Images of "linked" HTML previews. Entries are content-addressed, so these never change."""
+    if not PREVIEW_KEY_RE.match(key) or not PREVIEW_ASSET_NAME_RE.match(name):
+        raise HTTPException(status_code=404, detail="Preview asset not found.")
+    entry_dir = await asyncio.to_thread(preview_cache.lookup, key, True)
+    if entry_dir is None:
+        raise HTTPException(status_code=404, detail="Preview asset not found.")
+    asset_path = entry_dir / PREVIEW_ASSETS_DIR / name
+    if not await asyncio.to_thread(asset_path.is_file):
+        preview_cache.release(entry_dir)
+        raise HTTPException(status_code=404, detail="Preview asset not found.")
+    mime_type = mimetypes.guess_type(name)[0] or "application/octet-stream"
+    return await conditional_file_response(
+        request, asset_path, mime_type, content_disposition_type="inline",
+        cache_control="private, max-age=31536000, immutable",
+        release=functools.partial(preview_cache.release, entry_dir),
+    )
+
+
+# --- Paged previews: one PDF conversion, then single pages and thumbnails on demand ---
+# These routes must be registered before the catch-all document route below.
+PAGED_PREVIEW_EXTENSIONS = {".doc", ".docx", ".ppt", ".pptx", ".odt", ".odp", ".rtf", ".pdf"}
+PAGE_FORMATS = ("png", "pdf", "thumb")
+PAGE_IMAGE_DPI = int(os.getenv("PAGE_IMAGE_DPI", "110"))
+PAGE_THUMBNAIL_SIZE = int(os.getenv("PAGE_THUMBNAIL_SIZE", "200"))
+PAGE_MANIFEST_NAME = "manifest.json"
+
+
+def _validate_paged_source(file_path: str) -> Path:
+    valid_src_path = is_path_secure_and_valid(file_path, ALLOWED_DOCUMENT_ROOTS)
+    if valid_src_path.suffix.lower() not in PAGED_PREVIEW_EXTENSIONS:
+        raise HTTPException(status_code=415, detail=f"Paged preview is not supported for '{valid_src_path.suffix}' files.")
+    if valid_src_path.suffix.lower() != ".pdf" and not LIBREOFFICE_PATH:
+        raise HTTPException(status_code=501, detail="LibreOffice is not available for paged previews.")
+    return valid_src_path
+
+
+@asynccontextmanager
+async def paged_pdf(source_file: Path, priority: int = 0) -> AsyncIterator[Path]:
+    """
+    PDF the pages are cut from: the file itself, or its cached LibreOffice
+    conversion, which stays pinned in the cache while the block runs.
+    """
+    if source_file.suffix.lower() == ".pdf":
+        yield source_file
+        return
+    pdf_path = await get_cached_preview(source_file, "pdf", priority=priority, pin=True)
+    try:
+        yield pdf_path
+    finally:
+        release_preview(pdf_path)
+
+
+async def get_thumbnails_dir(source_file: Path) -> Path:
+    """Cached directory with a <page>.png thumbnail for every page."""
+    async def producer(entry_dir: Path) -> None:
+        async with paged_pdf(source_file, priority=1) as pdf_path:
+            await render_thumbnails(pdf_path, entry_dir, PAGE_THUMBNAIL_SIZE)
+
+    return await preview_cache.get_or_create(await preview_key(source_file, "thumbs"), producer)
+
+
+def _precompute_thumbnails(source_file: Path) -> None:
+    async def run() -> None:
+        try:
+            await get_thumbnails_dir(source_file)
+        except Exception as e:
+            logger.warning(f"Thumbnail precomputation failed for {source_file.name}: {e}")
+
+    task = asyncio.create_task(run())
+    _background_tasks.add(task)
+    task.add_done_callback(_background_tasks.discard)
+
+
+async def get_page_manifest(source_file: Path) -> dict:
+    """
+    Page count of the paged preview, cached next to the other previews. Building
+    it also starts rendering the thumbnails in the background.
+    """
+    async def producer(entry_dir: Path) -> None:
+        async with paged_pdf(source_file) as pdf_path:
+            manifest = {"page_count": await pdf_page_count(pdf_path)}
+        await asyncio.to_thread((entry_dir / PAGE_MANIFEST_NAME).write_text, json.dumps(manifest))
+        _precompute_thumbnails(source_file)
+
+    entry_dir = await preview_cache.get_or_create(await preview_key(source_file, "pages"), producer, pin=True)
+    try:
+        return json.loads(await asyncio.to_thread((entry_dir / PAGE_MANIFEST_NAME).read_text))
+    finally:
+        preview_cache.release(entry_dir)
+
+
+async def get_page_file(source_file: Path, page: int, page_format: str, dpi: int) -> Path:
+    """
+    Cached single page of the paged preview as a one-page PDF, a PNG or a
+    thumbnail. Its cache entry is pinned; the caller must release_preview() it.
+    Thumbnails come from the precomputed set of all pages once that is ready,
+    and are rendered one at a time until then.
+    """
+    if page_format == "thumb":
+        thumbs_dir = await asyncio.to_thread(preview_cache.lookup, await preview_key(source_file, "thumbs"), True)
+        if thumbs_dir is not None:
+            if await asyncio.to_thread((thumbs_dir / f"{page}.png").is_file):
+                return thumbs_dir / f"{page}.png"
+            preview_cache.release(thumbs_dir)  # the renderer skipped this page, render it on its own
+
+    name = "page.pdf" if page_format == "pdf" else "page.png"
+    kind = f"page-{page_format}-{page}"
+    if page_format == "png":
+        kind += f"-{dpi}"
+    elif page_format == "thumb":
+        kind += f"-{PAGE_THUMBNAIL_SIZE}"
+
+    async def producer(entry_dir: Path) -> None:
+        async with paged_pdf(source_file) as pdf_path:
+            if page_format == "pdf":
+                await extract_page_pdf(pdf_path, page, entry_dir / name)
+            elif page_format == "thumb":
+                await render_page_thumbnail(pdf_path, page, entry_dir / name, PAGE_THUMBNAIL_SIZE)
+            else:
+                await render_page_png(pdf_path, page, entry_dir / name, dpi)
+
+    entry_dir = await preview_cache.get_or_create(await preview_key(source_file, kind), producer, pin=True)
+    if not await asyncio.to_thread((entry_dir / name).is_file):
+        preview_cache.release(entry_dir)
+        raise FileNotFoundError(f"Page {page} was not rendered")
+    return entry_dir / name
+
+
+@app.get("/api/documents/{file_path:path}/pages")
+async def get_document_pages(file_path: str):
+    """Page count of a paged preview, and where to fetch the pages."""
+    valid_src_path = _validate_paged_source(file_path)
+    try:
+        manifest = await get_page_manifest(valid_src_path)
+    except ConversionPoolBusy:
+        raise HTTPException(status_code=503, detail="Preview service is busy, please retry shortly.", headers={"Retry-After": "10"})
+    except PagedPreviewUnavailable as e:
+        raise HTTPException(status_code=501, detail=str(e))
+    except (RuntimeError, FileNotFoundError) as e:
+        logger.error(f"Paged preview failed for {valid_src_path.name}: {e}")
+        raise HTTPException(status_code=500, detail="Could not prepare the paged preview.")
+    return {
+        "page_count": manifest["page_count"],
+        "formats": list(PAGE_FORMATS),
+        "page_url": f"/api/documents/{file_path}/pages/{{n}}",
+    }
+
+
+@app.get("/api/documents/{file_path:path}/pages/{page}")
+async def get_document_page(
+    request: Request,
+    file_path: str,
+    page: int,
+    format: str = Query("png", enum=list(PAGE_FORMATS)),
+    dpi: int = Query(PAGE_IMAGE_DPI, ge=36, le=300),
+):
+    """One page of a paged preview: PNG (`dpi`), one-page PDF, or thumbnail."""
+    if format not in PAGE_FORMATS:
+        raise HTTPException(status_code=400, detail=f"Invalid format. Use one of {list(PAGE_FORMATS)}.")
+    valid_src_path = _validate_paged_source(file_path)
+    try:
+        manifest = await get_page_manifest(valid_src_path)
+        if not 1 <= page <= manifest["page_count"]:
+            raise HTTPException(status_code=404, detail=f"Page {page} does not exist (document has {manifest['page_count']} pages).")
+        page_file = await get_page_file(valid_src_path, page, format, dpi)
+    except HTTPException:
+        raise
+    except ConversionPoolBusy:
+        raise HTTPException(status_code=503, detail="Preview service is busy, please retry shortly.", headers={"Retry-After": "10"})
+    except PagedPreviewUnavailable as e:
+        raise HTTPException(status_code=501, detail=str(e))
+    except (RuntimeError, FileNotFoundError) as e:
+        logger.error(f"Rendering page {page} of {valid_src_path.name} failed: {e}")
+        raise HTTPException(status_code=500, detail="Could not render the requested page.")
+
+    media_type = "application/pdf" if format == "pdf" else "image/png"
+    return await conditional_file_response(
+        request, page_file, media_type, content_disposition_type="inline",
+        filename=f"{valid_src_path.stem}_p{page}.{'pdf' if format == 'pdf' else 'png'}",
+        release=functools.partial(release_preview, page_file),
+    )
+
+
 # *** UPDATED *** /api/documents/{file_path:path} endpoint
 @app.get("/api/documents/{file_path:path}")
 async def get_document(
+    request: Request,
     file_path: str,
     action: str = Query("view", enum=["view", "download"]),
+    images: str = Query(HTML_PREVIEW_IMAGES, enum=list(HTML_PREVIEW_IMAGE_MODES), description="DOC/DOCX previews: linked (cacheable image URLs) or inline (Base64)"),
 ):
     try:
         valid_src_path: Path = is_path_secure_and_valid(file_path, ALLOWED_DOCUMENT_ROOTS) # Your validation function
@@ -265,120 +749,84 @@ async def get_document(
         logger.error(f"Unexpected error during path validation for '{file_path}': {e}")
         raise HTTPException(status_code=500, detail="Server error during path validation.")
 
+    if images not in HTML_PREVIEW_IMAGE_MODES:
+        raise HTTPException(status_code=400, detail=f"Invalid images mode. Use one of {list(HTML_PREVIEW_IMAGE_MODES)}.")
+
     file_extension = valid_src_path.suffix.lower()
     mime_type, _ = mimetypes.guess_type(valid_src_path)
     mime_type = mime_type or "application/octet-stream"
 
     try:
         if action == "download":
-            return FileResponse(
-                path=valid_src_path, media_type=mime_type, filename=valid_src_path.name,
-                headers={"Content-Disposition": f'attachment; filename="{valid_src_path.name}"'}
-            )
+            return await conditional_file_response(request, valid_src_path, mime_type, filename=valid_src_path.name)
         
         elif action == "view":
             # --- DOC/DOCX to HTML (with embedded images) ---
             if file_extension in [".doc", ".docx"] and LIBREOFFICE_PATH:
-                with tempfile.TemporaryDirectory(prefix="lo_html_convert_") as tmp_dir_str:
-                    tmp_output_dir = Path(tmp_dir_str)
-                    try:
-                        # Call the updated function that returns HTML string
-                        html_content_with_embedded_images = convert_to_html_with_libreoffice(
-                            valid_src_path, 
-                            tmp_output_dir,
-                            embed_images=True # Ensure this is true
-                        )
-                        return HTMLResponse(content=html_content_with_embedded_images)
-                    except (RuntimeError, FileNotFoundError) as conversion_error:
-                        logger.error(f"HTML conversion failed for {valid_src_path.name}: {conversion_error}")
-                        return HTMLResponse(
-                            content=f"<html><body><h1>Preview Unavailable</h1><p>Could not generate a preview for {valid_src_path.name}. Error: {str(conversion_error)[:200]}...</p><p>You can try downloading the file directly.</p></body></html>",
-                            status_code=500
-                        )
-            
+                try:
+                    html_kind = "html" if images == "inline" else "html-linked"
+                    html_preview_path = await get_cached_preview(valid_src_path, html_kind, pin=True)
+                    return await conditional_file_response(
+                        request, html_preview_path, "text/html", content_disposition_type="inline",
+                        release=functools.partial(release_preview, html_preview_path),
+                    )
+                except (RuntimeError, FileNotFoundError) as conversion_error:
+                    logger.error(f"HTML conversion failed for {valid_src_path.name}: {conversion_error}")
+                    return HTMLResponse(
+                        content=f"<html><body><h1>Preview Unavailable</h1><p>Could not generate a preview for {valid_src_path.name}. Error: {str(conversion_error)[:200]}...</p><p>You can try downloading the file directly.</p></body></html>",
+                        status_code=500
+                    )
+
             # --- PPT/PPTX to PDF ---
             # *** NEW ***
             elif file_extension in [".ppt", ".pptx"] and LIBREOFFICE_PATH:
-                with tempfile.TemporaryDirectory(prefix="lo_pdf_convert_") as tmp_dir_str:
-                    tmp_output_dir = Path(tmp_dir_str)
-                    try:
-                        # LibreOffice command for PDF conversion
-                        cmd_pdf = [
-                            LIBREOFFICE_PATH, "--headless", "--nolockcheck", "--nodefault",
-                            "--norestore", "--invisible",
-                            "--convert-to", "pdf:writer_pdf_Export", # Specific PDF export filter
-                            "--outdir", str(tmp_output_dir), str(valid_src_path)
-                        ]
-                        process_pdf = subprocess.run(cmd_pdf, check=True, timeout=180, capture_output=True, text=True, errors='replace')
-                        if process_pdf.stderr:
-                            logger.info(f"LibreOffice PDF conversion STDERR for {valid_src_path.name}: {process_pdf.stderr[:1000]}")
-
-                        pdf_filename = valid_src_path.stem + ".pdf"
-                        converted_pdf_path = tmp_output_dir / pdf_filename
-                        expected_pdf=tmp_output_dir/(valid_src_path.stem+".pdf")
-                        
-                        if not converted_pdf_path.is_file():
-                            # Fallback: search for any .pdf file
-                            pdf_files = list(tmp_output_dir.glob("*.pdf"))
-                            if not pdf_files:
-                                raise FileNotFoundError("LibreOffice PDF conversion failed: No PDF file found.")
-                            converted_pdf_path = pdf_files[0]
-                            expected_pdf=pdf_files[0]
-                            logger.warning(f"Expected PDF file '{pdf_filename}' not found. Using first found: '{converted_pdf_path.name}'")
-                        
-
-                        pdf_bytes=expected_pdf.read_bytes()
-                        logger.info(f"Successfully converted '{valid_src_path.name}' to PDF: '{converted_pdf_path}'")
-                        # return FileResponse(
-                        #     path=converted_pdf_path,
-                        #     media_type="application/pdf",
-                        #     filename=valid_src_path.stem + ".pdf", # Suggest a filename for the browser
-                        #     content_disposition_type="inline" # Tell browser to display inline
-                        # )
+                try:
+                    pdf_preview_path = await get_cached_preview(valid_src_path, "pdf", pin=True)
+
+                   # HIGHLIGHTED CHANGE SECTION: PPT/PPTX Conversion Error Handling
+                except (FileNotFoundError, RuntimeError) as conversion_error:
+                    logger.error(f"PDF conversion failed for {valid_src_path.name}: {conversion_error}")
+
+                    # Instead of returning the original file, return an HTML error page
+                    # You can make this HTML more elaborate if needed
+                    error_html_content = f"""
+                    <html>
+                        <head><title>Preview Error</title></head>
+                        <body style="font-family: sans-serif; padding: 20px;">
+                            <h1>PDF Preview Unavailable</h1>
+                            <p>Could not generate a PDF preview for the file: <strong>{valid_src_path.name}</strong>.</p>
+                            <p>Reason: {str(conversion_error)[:250]}...</p>
+                            <p>You can try downloading the original file instead.</p>
+                            <!-- Optional: Add a direct link to download the original file -->
+                            <!-- This would require knowing the base URL or constructing it carefully -->
+                            <!-- <p><a href="/api/documents/{file_path}?action=download">Download Original File ({valid_src_path.name})</a></p> -->
+                            <p><button onclick="window.close()">Close Tab</button></p>
+                        </body>
+                    </html>
+                    """
+                    return HTMLResponse(content=error_html_content, status_code=500)
+
+                # Served with Range support so the PDF viewer can fetch just the pages it shows
+                return await conditional_file_response(
+                    request, pdf_preview_path, "application/pdf",
+                    filename=f"{valid_src_path.stem}.pdf", content_disposition_type="inline",
+                    release=functools.partial(release_preview, pdf_preview_path),
+                )
+                # END OF HIGHLIGHTED CHANGE SECTION
 
-                    
-                       # HIGHLIGHTED CHANGE SECTION: PPT/PPTX Conversion Error Handling
-                    except (subprocess.CalledProcessError, subprocess.TimeoutExpired, FileNotFoundError, RuntimeError) as conversion_error:
-                        logger.error(f"PDF conversion failed for {valid_src_path.name}: {conversion_error}")
-                        
-                        # Instead of returning the original file, return an HTML error page
-                        # You can make this HTML more elaborate if needed
-                        error_html_content = f"""
-                        <html>
-                            <head><title>Preview Error</title></head>
-                            <body style="font-family: sans-serif; padding: 20px;">
-                                <h1>PDF Preview Unavailable</h1>
-                                <p>Could not generate a PDF preview for the file: <strong>{valid_src_path.name}</strong>.</p>
-                                <p>Reason: {str(conversion_error)[:250]}...</p>
-                                <p>You can try downloading the original file instead.</p>
-                                <!-- Optional: Add a direct link to download the original file -->
-                                <!-- This would require knowing the base URL or constructing it carefully -->
-                                <!-- <p><a href="/api/documents/{file_path}?action=download">Download Original File ({valid_src_path.name})</a></p> -->
-                                <p><button onclick="window.close()">Close Tab</button></p>
-                            </body>
-                        </html>
-                        """
-                        return HTMLResponse(content=error_html_content, status_code=500)
-
-                    return StreamingResponse(
-                        content=io.BytesIO(pdf_bytes),
-                        media_type="application/pdf",
-                        headers={
-                            "Content-Disposition": f'inline; filename="{valid_src_path.stem}.pdf"'
-                        }
-                    )
-                    # END OF HIGHLIGHTED CHANGE SECTION
-            
             elif file_extension == ".html":
-                return FileResponse(path=valid_src_path, media_type="text/html", content_disposition_type="inline")
+                return await conditional_file_response(request, valid_src_path, "text/html", content_disposition_type="inline")
 
             elif mime_type and (mime_type.startswith("image/") or mime_type.startswith("text/") or mime_type == "application/pdf"):
-                return FileResponse(path=valid_src_path, media_type=mime_type, content_disposition_type="inline")
+                return await conditional_file_response(request, valid_src_path, mime_type, content_disposition_type="inline")
             
             else: # Other types
                 logger.info(f"Attempting inline view for '{valid_src_path.name}' (MIME: {mime_type}). Browser may download.")
-                return FileResponse(path=valid_src_path, media_type=mime_type, content_disposition_type="inline", filename=valid_src_path.name)
+                return await conditional_file_response(request, valid_src_path, mime_type, filename=valid_src_path.name, content_disposition_type="inline")
 
+    except ConversionPoolBusy as e:
+        logger.warning(f"Preview conversion rejected for '{valid_src_path.name}': {e}")
+        raise HTTPException(status_code=503, detail="Preview service is busy, please retry shortly.", headers={"Retry-After": "10"})
     except PermissionError:
         logger.error(f"Permission denied accessing file: {valid_src_path}")
         raise HTTPException(status_code=403, detail="Server does not have permission to access this file.")
@@ -390,10 +838,15 @@ async def get_document(
 
 
 
-@app.get("/download_all")
-async def download_all(parent_app_id: str = Query(..., description="Parent AppId to fetch documents for")):
-    MAX_ATTACHMENT_RESULTS = 1000
+# Default deflate level for bundle downloads (0-9); callers can override per request
+ZIP_COMPRESSION_LEVEL = int(os.getenv("ZIP_COMPRESSION_LEVEL", "6"))
 
+
+async def fetch_parent_bundle_candidates(parent_app_id: str) -> List[Tuple[str, Optional[str]]]:
+    """
+    Returns (SystemPath, FileExtension) for the main document `parent_app_id` and its attachments.
+    """
+    MAX_ATTACHMENT_RESULTS = 1000
     # Elasticsearch query: get attachments + main document
     query = {
         "query": {
@@ -404,103 +857,63 @@ async def download_all(parent_app_id: str = Query(..., description="Parent AppId
                 ]
             }
         },
-        "_source": ["SystemPath", "ProphecyId", "ParentProphecyId"],
+        "_source": ["SystemPath", "ProphecyId", "ParentProphecyId", "FileExtension"],
         "size": MAX_ATTACHMENT_RESULTS + 1
     }
 
-    try:
-        async with httpx.AsyncClient(timeout=15.0) as client:
-            url = f"{idx_url}/_search"
-            response = await client.post(url, json=query)
-
-            if response.status_code != 200:
-                raise HTTPException(
-                    status_code=500,
-                    detail=f"Elasticsearch error: {response.status_code} - {response.text}"
-                )
-
-        data = response.json()
-        hits = data.get("hits", {}).get("hits", [])
-        if not hits:
-            raise HTTPException(status_code=404, detail="No documents found for given parent_app_id")
-
-        # Extract file paths
-        file_paths = []
-        for hit in hits:
-            src = hit.get("_source", {})
-            if "SystemPath" in src:
-                file_paths.append(src["SystemPath"])
-
-        if not file_paths:
-            raise HTTPException(status_code=404, detail="No valid SystemPath found for given parent_app_id")
-
-        # Create in-memory ZIP
-        zip_buffer = io.BytesIO()
-        with zipfile.ZipFile(zip_buffer, "w", zipfile.ZIP_DEFLATED) as zipf:
-            for file_path in file_paths:
-                try:
-                    valid_src_path: Path = is_path_secure_and_valid(file_path, ALLOWED_DOCUMENT_ROOTS)
-                    if valid_src_path.exists():
-                        zipf.write(valid_src_path, arcname=valid_src_path.name)
-                except Exception as e:
-                    logger.error(f"Skipping file {file_path}: {e}")
-
-        zip_buffer.seek(0)
+    client = get_es_client()
+    url = f"{idx_url}/_search"
+    response = await client.post(url, json=query, timeout=15.0)
 
-        return StreamingResponse(
-            zip_buffer,
-            media_type="application/zip",
-            headers={"Content-Disposition": f'attachment; filename="{parent_app_id}_documents.zip"'}
+    if response.status_code != 200:
+        raise HTTPException(
+            status_code=500,
+            detail=f"Elasticsearch error: {response.status_code} - {response.text}"
         )
 
-    except Exception as e:
-        logger.error(f"Error in /download_all for parent_app_id={parent_app_id}: {e}")
-        raise HTTPException(status_code=500, detail="Server error during document download")
+    data = response.json()
+    hits = data.get("hits", {}).get("hits", [])
+    if not hits:
+        raise HTTPException(status_code=404, detail="No documents found for given parent_app_id")
 
+    # Extract file paths (with the indexed extension, used by the compression policy)
+    file_paths = []
+    for hit in hits:
+        src = hit.get("_source", {})
+        if "SystemPath" in src:
+            file_paths.append((src["SystemPath"], src.get("FileExtension")))
 
+    if not file_paths:
+        raise HTTPException(status_code=404, detail="No valid SystemPath found for given parent_app_id")
+    return file_paths
 
 
-@app.post("/download_multiple")
-async def download_multiple(prophecy_ids: str = Form(...)):
+async def fetch_id_bundle_candidates(list_of_ids: List[str]) -> List[Tuple[str, Optional[str]]]:
     """
-    Accepts a JSON string list of Prophecy IDs, retrieves their system paths from
-    Elasticsearch using httpx, packages the files into a ZIP archive, and streams it.
+    Returns (SystemPath, FileExtension) for the documents with the given Prophecy IDs.
     """
-    if not prophecy_ids:
-        raise HTTPException(status_code=400, detail="No Prophecy IDs provided.")
-
-    try:
-        # 1. Parse the incoming list of IDs from the form data
-        list_of_ids = json.loads(prophecy_ids)
-        if not isinstance(list_of_ids, list) or not list_of_ids:
-            raise HTTPException(status_code=400, detail="Invalid format: Prophecy IDs must be a non-empty array.")
-        logger.info(f"Received request to download {len(list_of_ids)} documents.")
-
-    except json.JSONDecodeError:
-        raise HTTPException(status_code=400, detail="Could not parse Prophecy IDs. Must be a valid JSON array.")
-
-    # 2. Build a single, efficient Elasticsearch query
+    # Build a single, efficient Elasticsearch query
     query = {
         "query": {
             "terms": {
                 "ProphecyId.keyword": list_of_ids
             }
         },
-        "_source": ["SystemPath"], # Also fetch FileName for clarity
+        "_source": ["SystemPath", "FileExtension"], # FileExtension drives the compression policy
         "size": len(list_of_ids) # Ensure we get all requested documents
     }
 
-    # 3. Execute the query using httpx
+    # Execute the query using httpx
     hits = []
     search_url = f"{ES_HOST}/{ES_INDEX}/_search"
     try:
-        async with httpx.AsyncClient(timeout=15.0) as client:
-            response = await client.post(search_url, json=query)
-            # Raise an exception for 4xx or 5xx status codes
-            response.raise_for_status()
-            
-            response_data = response.json()
-            hits = response_data.get('hits', {}).get('hits', [])
+        client = get_es_client()
+        response = await client.post(search_url, json=query, timeout=15.0)
+        # Raise an exception for 4xx or 5xx status codes
+        response.raise_for_status()
+        
+        response_data = response.json()
+        hits = response_data.get('hits', {}).get('hits', [])
 
     except httpx.HTTPStatusError as e:
         # Error response from Elasticsearch (e.g., 404 Not Found, 400 Bad Request)
@@ -517,8 +930,7 @@ async def download_multiple(prophecy_ids: str = Form(...)):
     if not hits:
         raise HTTPException(status_code=404, detail="None of the requested documents were found.")
 
-    # 4. Validate paths and collect a list of valid files to be zipped
-    valid_file_paths: List[Path] = []
+    candidates = []
     for hit in hits:
         source = hit.get('_source', {})
         system_path_str = source.get('SystemPath')
@@ -526,49 +938,155 @@ async def download_multiple(prophecy_ids: str = Form(...)):
         if not system_path_str:
             logger.warning(f"Document with ID {hit['_id']} is missing a SystemPath.")
             continue
+        candidates.append((system_path_str, source.get('FileExtension')))
+    return candidates
+
 
+def parse_prophecy_ids(prophecy_ids) -> List[str]:
+    """Accepts a JSON array string (form field) or an already decoded list of Prophecy IDs."""
+    if not prophecy_ids:
+        raise HTTPException(status_code=400, detail="No Prophecy IDs provided.")
+    if isinstance(prophecy_ids, str):
         try:
-            doc_path = Path(system_path_str).resolve()
+            prophecy_ids = json.loads(prophecy_ids)
+        except json.JSONDecodeError:
+            raise HTTPException(status_code=400, detail="Could not parse Prophecy IDs. Must be a valid JSON array.")
+    if not isinstance(prophecy_ids, list) or not prophecy_ids:
+        raise HTTPException(status_code=400, detail="Invalid format: Prophecy IDs must be a non-empty array.")
+    return prophecy_ids
 
-            # ★★★ SECURITY CHECK: Ensure the resolved path is inside the allowed directory ★★★
-            if not doc_path.is_relative_to(ALLOWED_DOWNLOAD_DIRECTORY):
-                logger.error(f"SECURITY ALERT: Attempt to access a forbidden path: {doc_path}")
-                continue # Silently skip this file
 
-            if doc_path.is_file():
-                valid_file_paths.append(doc_path)
-            else:
-                logger.warning(f"Path for file  does not exist or is not a file: {doc_path}")
+def check_compression_options(compression: str, compression_level: int) -> None:
+    if compression not in COMPRESSION_MODES:
+        raise HTTPException(status_code=400, detail=f"Invalid compression. Use one of {list(COMPRESSION_MODES)}.")
+    if not 0 <= compression_level <= 9:
+        raise HTTPException(status_code=400, detail="compression_level must be between 0 and 9.")
 
-        except Exception as e:
-            logger.error(f"Error processing path '{system_path_str}': {e}")
-            continue
 
-    if not valid_file_paths:
-         raise HTTPException(status_code=404, detail="Found document records, but none of the corresponding files could be accessed on the server.")
+@app.get("/download_all")
+async def download_all(
+    parent_app_id: str = Query(..., description="Parent AppId to fetch documents for"),
+    compression: str = Query("auto", enum=list(COMPRESSION_MODES), description="auto: store already-compressed files; store: no compression (fastest)"),
+    compression_level: int = Query(ZIP_COMPRESSION_LEVEL, ge=0, le=9),
+):
+    check_compression_options(compression, compression_level)
 
-    # 5. Create a ZIP archive in an in-memory buffer
-    zip_buffer = io.BytesIO()
-    with zipfile.ZipFile(zip_buffer, "a", zipfile.ZIP_DEFLATED, False) as zip_file:
-        for file_path in valid_file_paths:
-            # Use `arcname` to store the file with just its name, not the full server path
-            zip_file.write(file_path, arcname=file_path.name)
-    
-    # Reset the buffer's cursor to the beginning for reading
-    zip_buffer.seek(0)
+    try:
+        file_paths = await fetch_parent_bundle_candidates(parent_app_id)
+
+        # Validate up front so a bundle with nothing downloadable is still a clean 404
+        bundle_files = await validate_bundle_files(file_paths)
+
+        if not bundle_files:
+            raise HTTPException(status_code=404, detail="None of the files for given parent_app_id could be accessed on the server.")
+
+        # Stream the ZIP while it is being built: constant memory, first byte immediately
+        return StreamingResponse(
+            iter_zip_stream(
+                bundle_files, mode=compression, compresslevel=compression_level,
+                executor=bundle_io_executor, read_ahead=BUNDLE_READ_AHEAD
+            ),
+            media_type="application/zip",
+            headers={"Content-Disposition": f'attachment; filename="{parent_app_id}_documents.zip"'}
+        )
 
-    # 6. Stream the ZIP file as the final response
+    except HTTPException:
+        raise
+    except Exception as e:
+        logger.error(f"Error in /download_all for parent_app_id={parent_app_id}: {e}")
+        raise HTTPException(status_code=500, detail="Server error during document download")
+
+
+
+
+@app.post("/download_multiple")
+async def download_multiple(
+    prophecy_ids: str = Form(...),
+    compression: str = Form("auto"),
+    compression_level: int = Form(ZIP_COMPRESSION_LEVEL),
+):
+    """
+    Accepts a JSON string list of Prophecy IDs, retrieves their system paths from
+    Elasticsearch using httpx, packages the files into a ZIP archive, and streams it.
+    `compression` is one of auto / store / deflate (see zip_stream.choose_compression).
+    """
+    check_compression_options(compression, compression_level)
+    list_of_ids = parse_prophecy_ids(prophecy_ids)
+    logger.info(f"Received request to download {len(list_of_ids)} documents.")
+
+    candidates = await fetch_id_bundle_candidates(list_of_ids)
+
+    # ★★★ SECURITY CHECK: Ensure the resolved paths are inside the allowed directories ★★★
+    bundle_files = await validate_bundle_files(candidates)
+
+    if not bundle_files:
+         raise HTTPException(status_code=404, detail="Found document records, but none of the corresponding files could be accessed on the server.")
+
+    # Stream the ZIP archive as it is built, without buffering it in memory
     timestamp = datetime.now().strftime("%Y-%m-%d_%H%M")
     zip_filename = f"documents_{timestamp}.zip"
 
-    logger.info(f"Streaming {len(valid_file_paths)} files in '{zip_filename}'")
+    logger.info(f"Streaming {len(bundle_files)} files in '{zip_filename}'")
 
     return StreamingResponse(
-        zip_buffer,
+        iter_zip_stream(
+            bundle_files, mode=compression, compresslevel=compression_level,
+            executor=bundle_io_executor, read_ahead=BUNDLE_READ_AHEAD
+        ),
         media_type="application/zip",
         headers={"Content-Disposition": f'attachment; filename="{zip_filename}"'}
     )
 
+
+# --- Bundle jobs: build large bundles in the background, download them resumably ---
+@app.post("/bundles", status_code=202)
+async def create_bundle_job(payload: dict):
+    """
+    Starts building a ZIP bundle in the background. Payload: `parent_app_id` or
+    `prophecy_ids` (list), plus optional `compression` / `compression_level`.
+    Identical requests share one job. Poll GET /bundles/{job_id}, then fetch
+    GET /bundles/{job_id}/download (Range requests are supported).
+    """
+    parent_app_id = payload.get("parent_app_id")
+    compression = payload.get("compression", "auto")
+    compression_level = payload.get("compression_level", ZIP_COMPRESSION_LEVEL)
+    if not isinstance(compression_level, int):
+        raise HTTPException(status_code=400, detail="compression_level must be an integer.")
+    check_compression_options(compression, compression_level)
+
+    if parent_app_id:
+        candidates = await fetch_parent_bundle_candidates(str(parent_app_id))
+    else:
+        candidates = await fetch_id_bundle_candidates(parse_prophecy_ids(payload.get("prophecy_ids")))
+
+    bundle_files = await validate_bundle_files(candidates)
+    if not bundle_files:
+        raise HTTPException(status_code=404, detail="None of the requested files could be accessed on the server.")
+
+    job = await bundle_jobs.submit(bundle_files, compression, compression_level)
+    return job.to_dict(bundle_jobs.ttl)
+
+
+@app.get("/bundles/{job_id}")
+async def get_bundle_job(job_id: str):
+    job = await bundle_jobs.get(job_id)
+    if job is None:
+        raise HTTPException(status_code=404, detail="Unknown or expired bundle job.")
+    return job.to_dict(bundle_jobs.ttl)
+
+
+@app.get("/bundles/{job_id}/download")
+async def download_bundle_job(request: Request, job_id: str):
+    job = await bundle_jobs.get(job_id)
+    if job is None:
+        raise HTTPException(status_code=404, detail="Unknown or expired bundle job.")
+    if job.status == "failed":
+        raise HTTPException(status_code=500, detail=f"Bundle job failed: {job.error}")
+    if job.status != "done":
+        raise HTTPException(status_code=409, detail=f"Bundle is not ready yet (status: {job.status}).")
+    # Range / If-Range requests are answered with 206 / 416, so downloads can resume
+    return await conditional_file_response(request, job.artifact_path, "application/zip", filename=f"documents_{job_id[:12]}.zip")
+
 # Optional: A generic exception handler for cleaner error responses
 @app.exception_handler(Exception)
 async def generic_exception_handler(request: Request, exc: Exception):
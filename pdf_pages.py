@@ -0,0 +1,98 @@
+"""
+Per-page operations on PDF previews, using the poppler command line tools.
+
+Paged previews convert a document to PDF once and then serve single pages
+(as one-page PDFs or PNGs) and thumbnails on demand, so the time to the first
+page no longer depends on how long the document is. Like LibreOffice, the
+tools run as asyncio subprocesses; they are optional, and PagedPreviewUnavailable
+is raised when they are not installed.
+"""
+
+import asyncio
+import logging
+import os
+import re
+import shutil
+from pathlib import Path
+from typing import List, Optional
+
+
+logger = logging.getLogger(__name__)
+
+PDFINFO_PATH = os.getenv("PDFINFO_PATH", shutil.which("pdfinfo") or "")
+PDFSEPARATE_PATH = os.getenv("PDFSEPARATE_PATH", shutil.which("pdfseparate") or "")
+PDFTOPPM_PATH = os.getenv("PDFTOPPM_PATH", shutil.which("pdftoppm") or "")
+PAGE_TOOL_TIMEOUT = 60
+# Rasterising is CPU heavy; cap how many poppler processes run at once
+PAGE_RENDER_WORKERS = int(os.getenv("PAGE_RENDER_WORKERS", str(max(1, (os.cpu_count() or 2) // 2))))
+_render_slots: Optional[asyncio.Semaphore] = None
+
+
+class PagedPreviewUnavailable(RuntimeError):
+    """Raised when a poppler tool needed for paged previews is not installed."""
+
+
+async def _run(tool: str, args: List[str], timeout: float = PAGE_TOOL_TIMEOUT) -> str:
+    global _render_slots
+    if not tool:
+        raise PagedPreviewUnavailable("Paged previews need poppler-utils (pdfinfo, pdfseparate, pdftoppm).")
+    if _render_slots is None:
+        _render_slots = asyncio.Semaphore(PAGE_RENDER_WORKERS)
+    async with _render_slots:
+        process = await asyncio.create_subprocess_exec(
+            tool, *args, stdout=asyncio.subprocess.PIPE, stderr=asyncio.subprocess.PIPE
+        )
+        try:
+            stdout, stderr = await asyncio.wait_for(process.communicate(), timeout)
+        except (asyncio.TimeoutError, asyncio.CancelledError):
+            process.kill()
+            await process.wait()
+            raise
+    if process.returncode != 0:
+        raise RuntimeError(f"{Path(tool).name} failed (exit code {process.returncode}): {stderr.decode(errors='replace')[:500]}")
+    return stdout.decode(errors="replace")
+
+
+async def pdf_page_count(pdf_path: Path) -> int:
+    info = await _run(PDFINFO_PATH, [str(pdf_path)])
+    match = re.search(r"^Pages:\s+(\d+)", info, re.MULTILINE)
+    if not match:
+        raise RuntimeError(f"Could not read the page count of {pdf_path.name}")
+    return int(match.group(1))
+
+
+async def extract_page_pdf(pdf_path: Path, page: int, dest: Path) -> None:
+    """Writes page `page` (1-based) of `pdf_path` as a one-page PDF to `dest`."""
+    await _run(PDFSEPARATE_PATH, ["-f", str(page), "-l", str(page), str(pdf_path), str(dest)])
+
+
+async def _render_page(pdf_path: Path, page: int, dest: Path, options: List[str]) -> None:
+    prefix = dest.with_suffix("")
+    await _run(PDFTOPPM_PATH, ["-f", str(page), "-l", str(page), *options, "-png", "-singlefile", str(pdf_path), str(prefix)])
+    if prefix.with_suffix(".png") != dest:
+        os.replace(prefix.with_suffix(".png"), dest)
+
+
+async def render_page_png(pdf_path: Path, page: int, dest: Path, dpi: int) -> None:
+    """Rasterises page `page` (1-based) of `pdf_path` to the PNG file `dest`."""
+    await _render_page(pdf_path, page, dest, ["-r", str(dpi)])
+
+
+async def render_page_thumbnail(pdf_path: Path, page: int, dest: Path, size: int) -> None:
+    """Renders page `page` (1-based) of `pdf_path` as a PNG scaled to fit `size` pixels, like render_thumbnails."""
+    await _render_page(pdf_path, page, dest, ["-scale-to", str(size)])
+
+
+async def render_thumbnails(pdf_path: Path, out_dir: Path, size: int) -> int:
+    """
+    Renders every page of `pdf_path` into `out_dir` as <page>.png, scaled to fit
+    `size` pixels, in a single pdftoppm run. Returns the number of thumbnails.
+    """
+    await _run(PDFTOPPM_PATH, ["-png", "-scale-to", str(size), str(pdf_path), str(out_dir / "thumb")], timeout=PAGE_TOOL_TIMEOUT * 10)
+    count = 0
+    # pdftoppm zero-pads page numbers to the width of the page count (thumb-01.png ...)
+    for rendered in out_dir.glob("thumb-*.png"):
+        page = int(rendered.stem.rsplit("-", 1)[1])
+        os.replace(rendered, out_dir / f"{page}.png")
+        count += 1
+    return count
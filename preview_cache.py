@@ -0,0 +1,310 @@
+"""
+Content-addressed on-disk cache for converted document previews.
+
+Each entry is a directory named after a key derived from the source file's
+resolved path, mtime and size, so an edited file naturally gets a new entry.
+Entries are built in a staging directory and published with an atomic rename,
+concurrent requests for the same key share a single conversion, and the least
+recently used entries are evicted once the cache grows past its disk quota.
+Entries that are being served or read are pinned and never evicted; victims
+are first renamed into a trash directory, so a lookup never returns a
+directory that is half deleted.
+
+Several processes (uvicorn workers, the warm_previews CLI) may share one
+cache root. Pins are also shared flock()s on `.locks/<key>`, and eviction
+only takes entries it can lock exclusively. When over quota, the index is
+re-read from disk first, so the quota is enforced against what all processes
+wrote, with the entry mtimes (touched on every lookup) as last access.
+"""
+
+import asyncio
+import fcntl
+import hashlib
+import logging
+import os
+import shutil
+import tempfile
+import threading
+import time
+from pathlib import Path
+from typing import Awaitable, Callable, Dict, Optional, Set, Tuple
+
+
+logger = logging.getLogger(__name__)
+
+
+def _dir_size(path: Path) -> int:
+    total = 0
+    for dirpath, _dirnames, filenames in os.walk(path):
+        for name in filenames:
+            try:
+                total += os.path.getsize(os.path.join(dirpath, name))
+            except OSError:
+                pass
+    return total
+
+
+class PreviewCache:
+    """
+    Disk cache of preview directories with an LRU disk quota and single-flight creation.
+    """
+
+    def __init__(self, root: Path, quota_bytes: int):
+        self.root = root
+        self.quota_bytes = quota_bytes
+        self._staging = root / ".staging"
+        self._trash = root / ".trash"
+        self._locks = root / ".locks"
+        self._entries: Optional[Dict[str, Tuple[int, float]]] = None  # key -> (size, last access)
+        self._lock = threading.Lock()
+        self._inflight: Dict[str, asyncio.Task] = {}
+        self._waiters: Dict[str, int] = {}
+        self._pinned: Set[str] = set()  # builds somebody other than a detachable caller is waiting for
+        self._in_use: Dict[str, int] = {}  # key -> number of readers holding it, see pin()
+        self._lock_fds: Dict[str, int] = {}  # key -> fd holding the shared flock of a pinned key
+
+    @staticmethod
+    def make_key(source: Path, kind: str) -> str:
+        """Key for the `kind` preview ("html", "pdf", ...) of the file currently at `source`."""
+        st = source.stat()
+        material = f"{kind}|{source}|{st.st_mtime_ns}|{st.st_size}"
+        return hashlib.sha256(material.encode("utf-8")).hexdigest()
+
+    def entry_dir(self, key: str) -> Path:
+        return self.root / key[:2] / key
+
+    def _load_index(self) -> Dict[str, Tuple[int, float]]:
+        # Built lazily from what is already on disk so the quota survives restarts
+        if self._entries is None:
+            self.root.mkdir(parents=True, exist_ok=True)
+            self._entries = self._scan({})
+            self._clean_stale_staging()
+            self._clean_stale_locks()
+            shutil.rmtree(self._trash, ignore_errors=True)
+        return self._entries
+
+    def _clean_stale_locks(self) -> None:
+        # Lock files of entries that were never published (failed builds); nobody can be holding those
+        if not self._locks.is_dir():
+            return
+        for lock_path in self._locks.iterdir():
+            if lock_path.name in self._entries or lock_path.name in self._in_use:
+                continue
+            fd = self._lock_file(lock_path.name, exclusive=True)
+            if fd is not None:
+                try:
+                    os.unlink(lock_path)
+                except OSError:
+                    pass
+                os.close(fd)
+
+    def _scan(self, known: Dict[str, Tuple[int, float]]) -> Dict[str, Tuple[int, float]]:
+        # Sizes of `known` entries are reused (entries never change once published)
+        entries = {}
+        for shard in self.root.iterdir():
+            if not shard.is_dir() or shard in (self._staging, self._trash, self._locks):
+                continue
+            for entry in shard.iterdir():
+                try:
+                    if entry.is_dir():
+                        size = known[entry.name][0] if entry.name in known else _dir_size(entry)
+                        entries[entry.name] = (size, entry.stat().st_mtime)
+                except OSError:
+                    pass  # evicted by another process meanwhile
+        return entries
+
+    def _clean_stale_staging(self, max_age: float = 3600.0) -> None:
+        # Leftovers from a crash. Only old ones: other processes may be building right now.
+        if not self._staging.is_dir():
+            return
+        cutoff = time.time() - max_age
+        for leftover in self._staging.iterdir():
+            try:
+                if leftover.stat().st_mtime < cutoff:
+                    shutil.rmtree(leftover, ignore_errors=True)
+            except OSError:
+                pass
+
+    def _lock_file(self, key: str, exclusive: bool) -> Optional[int]:
+        """
+        Opens and flock()s `.locks/<key>`: shared (blocking; exclusive locks are
+        only held for a rename) or exclusive (non-blocking, None if anybody holds it).
+        """
+        self._locks.mkdir(parents=True, exist_ok=True)
+        path = self._locks / key
+        while True:
+            fd = os.open(path, os.O_RDWR | os.O_CREAT, 0o644)
+            try:
+                fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB if exclusive else fcntl.LOCK_SH)
+            except BlockingIOError:
+                os.close(fd)
+                return None
+            try:
+                current = os.fstat(fd).st_ino == os.stat(path).st_ino
+            except FileNotFoundError:
+                current = False
+            if current:
+                return fd
+            os.close(fd)  # an evicting process unlinked it after we opened it, retry on the new file
+
+    def _pin_locked(self, key: str) -> None:
+        count = self._in_use.get(key, 0)
+        if count == 0:
+            self._lock_fds[key] = self._lock_file(key, exclusive=False)
+        self._in_use[key] = count + 1
+
+    def _release_locked(self, key: str) -> None:
+        count = self._in_use.get(key, 0) - 1
+        if count > 0:
+            self._in_use[key] = count
+            return
+        self._in_use.pop(key, None)
+        fd = self._lock_fds.pop(key, None)
+        if fd is not None:
+            os.close(fd)  # drops the flock
+
+    def pin(self, key: str) -> None:
+        """Keeps `key` from being evicted, by any process sharing the root, until a matching release()."""
+        with self._lock:
+            self._pin_locked(key)
+
+    def release(self, entry: Path) -> None:
+        """Drops a pin taken by pin(), lookup(pin=True) or get_or_create(pin=True) on the entry directory."""
+        with self._lock:
+            self._release_locked(entry.name)
+
+    def lookup(self, key: str, pin: bool = False) -> Optional[Path]:
+        """
+        Returns the entry directory if it is cached, marking it as recently used.
+        With `pin` the entry is also pinned; the caller must release() it.
+        """
+        entry = self.entry_dir(key)
+        now = time.time()
+        # pinned before the check: evictions (of any process) only move unpinned entries away
+        with self._lock:
+            entries = self._load_index()
+            if pin:
+                self._pin_locked(key)
+            if not entry.is_dir():
+                if pin:
+                    self._release_locked(key)
+                return None
+            size = entries.get(key, (None, 0))[0]
+            entries[key] = (size if size is not None else _dir_size(entry), now)
+        try:
+            os.utime(entry, (now, now))
+        except OSError:
+            pass
+        return entry
+
+    async def get_or_create(
+        self, key: str, producer: Callable[[Path], Awaitable[None]], detachable: bool = False, pin: bool = False
+    ) -> Path:
+        """
+        Returns the entry directory for `key`, running `producer(staging_dir)` to
+        build it on a miss. Concurrent callers for the same key wait on the same
+        build; a caller going away does not cancel it for the others.
+
+        Builds that only `detachable` callers (e.g. speculative prefetches) ever
+        waited for are cancelled when the last of those callers is cancelled.
+        With `pin` the returned entry stays pinned until the caller release()s it.
+        """
+        if not pin:
+            return await self._get_or_create(key, producer, detachable)
+        self.pin(key)  # before the lookup, so the entry cannot be evicted in between
+        try:
+            return await self._get_or_create(key, producer, detachable)
+        except BaseException:
+            self.release(self.entry_dir(key))
+            raise
+
+    async def _get_or_create(self, key: str, producer: Callable[[Path], Awaitable[None]], detachable: bool) -> Path:
+        cached = await asyncio.to_thread(self.lookup, key)
+        if cached is not None:
+            return cached
+
+        task = self._inflight.get(key)
+        if task is None:
+            task = asyncio.ensure_future(self._create(key, producer))
+            self._inflight[key] = task
+            task.add_done_callback(lambda _t: self._inflight.pop(key, None))
+
+        if not detachable:
+            self._pinned.add(key)
+        self._waiters[key] = self._waiters.get(key, 0) + 1
+        try:
+            return await asyncio.shield(task)
+        except asyncio.CancelledError:
+            if self._waiters[key] == 1 and key not in self._pinned:
+                task.cancel()
+            raise
+        finally:
+            self._waiters[key] -= 1
+            if not self._waiters[key]:
+                del self._waiters[key]
+                self._pinned.discard(key)
+
+    async def _create(self, key: str, producer: Callable[[Path], Awaitable[None]]) -> Path:
+        await asyncio.to_thread(self._staging.mkdir, parents=True, exist_ok=True)
+        staging = Path(await asyncio.to_thread(tempfile.mkdtemp, prefix=f"{key[:12]}_", dir=self._staging))
+        try:
+            await producer(staging)
+            return await asyncio.to_thread(self._publish, key, staging)
+        finally:
+            await asyncio.to_thread(shutil.rmtree, staging, True)
+
+    def _publish(self, key: str, staging: Path) -> Path:
+        final = self.entry_dir(key)
+        final.parent.mkdir(parents=True, exist_ok=True)
+        size = _dir_size(staging)
+        try:
+            os.rename(staging, final)  # atomic on the same filesystem
+        except OSError:
+            if not final.is_dir():  # somebody else published it first otherwise
+                raise
+        with self._lock:
+            self._load_index()[key] = (size, time.time())
+        self._evict(keep=key)
+        logger.info(f"Preview cached: {key} ({size} bytes)")
+        return final
+
+    def _evict(self, keep: str) -> None:
+        with self._lock:
+            entries = self._load_index()
+            if sum(size for size, _ in entries.values()) <= self.quota_bytes:
+                return
+            # other processes may have added, used or evicted entries since we last looked
+            entries = self._entries = self._scan(entries)
+            total = sum(size for size, _ in entries.values())
+            victims = []
+            trashed = []
+            for key, (size, _atime) in sorted(entries.items(), key=lambda kv: kv[1][1]):
+                if total <= self.quota_bytes:
+                    break
+                if key == keep or key in self._in_use:
+                    continue
+                fd = self._lock_file(key, exclusive=True)
+                if fd is None:
+                    continue  # pinned by another process
+                # renames are cheap, so they happen under the locks; the slow deletes do not
+                try:
+                    if not trashed:
+                        self._trash.mkdir(parents=True, exist_ok=True)
+                    target = self._trash / f"{key}_{os.getpid()}_{time.monotonic_ns()}"
+                    os.rename(self.entry_dir(key), target)
+                    trashed.append(target)
+                except OSError:
+                    pass
+                finally:
+                    try:
+                        os.unlink(self._locks / key)
+                    except OSError:
+                        pass
+                    os.close(fd)
+                victims.append(key)
+                total -= size
+                del entries[key]
+        for target in trashed:
+            shutil.rmtree(target, ignore_errors=True)
+        if victims:
+            logger.info(f"Preview cache over quota, evicted {len(victims)} entries")
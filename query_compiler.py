@@ -0,0 +1,198 @@
+"""
+Compiles search parameters into an Elasticsearch bool query.
+
+Only the free-text queries can contribute to relevance; the facet filters
+(`terms` on keyword fields), the DocumentDate range and the parents-only term
+are yes/no conditions and always go into `bool.filter`, where ES skips scoring
+and caches the matching doc ids per segment as bitsets. When the results are
+not sorted by `_score` the text clauses become filters too, so no scores are
+computed at all.
+
+Parameters are normalised first (see search_cache.normalize_search_params):
+duplicate queries and filter values are dropped and everything is emitted in
+a fixed order, so equivalent requests compile to byte-identical queries and
+reuse the same cache entries in ES.
+
+The text part is planned to keep the clause count flat for long term lists:
+with search_type "any" all exact name / id lookups share one `terms` query per
+keyword field and all Text phrases one `simple_query_string`. Lists of
+thousands of identifiers go through a stored bulk list and a terms lookup
+instead (see BULK_LIST_INDEX).
+"""
+
+import hashlib
+import json
+import os
+import re
+from datetime import datetime, time, timedelta, timezone
+from typing import Any, Dict, List, Optional
+
+from search_cache import normalize_search_params
+
+
+SEARCH_TYPES = ("any", "all")
+TEXT_FIELD = "Text"
+KEYWORD_SEARCH_FIELDS = ["OriginalName.keyword", "ProphecyId.keyword", "ParentProphecyId.keyword"]
+DATE_FIELD = "DocumentDate"
+PARENTS_ONLY_CLAUSE = {"term": {"IsAttachment.keyword": "False"}}
+# simple_query_string syntax is limited to "quoted phrases" separated by whitespace,
+# so nothing in a user's query is interpreted as an operator
+PHRASE_QUERY_FLAGS = "PHRASE|WHITESPACE"
+
+# Bulk lists: identifier lists (IMEIs, phone numbers, e-mail addresses ...) too
+# long to send as queries are stored once as a document in BULK_LIST_INDEX and
+# matched with a terms lookup against BULK_LIST_FIELDS, in a single clause.
+BULK_LIST_INDEX = os.getenv("BULK_LIST_INDEX", "search_lists")
+BULK_LIST_FIELDS = [
+    f.strip() for f in os.getenv(
+        "BULK_LIST_FIELDS", "Imei.keyword,Imsi.keyword,EmailIds.keyword,PhoneNumbers.keyword"
+    ).split(",") if f.strip()
+]
+BULK_LIST_TERMS_PATH = "terms"
+
+
+def sort_uses_score(sort: Optional[List[Any]]) -> bool:
+    """True when `sort` (an ES sort list) orders by relevance anywhere."""
+    if not sort:
+        return True  # ES sorts by _score by default
+    for entry in sort:
+        field = entry if isinstance(entry, str) else next(iter(entry), None)
+        if field == "_score":
+            return True
+    return False
+
+
+def day_start_epoch(date_str: str) -> int:
+    """Epoch seconds of 00:00 UTC on the YYYY-MM-DD day `date_str`."""
+    day = datetime.strptime(date_str, "%Y-%m-%d").date()
+    return int(datetime.combine(day, time.min, tzinfo=timezone.utc).timestamp())
+
+
+def date_range_clause(date_range: Dict[str, str]) -> Optional[Dict[str, Any]]:
+    """Range on DocumentDate covering whole days: from 00:00 of `from` up to the end of `to`."""
+    bounds = {}
+    if date_range.get("from"):
+        bounds["gte"] = day_start_epoch(date_range["from"])
+    if date_range.get("to"):
+        next_day = datetime.strptime(date_range["to"], "%Y-%m-%d").date() + timedelta(days=1)
+        bounds["lt"] = day_start_epoch(next_day.isoformat())
+    return {"range": {DATE_FIELD: bounds}} if bounds else None
+
+
+def keyword_lookup_clauses(terms: List[str]) -> List[Dict[str, Any]]:
+    """One `terms` query per keyword field, covering every term at once."""
+    return [{"terms": {field: terms}} for field in KEYWORD_SEARCH_FIELDS]
+
+
+def phrases_clause(queries: List[str]) -> Optional[Dict[str, Any]]:
+    """
+    One clause matching any of `queries` as a phrase in Text. Quotes and
+    backslashes cannot be expressed inside a quoted phrase; they are replaced by
+    spaces, which is how the text analyzer treats them anyway.
+    """
+    phrases = [" ".join(re.sub(r'["\\]', " ", q).split()) for q in queries]
+    query_string = " ".join(f'"{phrase}"' for phrase in phrases if phrase)
+    if not query_string:
+        return None
+    return {"simple_query_string": {
+        "query": query_string, "fields": [TEXT_FIELD],
+        "default_operator": "or", "flags": PHRASE_QUERY_FLAGS,
+    }}
+
+
+def term_clause(query: str) -> Dict[str, Any]:
+    """
+    A single query string that must match on its own ("all" searches): a phrase
+    in the document text or an exact name / id.
+    """
+    # on the keyword fields the phrase is a single token, i.e. an exact term match
+    return {"multi_match": {"query": query, "type": "phrase", "fields": [TEXT_FIELD] + KEYWORD_SEARCH_FIELDS}}
+
+
+def plan_text_clauses(queries: List[str], search_type: str) -> List[Dict[str, Any]]:
+    """
+    Returns the clauses for the free-text part of a search; with "all" each of
+    them must match, with "any" at least one.
+
+    Every query is searched as a phrase in Text and looked up in the keyword
+    fields. For "any" searches the keyword lookups of all queries share one
+    `terms` query per field and the phrases one grouped clause, so a pasted
+    list of hundreds of ids costs four clauses instead of four per id.
+    """
+    if not queries:
+        return []
+    if search_type == "all":
+        return [term_clause(q) for q in queries]
+    clauses = keyword_lookup_clauses(queries)
+    text_clause = phrases_clause(queries)
+    if text_clause:
+        clauses.append(text_clause)
+    return clauses
+
+
+def normalize_list_terms(terms: List[Any]) -> List[str]:
+    """Canonical form of a bulk list: stripped, de-duplicated, sorted strings."""
+    return sorted({str(t).strip() for t in terms if str(t).strip()})
+
+
+def bulk_list_id(terms: List[str]) -> str:
+    """Content-addressed id of a normalised list, so storing a list twice is a no-op."""
+    return hashlib.sha256(json.dumps(terms, separators=(",", ":")).encode("utf-8")).hexdigest()[:32]
+
+
+def bulk_list_clause(list_id: str) -> Dict[str, Any]:
+    """Matches documents with any value of the stored list in any of BULK_LIST_FIELDS."""
+    lookup = {"index": BULK_LIST_INDEX, "id": list_id, "path": BULK_LIST_TERMS_PATH}
+    lookups = [{"terms": {field: lookup}} for field in BULK_LIST_FIELDS]
+    if len(lookups) == 1:
+        return lookups[0]
+    return {"bool": {"should": lookups, "minimum_should_match": 1}}
+
+
+def compile_query(
+    queries: Optional[List[str]],
+    search_type: str = "any",
+    filters: Optional[Dict[str, List[str]]] = None,
+    date_range: Optional[Dict[str, str]] = None,
+    parents_only: bool = False,
+    scoring: bool = True,
+    list_id: Optional[str] = None,
+) -> Dict[str, Any]:
+    """
+    Returns the query clause for the given search parameters. With
+    scoring=False (results sorted by something other than _score) every clause
+    is a filter; `list_id` restricts the results to a stored bulk list.
+    Raises ValueError for an unknown search_type.
+    """
+    normalized = normalize_search_params(queries, search_type, filters, date_range, parents_only, list_id)
+    if normalized["queries"] and search_type not in SEARCH_TYPES:
+        raise ValueError("Invalid search_type. Use 'any' or 'all'.")
+
+    filter_clauses = [{"terms": {field: values}} for field, values in normalized["filters"].items()]
+    range_clause = date_range_clause(normalized["date_range"])
+    if range_clause:
+        filter_clauses.append(range_clause)
+    if normalized["parents_only"]:
+        filter_clauses.append(PARENTS_ONLY_CLAUSE)
+    if normalized.get("list_id"):
+        filter_clauses.append(bulk_list_clause(normalized["list_id"]))
+
+    bool_query: Dict[str, Any] = {}
+    text_clauses = plan_text_clauses(normalized["queries"], search_type)
+    if text_clauses and search_type == "all":
+        if scoring:
+            bool_query["must"] = text_clauses
+        else:
+            filter_clauses = text_clauses + filter_clauses
+    elif text_clauses:
+        any_of = {"should": text_clauses, "minimum_should_match": 1}
+        if scoring:
+            bool_query.update(any_of)
+        else:
+            filter_clauses.insert(0, {"bool": any_of})
+
+    if filter_clauses:
+        bool_query["filter"] = filter_clauses
+    if not bool_query:
+        return {"match_all": {}}
+    return {"bool": bool_query}
@@ -12,8 +12,10 @@ import json
 from datetime import datetime,timezone,time,timedelta
 import re
 
+from es_client import es_lifespan, get_es_client
 
-app = FastAPI()
+
+app = FastAPI(lifespan=es_lifespan)
 
 
 
@@ -140,15 +142,15 @@ async def handle_attachment_link(payload: Dict[str, Any] = Body(...)):
         
 
     try:
-        async with httpx.AsyncClient(timeout=10.0) as client:
-            url = f"{idx_url}/_search"
-            response = await client.post(url, json=query)
-
-            if response.status_code != 200:
-                raise HTTPException(
-                    status_code=500,
-                    detail=f"Elasticsearch error: {response.status_code} - {response.text}"
-                )
+        client = get_es_client()
+        url = f"{idx_url}/_search"
+        response = await client.post(url, json=query)
+
+        if response.status_code != 200:
+            raise HTTPException(
+                status_code=500,
+                detail=f"Elasticsearch error: {response.status_code} - {response.text}"
+            )
 
         data = response.json()
         raw_hits = data.get("hits", {}).get("hits", [])
@@ -331,18 +333,18 @@ async def search_elasticsearch(
     
 
     try:
-        async with httpx.AsyncClient(timeout=10.0) as client:
-            print("before sending to es")
-            url = f"{idx_url}/_search"
-            print("after sending to es")
-            response = await client.post(url, json=search_body)
-
-            if response.status_code != 200:
-                logger.error(f"Elasticsearch error: {response.status_code} - {response.text}")
-                raise HTTPException(
-                    status_code=500,
-                    detail=f"Elasticsearch responded with status code {response.status_code}: {response.text}"
-                )
+        client = get_es_client()
+        print("before sending to es")
+        url = f"{idx_url}/_search"
+        print("after sending to es")
+        response = await client.post(url, json=search_body)
+
+        if response.status_code != 200:
+            logger.error(f"Elasticsearch error: {response.status_code} - {response.text}")
+            raise HTTPException(
+                status_code=500,
+                detail=f"Elasticsearch responded with status code {response.status_code}: {response.text}"
+            )
 
         data = response.json()
         raw_hits = data.get("hits", {}).get("hits", [])
@@ -14,8 +14,10 @@ import json
 from datetime import datetime,timezone,time,timedelta
 import re
 
+from es_client import es_lifespan, get_es_client
 
-app = FastAPI()
+
+app = FastAPI(lifespan=es_lifespan)
 
 
 
@@ -143,15 +145,15 @@ async def handle_attachment_link(payload: Dict[str, Any] = Body(...)):
         
 
     try:
-        async with httpx.AsyncClient(timeout=10.0) as client:
-            url = f"{idx_url}/_search"
-            response = await client.post(url, json=query)
-
-            if response.status_code != 200:
-                raise HTTPException(
-                    status_code=500,
-                    detail=f"Elasticsearch error: {response.status_code} - {response.text}"
-                )
+        client = get_es_client()
+        url = f"{idx_url}/_search"
+        response = await client.post(url, json=query)
+
+        if response.status_code != 200:
+            raise HTTPException(
+                status_code=500,
+                detail=f"Elasticsearch error: {response.status_code} - {response.text}"
+            )
 
         data = response.json()
         raw_hits = data.get("hits", {}).get("hits", [])
@@ -336,41 +338,41 @@ async def search_elasticsearch(
     
 
     try:
-        async with httpx.AsyncClient(timeout=10.0) as client:
-            print("before sending to es")
-            url = f"{idx_url}/_search"
-            print("after sending to es")
-            response = await client.post(url, json=search_body)
+        client = get_es_client()
+        print("before sending to es")
+        url = f"{idx_url}/_search"
+        print("after sending to es")
+        response = await client.post(url, json=search_body)
 
 
-            # new
-            highlight_disabled=False  
+        # new
+        highlight_disabled=False  
 
-            print(f"the status code is {response.status_code}")
-            if response.status_code == 400:
-                print("hello")
-                logger.warning("Elasticsearch highlight limit reached")
-                highlight_disabled=True
+        print(f"the status code is {response.status_code}")
+        if response.status_code == 400:
+            print("hello")
+            logger.warning("Elasticsearch highlight limit reached")
+            highlight_disabled=True
 
 
-                # remove highlight and retry
-                search_body.pop("highlight",None)
-                response = await client.post(url, json=search_body)
+            # remove highlight and retry
+            search_body.pop("highlight",None)
+            response = await client.post(url, json=search_body)
 
-                if response.status_code !=200:
+            if response.status_code !=200:
 
-                    print("error")
-                    logger.error(f"Elasticsearch error: {response.status_code} - {response.text}")
-                    print("error")
+                print("error")
+                logger.error(f"Elasticsearch error: {response.status_code} - {response.text}")
+                print("error")
 
 
 
-            if response.status_code != 200:
-                logger.error(f"Elasticsearch error: {response.status_code} - {response.text}")
-                raise HTTPException(
-                    status_code=500,
-                    detail=f"Elasticsearch responded with status code {response.status_code}: {response.text}"
-                )
+        if response.status_code != 200:
+            logger.error(f"Elasticsearch error: {response.status_code} - {response.text}")
+            raise HTTPException(
+                status_code=500,
+                detail=f"Elasticsearch responded with status code {response.status_code}: {response.text}"
+            )
 
         data = response.json()
         raw_hits = data.get("hits", {}).get("hits", [])
@@ -0,0 +1,124 @@
+"""
+Query fingerprints and a small in-process TTL/LRU cache for search results.
+
+A fingerprint is a stable hash of the normalised search parameters, so two
+requests that differ only in query order, duplicate terms or filter value
+order map to the same cache entry.
+"""
+
+import hashlib
+import json
+import threading
+import time
+from collections import OrderedDict
+from typing import Any, Dict, Hashable, List, Optional
+
+
+def normalize_search_params(
+    queries: Optional[List[str]],
+    search_type: str = "any",
+    filters: Optional[Dict[str, List[str]]] = None,
+    date_range: Optional[Dict[str, str]] = None,
+    parents_only: bool = False,
+    list_id: Optional[str] = None,
+) -> Dict[str, Any]:
+    """
+    Returns the canonical form of the parameters that decide *which* documents match.
+    """
+    norm_queries = sorted({q.strip() for q in (queries or []) if isinstance(q, str) and q.strip()})
+
+    norm_filters = {}
+    for field, values in (filters or {}).items():
+        if not values:
+            continue
+        keyword_field = field if field.endswith(".keyword") else f"{field}.keyword"
+        norm_filters[keyword_field] = sorted({str(v) for v in values})
+
+    norm_dates = {k: v for k, v in (date_range or {}).items() if k in ("from", "to") and v}
+
+    normalized = {
+        "queries": norm_queries,
+        "search_type": search_type,
+        "filters": dict(sorted(norm_filters.items())),
+        "date_range": norm_dates,
+        "parents_only": bool(parents_only),
+    }
+    if list_id:  # only when set, so fingerprints of list-less searches are unchanged
+        normalized["list_id"] = list_id
+    return normalized
+
+
+def query_fingerprint(normalized: Dict[str, Any], **extra: Any) -> str:
+    """
+    Hashes normalised search parameters (plus any `extra` keys such as size or
+    paging position) into a short hex digest.
+    """
+    payload = dict(normalized, **extra)
+    canonical = json.dumps(payload, sort_keys=True, separators=(",", ":"), default=str)
+    return hashlib.sha256(canonical.encode("utf-8")).hexdigest()[:32]
+
+
+class TTLCache:
+    """
+    Size-bounded LRU cache whose entries also expire `ttl` seconds after insertion.
+    Keeps hit/miss/eviction counters for the stats endpoint. Cached values are
+    shared between callers and must be treated as read-only.
+    """
+
+    def __init__(self, maxsize: int = 1024, ttl: float = 300.0):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self._data: "OrderedDict[Hashable, tuple]" = OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.expirations = 0
+
+    def get(self, key: Hashable) -> Optional[Any]:
+        with self._lock:
+            item = self._data.get(key)
+            if item is None:
+                self.misses += 1
+                return None
+            expires_at, value = item
+            if expires_at < time.monotonic():
+                del self._data[key]
+                self.expirations += 1
+                self.misses += 1
+                return None
+            self._data.move_to_end(key)
+            self.hits += 1
+            return value
+
+    def set(self, key: Hashable, value: Any) -> None:
+        with self._lock:
+            self._data[key] = (time.monotonic() + self.ttl, value)
+            self._data.move_to_end(key)
+            while len(self._data) > self.maxsize:
+                self._data.popitem(last=False)
+                self.evictions += 1
+
+    def pop(self, key: Hashable) -> None:
+        with self._lock:
+            self._data.pop(key, None)
+
+    def clear(self) -> None:
+        with self._lock:
+            self._data.clear()
+
+    def stats(self) -> Dict[str, Any]:
+        lookups = self.hits + self.misses
+        return {
+            "size": len(self._data),
+            "maxsize": self.maxsize,
+            "ttl": self.ttl,
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_ratio": round(self.hits / lookups, 4) if lookups else 0.0,
+            "evictions": self.evictions,
+            "expirations": self.expirations,
+        }
+
+    def __len__(self) -> int:
+        return len(self._data)
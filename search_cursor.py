@@ -0,0 +1,66 @@
+"""
+Opaque, signed pagination cursors.
+
+A cursor carries everything needed to fetch the next page with search_after
+(the sort values of the last hit, the page number, the page size, an optional
+point-in-time id) plus the fingerprint of the query it belongs to. It is
+base64 JSON with an HMAC, so clients cannot forge sort values or replay a
+cursor against a different query.
+
+Set SEARCH_CURSOR_SECRET so cursors stay valid across restarts and workers;
+without it a random per-process secret is used.
+"""
+
+import base64
+import hashlib
+import hmac
+import json
+import logging
+import os
+import secrets
+from typing import Any, Dict
+
+
+logger = logging.getLogger(__name__)
+
+_secret = os.getenv("SEARCH_CURSOR_SECRET")
+if not _secret:
+    logger.warning("SEARCH_CURSOR_SECRET is not set; pagination cursors will not survive a restart.")
+    _secret = secrets.token_hex(32)
+SEARCH_CURSOR_SECRET = _secret.encode("utf-8")
+
+
+class InvalidCursor(ValueError):
+    """Raised for cursors that are malformed or whose signature does not match."""
+
+
+def _b64encode(data: bytes) -> str:
+    return base64.urlsafe_b64encode(data).decode("ascii").rstrip("=")
+
+
+def _b64decode(text: str) -> bytes:
+    return base64.urlsafe_b64decode(text + "=" * (-len(text) % 4))
+
+
+def _sign(body: str) -> str:
+    return _b64encode(hmac.new(SEARCH_CURSOR_SECRET, body.encode("utf-8"), hashlib.sha256).digest()[:16])
+
+
+def encode_cursor(state: Dict[str, Any]) -> str:
+    body = _b64encode(json.dumps(state, separators=(",", ":"), default=str).encode("utf-8"))
+    return f"{body}.{_sign(body)}"
+
+
+def decode_cursor(cursor: str) -> Dict[str, Any]:
+    if not isinstance(cursor, str) or "." not in cursor:
+        raise InvalidCursor("Malformed cursor.")
+    body, _, signature = cursor.rpartition(".")
+    if not hmac.compare_digest(signature.encode("utf-8"), _sign(body).encode("utf-8")):
+        raise InvalidCursor("Cursor signature does not match.")
+    try:
+        state = json.loads(_b64decode(body))
+    except (ValueError, UnicodeDecodeError):
+        raise InvalidCursor("Malformed cursor.")
+    if not isinstance(state, dict):
+        raise InvalidCursor("Malformed cursor.")
+    return state
@@ -6,6 +6,8 @@ from fastapi.middleware.cors import CORSMiddleware
 from fastapi.responses import JSONResponse
 from typing import List, Optional, AsyncGenerator,Dict, Any,Tuple
 from starlette.responses import StreamingResponse
+from starlette.background import BackgroundTask
+import asyncio
 import httpx
 import logging
 import os
@@ -13,9 +15,38 @@ from dotenv import load_dotenv
 import json 
 from datetime import datetime,timezone,time,timedelta
 import re
+from time import monotonic
+from contextlib import asynccontextmanager
+
+from es_client import es_lifespan, get_es_client
+from search_cache import TTLCache, normalize_search_params, query_fingerprint
+from search_cursor import InvalidCursor, decode_cursor, encode_cursor
+from query_compiler import (
+    BULK_LIST_FIELDS, BULK_LIST_INDEX, BULK_LIST_TERMS_PATH, bulk_list_id, compile_query,
+    normalize_list_terms, sort_uses_score,
+)
+
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    global _prefetch_client
+    async with es_lifespan(app):
+        cleanup_task = asyncio.create_task(bulk_list_cleanup_loop())
+        if PREVIEW_PREFETCH_URL:
+            _prefetch_client = httpx.AsyncClient(
+                limits=httpx.Limits(max_connections=PREVIEW_PREFETCH_MAX_CONNECTIONS), timeout=PREVIEW_PREFETCH_TIMEOUT
+            )
+        try:
+            yield
+        finally:
+            cleanup_task.cancel()
+            await asyncio.gather(cleanup_task, return_exceptions=True)
+            if _prefetch_client is not None:
+                await _prefetch_client.aclose()
+                _prefetch_client = None
 
 
-app = FastAPI()
+app = FastAPI(lifespan=lifespan)
 
 
 
@@ -56,6 +87,289 @@ ES_INDEX = "new_index"
 
 idx_url="http://localhost:9200/new_index"
 
+
+# Bulk export (stream=true) settings. Export pages through a point-in-time
+# with search_after and only ever fetches the fields listed here.
+EXPORT_BATCH_SIZE = int(os.getenv("EXPORT_BATCH_SIZE", "1000"))
+EXPORT_PIT_KEEP_ALIVE = os.getenv("EXPORT_PIT_KEEP_ALIVE", "2m")
+EXPORT_SOURCE_FIELDS = [
+    "ProphecyId", "ParentProphecyId", "OriginalName", "FileName", "FileExtension",
+    "DocType", "Branch", "DocumentDate", "IsAttachment", "SystemPath",
+    "CaseId", "CaseName", "Subject", "From", "To",
+]
+
+
+# _source projection per result view. None means "every field except Text".
+# The full Text body is never fetched for result pages; the short preview comes
+# from TEXT_PREVIEW_FIELD (a stored prefix of Text, if the mapping has one) or
+# from a script field that cuts the prefix on the ES side.
+VIEW_SOURCE_FIELDS: Dict[str, Optional[List[str]]] = {
+    "grid": None,
+    "card": [
+        "ProphecyId", "ParentProphecyId", "OriginalName", "FileName", "FileExtension",
+        "DocType", "DocumentDate", "IsAttachment", "Attachments", "SystemPath",
+        "ReportNumber", "From", "To",
+    ],
+    "table": [
+        "ProphecyId", "ParentProphecyId", "OriginalName", "FileName", "FileExtension",
+        "DocType", "Branch", "DocumentDate", "IngestionDate", "IsAttachment", "Attachments",
+        "SystemPath", "CaseId", "CaseName", "Subject", "Author", "From", "To",
+        "EmailFrom", "EmailTo", "FileSize", "ReportNumber",
+    ],
+}
+TEXT_PREVIEW_FIELD = os.getenv("ES_TEXT_PREVIEW_FIELD")  # e.g. "TextPreview"
+TEXT_PREVIEW_CHARS = 100
+
+
+# Highlighting. The highlight request is sized to the page and capped with
+# max_analyzed_offset, so very large documents are highlighted from their first
+# HIGHLIGHT_MAX_ANALYZED_OFFSET characters instead of failing the whole search.
+# If the Text mapping stores offsets (index_options: offsets) or term vectors
+# (term_vector: with_positions_offsets), the highlighter uses them instead of
+# re-analysing the text; ES_TEXT_OFFSETS overrides the mapping detection.
+HIGHLIGHT_MAX_ANALYZED_OFFSET = int(os.getenv("HIGHLIGHT_MAX_ANALYZED_OFFSET", "1000000"))
+HIGHLIGHT_BACKOFF = float(os.getenv("HIGHLIGHT_BACKOFF", "300"))
+# (largest page size, fragment_size); one fragment per hit, the only one shown
+HIGHLIGHT_TIERS = [(20, 250), (100, 200), (None, 150)]
+highlight_state: Dict[str, Any] = {
+    "offsets": os.getenv("ES_TEXT_OFFSETS"),  # "postings", "term_vectors" or "none"
+    "disabled_until": 0.0,
+    "requests": 0,
+    "degraded": 0,
+    "rejected": 0,
+}
+
+
+async def detect_text_offsets() -> str:
+    """How the Text field can be highlighted without re-analysis, read once from the mapping."""
+    if highlight_state["offsets"]:
+        return highlight_state["offsets"]
+    try:
+        client = get_es_client()
+        response = await client.get(f"{idx_url}/_mapping/field/Text")
+        response.raise_for_status()
+    except httpx.HTTPError as e:
+        logger.warning(f"Could not read the Text mapping, highlighting without offsets: {e}")
+        return "none"
+    offsets = "none"
+    for index_mapping in response.json().values():
+        text_mapping = index_mapping.get("mappings", {}).get("Text", {}).get("mapping", {}).get("Text", {})
+        if text_mapping.get("term_vector", "").startswith("with_positions_offsets"):
+            offsets = "term_vectors"
+        elif text_mapping.get("index_options") == "offsets":
+            offsets = "postings"
+    highlight_state["offsets"] = offsets
+    logger.info(f"Text highlighting uses offsets from: {offsets}")
+    return offsets
+
+
+async def build_highlight(size: int) -> Optional[Dict[str, Any]]:
+    """
+    Highlight section for a page of `size` hits, or None while highlighting is
+    backed off after ES rejected it.
+    """
+    if monotonic() < highlight_state["disabled_until"]:
+        return None
+    offsets = await detect_text_offsets()
+    fragment_size = next(f for limit, f in HIGHLIGHT_TIERS if limit is None or size <= limit)
+    text_field: Dict[str, Any] = {
+        "fragment_size": fragment_size,
+        "number_of_fragments": 1,
+        "no_match_size": 0,
+        "boundary_scanner": "sentence",
+    }
+    highlight: Dict[str, Any] = {
+        "type": "fvh" if offsets == "term_vectors" else "unified",
+        "fields": {"Text": text_field},
+        "pre_tags": ["<mark>"],
+        "post_tags": ["</mark>"],
+    }
+    if offsets == "none":
+        highlight["max_analyzed_offset"] = HIGHLIGHT_MAX_ANALYZED_OFFSET
+    return highlight
+
+
+def is_highlight_error(status: int, text: str) -> bool:
+    return status == 400 and ("highlight" in text or "max_analyzed_offset" in text)
+
+
+def is_highlight_rejection(response: httpx.Response) -> bool:
+    return is_highlight_error(response.status_code, response.text)
+
+
+def build_source_projection(view: Optional[str]) -> Dict[str, Any]:
+    """
+    Returns the `_source` / `script_fields` part of a search body for a result view.
+    """
+    fields = VIEW_SOURCE_FIELDS.get(view or "grid")
+    projection: Dict[str, Any] = {}
+    if fields is None:
+        projection["_source"] = {"excludes": ["Text"]}
+    else:
+        projection["_source"] = list(fields) + ([TEXT_PREVIEW_FIELD] if TEXT_PREVIEW_FIELD else [])
+
+    if not TEXT_PREVIEW_FIELD:
+        projection["script_fields"] = {
+            "text_preview": {
+                "script": {
+                    "lang": "painless",
+                    "source": (
+                        "def t = params['_source']['Text'];"
+                        "if (t == null) { return ''; }"
+                        "return t.length() > params.n ? t.substring(0, params.n) : t;"
+                    ),
+                    "params": {"n": TEXT_PREVIEW_CHARS}
+                }
+            }
+        }
+    return projection
+
+
+# Opt-in preview pre-warming. When PREVIEW_PREFETCH_URL points at the document
+# service's /api/previews/prefetch, every served result page sends it the top
+# hits that need a LibreOffice conversion, so "view" clicks find a warm cache.
+PREVIEW_PREFETCH_URL = os.getenv("PREVIEW_PREFETCH_URL")
+PREVIEW_PREFETCH_TOP_N = int(os.getenv("PREVIEW_PREFETCH_TOP_N", "3"))
+PREVIEW_PREFETCH_EXTENSIONS = {"doc", "docx", "ppt", "pptx"}
+# Prefetch has its own small client (created in the lifespan) so slow prefetch
+# calls never hold connections of the Elasticsearch pool
+PREVIEW_PREFETCH_MAX_CONNECTIONS = int(os.getenv("PREVIEW_PREFETCH_MAX_CONNECTIONS", "4"))
+PREVIEW_PREFETCH_TIMEOUT = float(os.getenv("PREVIEW_PREFETCH_TIMEOUT", "2"))
+
+_prefetch_client: Optional[httpx.AsyncClient] = None
+
+
+def select_prefetch_paths(documents: List[Dict[str, Any]], top_n: int = PREVIEW_PREFETCH_TOP_N) -> List[str]:
+    """SystemPaths of the first `top_n` documents whose previews need a conversion."""
+    paths = []
+    for doc in documents:
+        extension = str(doc.get("FileExtension") or "").lower().lstrip(".")
+        if extension in PREVIEW_PREFETCH_EXTENSIONS and doc.get("SystemPath"):
+            paths.append(doc["SystemPath"])
+            if len(paths) >= top_n:
+                break
+    return paths
+
+
+async def request_preview_prefetch(session_id: Optional[str], paths: List[str]) -> None:
+    """Runs after the response is sent; prefetching is best effort, errors are only logged."""
+    if _prefetch_client is None:
+        return
+    try:
+        response = await _prefetch_client.post(
+            PREVIEW_PREFETCH_URL, json={"session_id": session_id, "paths": paths}
+        )
+        if response.status_code >= 400:
+            logger.warning(f"Preview prefetch rejected: {response.status_code} - {response.text[:200]}")
+    except Exception as e:
+        # nobody awaits this task, so anything uncaught would only surface as a Starlette traceback
+        logger.warning(f"Preview prefetch request failed: {e!r}")
+
+
+# Facet aggregations shown in the filters sidebar. They only need to run once per
+# distinct query; page fetches reuse the cached result (see /search/facets).
+FACET_AGGS = {
+    "doctype_counts": {"terms": {"field": "DocType.keyword", "size": 100}},
+    "branchtype_counts": {"terms": {"field": "Branch.keyword", "size": 100}},
+    "extensiontype_counts": {"terms": {"field": "FileExtension.keyword", "size": 100}},
+}
+FACET_CACHE_TTL = float(os.getenv("FACET_CACHE_TTL", "300"))
+FACET_CACHE_SIZE = int(os.getenv("FACET_CACHE_SIZE", "1024"))
+facet_cache = TTLCache(maxsize=FACET_CACHE_SIZE, ttl=FACET_CACHE_TTL)
+
+# Post-processed search_elasticsearch results, keyed by query fingerprint plus
+# paging position. SEARCH_CACHE_REFRESH_CHECK > 0 makes both caches drop their
+# entries once the index has been written to (checked at most that often, in seconds).
+SEARCH_CACHE_TTL = float(os.getenv("SEARCH_CACHE_TTL", "120"))
+SEARCH_CACHE_SIZE = int(os.getenv("SEARCH_CACHE_SIZE", "512"))
+SEARCH_CACHE_REFRESH_CHECK = float(os.getenv("SEARCH_CACHE_REFRESH_CHECK", "0"))
+result_cache = TTLCache(maxsize=SEARCH_CACHE_SIZE, ttl=SEARCH_CACHE_TTL)
+_index_generation: Dict[str, Any] = {"value": None, "checked_at": 0.0}
+
+# Pagination. Pages are fetched with search_after, never deep from/size: each
+# response carries a signed cursor for the next page, and the sort values at the
+# page boundaries seen so far are kept per query (a sparse page index) so a jump
+# to page N only scans sort values forward from the nearest known boundary.
+SEARCH_SORT = [{"DocumentDate": "desc"}, {"_id": "asc"}]
+MAX_RESULT_WINDOW = int(os.getenv("ES_MAX_RESULT_WINDOW", "10000"))
+PAGE_SCAN_CHUNK = int(os.getenv("PAGE_SCAN_CHUNK", "5000"))  # sort values fetched per scan request
+SEARCH_PIT_KEEP_ALIVE = os.getenv("SEARCH_PIT_KEEP_ALIVE", "5m")
+page_index = TTLCache(maxsize=SEARCH_CACHE_SIZE, ttl=SEARCH_CACHE_TTL)
+
+# Totals. Searches count matches only up to this threshold and report a lower
+# bound ("total_relation": "gte") above it; the exact figure comes from the
+# cached /search/count (or totals="exact") when the UI really needs it.
+SEARCH_TOTAL_HITS_THRESHOLD = int(os.getenv("SEARCH_TOTAL_HITS_THRESHOLD", "10000"))
+TOTALS_MODES = ("approximate", "exact")
+count_cache = TTLCache(maxsize=FACET_CACHE_SIZE, ttl=FACET_CACHE_TTL)
+
+# Deferred highlighting. /search remembers the normalised parameters behind each
+# query fingerprint, so /search/highlights can rebuild the query from the
+# fingerprint alone and highlight just the requested ids.
+HIGHLIGHT_BATCH_MAX = int(os.getenv("HIGHLIGHT_BATCH_MAX", "100"))
+query_registry = TTLCache(maxsize=FACET_CACHE_SIZE, ttl=float(os.getenv("QUERY_REGISTRY_TTL", "1800")))
+highlight_cache = TTLCache(maxsize=SEARCH_CACHE_SIZE * 50, ttl=SEARCH_CACHE_TTL)
+
+# /search/batch: several searches of one screen in a single _msearch round-trip
+SEARCH_BATCH_MAX = int(os.getenv("SEARCH_BATCH_MAX", "20"))
+BATCH_SEARCH_TYPES = ("search", "attachments", "count")
+
+# Bulk lists (see query_compiler). ES refuses terms lookups with more values
+# than the index.max_terms_count setting, 65536 by default.
+BULK_LIST_MAX_TERMS = int(os.getenv("BULK_LIST_MAX_TERMS", "65536"))
+list_terms_cache = TTLCache(maxsize=64, ttl=FACET_CACHE_TTL)
+# Per-identifier counts need one terms bucket per identifier and field, and ES
+# rejects searches with more than search.max_buckets buckets (65535 by default)
+ES_MAX_BUCKETS = int(os.getenv("ES_MAX_BUCKETS", "65535"))
+BULK_LIST_COUNTS_MAX_TERMS = ES_MAX_BUCKETS // max(1, len(BULK_LIST_FIELDS))
+# Stored lists are deleted every BULK_LIST_CLEANUP_INTERVAL seconds once their
+# created_at is older than BULK_LIST_TTL. Posting a list renews it, and so does
+# using its list_id (at most once per BULK_LIST_TOUCH_INTERVAL and process).
+BULK_LIST_TTL = int(os.getenv("BULK_LIST_TTL", str(7 * 24 * 3600)))
+BULK_LIST_CLEANUP_INTERVAL = float(os.getenv("BULK_LIST_CLEANUP_INTERVAL", "3600"))
+BULK_LIST_TOUCH_INTERVAL = float(os.getenv("BULK_LIST_TOUCH_INTERVAL", "3600"))
+list_touch_cache = TTLCache(maxsize=1024, ttl=BULK_LIST_TOUCH_INTERVAL)
+
+
+def parse_facet_counts(data: Dict[str, Any]) -> Tuple[Dict[str, int], Dict[str, int], Dict[str, int]]:
+    """
+    Turns the FACET_AGGS buckets of an ES response into {key: doc_count} dicts.
+    """
+    # extracting and formatting aggrefgation results
+    doc_type_counts={}
+    branch_type_counts={}
+    extension_type_counts={}
+    # Check if 'aggregations' key exists in the response
+    if "aggregations" in data:
+        # Extract the bucket results from the 'doctype_counts' aggregation
+        doctype_counts = data["aggregations"]["doctype_counts"]
+        branchtype_counts=data["aggregations"]["branchtype_counts"]
+        extensiontype_counts=data["aggregations"]["extensiontype_counts"]
+        # Iterate over each bucket and store the counts in doc_type_counts
+        for bucket in doctype_counts.get("buckets", []):
+            key = bucket.get("key")
+            doc_count = bucket.get("doc_count")
+
+            if key is not None and doc_count is not None:
+                doc_type_counts[key] = doc_count
+
+        for bucket in branchtype_counts.get("buckets",[]):
+            key = bucket.get("key")
+            branch_count=bucket.get("doc_count")
+
+            if key is not None and branch_count is not None:
+                branch_type_counts[key]=branch_count
+
+        for bucket in extensiontype_counts.get("buckets",[]):
+            key = bucket.get("key")
+            extension_count=bucket.get("doc_count")
+
+            if key is not None and extension_count is not None:
+                extension_type_counts[key]=extension_count
+
+    return doc_type_counts, branch_type_counts, extension_type_counts
+
+
 def to_epoch_millis(date_str):
     dt_naive=datetime.strptime(date_str,"%Y-%m-%d")
     dt_aware_utc=datetime.combine(dt_naive.date(),time.min,tzinfo=timezone.utc)
@@ -65,17 +379,19 @@ def to_epoch_millis(date_str):
 
 
 
-@app.post("/handle-attachment-link")
-async def handle_attachment_link(payload: Dict[str, Any] = Body(...)):
-    print("hello")
+# check once with sir
+MAX_ATTACHMENT_RESULTS=1000
+
+
+async def build_attachment_link_query(payload: Dict[str, Any]) -> Dict[str, Any]:
+    """
+    The search behind /handle-attachment-link: the parent of an attachment
+    (is_attachment true) or all attachments of a main document.
+    """
     ProphecyId = payload.get("app_id")
     ParentProphecyId = payload.get("parent_app_id")
     is_attachment = payload.get("is_attachment")
 
-
-    # check once with sir
-    MAX_ATTACHMENT_RESULTS=1000
-    
     print(f"{ProphecyId}, {ParentProphecyId}re, {is_attachment}")
     if is_attachment=="False":
         is_attachment=0
@@ -84,13 +400,10 @@ async def handle_attachment_link(payload: Dict[str, Any] = Body(...)):
         raise HTTPException(status_code=400, detail="Required fields missing: app_id, parent_app_id, is_attachment")
 
     if is_attachment:
-        print(f"{ParentProphecyId} hello")
         # If it is an attachment, find parent where AppId == ParentAppId
-        
-
         query={ "query": {
             "bool": {
-              "must": [
+              "filter": [
                 {
                   "term": {
                     "ProphecyId.keyword": ParentProphecyId
@@ -101,24 +414,17 @@ async def handle_attachment_link(payload: Dict[str, Any] = Body(...)):
               "should": []
             }
           },
-          "highlight":{
-          "fields":{
-           "Text": {}
-          }
-          },
           "sort": [
             {"DocumentDate": "desc"},
             {"_id": "asc"}
               ],
           "size": 1  }
 
-        
     else:
         # If it is a main doc, find all attachments where ParentAppId == AppId
-        print(ProphecyId)
         query={ "query": {
             "bool": {
-              "must": [
+              "filter": [
                 {
                   "term": {
                     "ParentProphecyId.keyword": ProphecyId
@@ -129,51 +435,50 @@ async def handle_attachment_link(payload: Dict[str, Any] = Body(...)):
               "should": []
             }
           },
-          "highlight":{
-          "fields":{
-           "Text": {}
-          }
-          },
           "size": MAX_ATTACHMENT_RESULTS,
           "sort": [
             {"DocumentDate": "desc"},
             {"_id": "asc"}
                      ]  }
 
-        
+    highlight = await build_highlight(query["size"])
+    if highlight:
+        query["highlight"] = highlight
+    return query
+
+
+def process_attachment_hits(raw_hits: List[dict]) -> List[dict]:
+    """Documents of an attachment-link search, with highlighted_text filled in."""
+    documents = []
+    for hit in raw_hits:
+        source = hit["_source"]
+        highlight = hit.get("highlight", {}).get("Text", [])
+        if highlight:
+            source["highlighted_text"] = highlight[0]
+        else:
+            source["highlighted_text"] = source.get("Text", "")
+        documents.append(source)
+    return documents
+
+
+@app.post("/handle-attachment-link")
+async def handle_attachment_link(payload: Dict[str, Any] = Body(...)):
+    query = await build_attachment_link_query(payload)
 
     try:
-        async with httpx.AsyncClient(timeout=10.0) as client:
-            url = f"{idx_url}/_search"
-            response = await client.post(url, json=query)
+        client = get_es_client()
+        url = f"{idx_url}/_search"
+        response = await client.post(url, json=query)
 
-            if response.status_code != 200:
-                raise HTTPException(
-                    status_code=500,
-                    detail=f"Elasticsearch error: {response.status_code} - {response.text}"
-                )
+        if response.status_code != 200:
+            raise HTTPException(
+                status_code=500,
+                detail=f"Elasticsearch error: {response.status_code} - {response.text}"
+            )
 
         data = response.json()
         raw_hits = data.get("hits", {}).get("hits", [])
-        print(len(raw_hits))
-
-        # Process highlights
-        processed_hits = []
-        for hit in raw_hits:
-            source = hit["_source"]
-            highlight = hit.get("highlight", {}).get("Text", [])
-            if highlight:
-                source["highlighted_text"] = highlight[0]
-            else:
-                source["highlighted_text"] = source.get("Text", "")
-            
-            processed_hit = {
-                **hit,
-                "_source": source
-            }
-            processed_hits.append(processed_hit)
-
-        documents = [hit["_source"] for hit in processed_hits]
+        documents = process_attachment_hits(raw_hits)
         print(len(documents))
         
         # handle the case where there might be 100 attactcments
@@ -194,126 +499,155 @@ async def handle_attachment_link(payload: Dict[str, Any] = Body(...)):
 
 
 # ---------------------------------------
-async def search_elasticsearch(
+def build_query_body(
     queries: List[str],
-    size: int,
     search_type: str = "any",
-    search_after: Optional[List] = None,
     filters: Optional[Dict[str, List[str]]] = None,
     date_range: Optional[Dict[str, str]] = None,
-    parents_only: bool =False,
-    from_offset: Optional[int] = None  # ★ 1. Add the new 'from_offset' parameter
-    
-) -> Tuple[List[dict], Optional[List]]:
+    parents_only: bool = False,
+    list_id: Optional[str] = None,
+) -> Dict[str, Any]:
     """
-    Performs a search against Elasticsearch with pagination using search_after.
+    Builds the bool query shared by paginated search and bulk export. Filters
+    always run in filter context; since SEARCH_SORT does not order by _score,
+    the text clauses do too (see query_compiler).
     """
+    try:
+        return compile_query(
+            queries, search_type, filters, date_range, parents_only,
+            scoring=sort_uses_score(SEARCH_SORT), list_id=list_id,
+        )
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
 
 
+# Batch attachment resolution for a result page: the attachments of many
+# parents and the parents of many attachments in one size-0 search, grouped by
+# terms aggregations with top_hits. Hits carry the "card" fields only and are
+# not highlighted. ES caps top_hits at index.max_inner_result_window (100).
+ATTACHMENT_BATCH_MAX_IDS = int(os.getenv("ATTACHMENT_BATCH_MAX_IDS", "200"))
+ATTACHMENTS_PER_PARENT = int(os.getenv("ATTACHMENTS_PER_PARENT", "100"))
+ATTACHMENT_LINK_VIEW = "card"
 
-    # if not queries:
-    #     raise HTTPException(status_code=400, detail="Query list cannot be empty")
 
-    must_clauses = []
-    should_clauses = []
-    print(queries)
-    print(parents_only)
-    search_fields_keywords=["OriginalName.keyword","ProphecyId.keyword","ParentProphecyId.keyword"]
-    # Query clauses
-    if search_type == "all":
+def _id_list(payload: Dict[str, Any], key: str) -> List[str]:
+    values = payload.get(key) or []
+    if not isinstance(values, list) or not all(isinstance(v, str) for v in values):
+        raise HTTPException(status_code=400, detail=f"{key} must be a list of ProphecyIds.")
+    return list(dict.fromkeys(v for v in values if v))
 
-        for q in queries:
-            sub_clauses=[]
-            sub_clauses.append({"match_phrase": {"Text": q}} )
 
-            for field in search_fields_keywords:
-                sub_clauses.append({"term": {field:q}})
+@app.post("/handle-attachment-link/batch")
+async def handle_attachment_links_batch(payload: Dict[str, Any] = Body(...)):
+    """
+    Resolves the attachment links of a whole result page in one ES request.
+    Takes {"app_ids": [...]} (main documents whose attachments are wanted) and
+    {"parent_app_ids": [...]} (the ParentProphecyIds of attachments whose parent
+    is wanted). Returns {"attachments": {app_id: {"documents": [...], "total": n}},
+    "parents": {parent_app_id: document or null}}; "total" above the number of
+    documents means the list was cut at ATTACHMENTS_PER_PARENT and the rest is
+    available from /handle-attachment-link.
+    """
+    app_ids = _id_list(payload, "app_ids")
+    parent_app_ids = _id_list(payload, "parent_app_ids")
+    if not app_ids and not parent_app_ids:
+        raise HTTPException(status_code=400, detail="Required fields missing: app_ids or parent_app_ids")
+    if len(app_ids) + len(parent_app_ids) > ATTACHMENT_BATCH_MAX_IDS:
+        raise HTTPException(status_code=400, detail=f"At most {ATTACHMENT_BATCH_MAX_IDS} ids per request.")
+
+    should = []
+    aggs = {}
+    if app_ids:
+        should.append({"terms": {"ParentProphecyId.keyword": app_ids}})
+        aggs["attachments"] = {
+            "terms": {"field": "ParentProphecyId.keyword", "include": app_ids, "size": len(app_ids)},
+            "aggs": {"docs": {"top_hits": {
+                "size": ATTACHMENTS_PER_PARENT, "sort": SEARCH_SORT,
+                **build_source_projection(ATTACHMENT_LINK_VIEW),
+            }}},
+        }
+    if parent_app_ids:
+        should.append({"terms": {"ProphecyId.keyword": parent_app_ids}})
+        aggs["parents"] = {
+            "terms": {"field": "ProphecyId.keyword", "include": parent_app_ids, "size": len(parent_app_ids)},
+            "aggs": {"docs": {"top_hits": {
+                "size": 1, "sort": SEARCH_SORT,
+                **build_source_projection(ATTACHMENT_LINK_VIEW),
+            }}},
+        }
+    search_body = {
+        "size": 0,
+        "track_total_hits": False,
+        "query": {"bool": {"filter": [{"bool": {"should": should, "minimum_should_match": 1}}]}},
+        "aggs": aggs,
+    }
 
-            must_clauses.append({"bool": {"should": sub_clauses,"minimum_should_match":1}})
-    elif search_type == "any":
-        for q in queries:
-            sub_clauses=[]
-            sub_clauses.append({"match_phrase": {"Text": q}})
+    try:
+        client = get_es_client()
+        response = await client.post(f"{idx_url}/_search", json=search_body)
+    except httpx.RequestError as e:
+        logger.error(f"Elasticsearch connection error: {str(e)}")
+        raise HTTPException(status_code=503, detail="Elasticsearch unavailable")
+    if response.status_code != 200:
+        logger.error(f"Elasticsearch error: {response.status_code} - {response.text}")
+        raise HTTPException(
+            status_code=500,
+            detail=f"Elasticsearch error: {response.status_code} - {response.text}"
+        )
 
-            for field in search_fields_keywords:
-                sub_clauses.append({"term": {field:q}})
+    aggregations = response.json().get("aggregations", {})
 
-            should_clauses.append({"bool": {"should": sub_clauses,"minimum_should_match":1}})
-    else:
-        if queries:
-            raise HTTPException(status_code=400, detail="Invalid search_type. Use 'any' or 'all'.")
-
-    # Filter clauses
-    if filters:
-        for field, values in filters.items():
-            if values:  # only if list is non-empty
-                keyword_field=f"{field}.keyword" if not field.endswith(".keyword") else field
-                must_clauses.append({
-                    "terms": {keyword_field: values}
-                })
-
-    # Date range clause
-    
-    if date_range:
-        range_filter = {}
-        if date_range.get("from"):
-            range_filter["gte"] = to_epoch_millis(date_range["from"])
-        if date_range.get("to"):
-            to_dt_naive=datetime.strptime(date_range["to"],"%Y-%m-%d")
-            next_day_date_obj=to_dt_naive.date()+timedelta(days=1)
-            next_day_start_dt_aware_utc=datetime.combine(next_day_date_obj,time.min,tzinfo=timezone.utc)
-            range_filter["lt"] = int(next_day_start_dt_aware_utc.timestamp())
-
-        if range_filter.get("gte"):
-            print(f" 2nd {datetime.fromtimestamp(range_filter["gte"],tz=timezone.utc)}")
-        if range_filter["lt"]:
-            print(f" 3nd {datetime.fromtimestamp(range_filter["lt"],tz=timezone.utc)}")
-        
-        if range_filter:
-            must_clauses.append({
-                "range": {
-                    "DocumentDate": range_filter
-                }
-            })
-        elif range_filter:
-            print(f"4th {range_filter}")
-
-    if parents_only:
-        must_clauses.append({"term": {"IsAttachment.keyword": "False"}})
-
-    # Final query
-    query_body = {
-        "bool": {
-            "must": must_clauses,
-            "should": should_clauses,
-            "minimum_should_match": 1 if should_clauses else 0
-        }
-    }
+    def bucket_documents(bucket: Dict[str, Any]) -> List[dict]:
+        top_hits = bucket.get("docs", {}).get("hits", {"hits": []})
+        hits = process_search_response({"hits": {"hits": top_hits.get("hits", [])}})[0]
+        return [{**hit["_source"], "_id": hit.get("_id")} for hit in hits]
+
+    attachments = {app_id: {"documents": [], "total": 0} for app_id in app_ids}
+    for bucket in aggregations.get("attachments", {}).get("buckets", []):
+        attachments[bucket["key"]] = {"documents": bucket_documents(bucket), "total": bucket["doc_count"]}
+    parents: Dict[str, Optional[dict]] = {parent_id: None for parent_id in parent_app_ids}
+    for bucket in aggregations.get("parents", {}).get("buckets", []):
+        documents = bucket_documents(bucket)
+        parents[bucket["key"]] = documents[0] if documents else None
+
+    return JSONResponse(content={"attachments": attachments, "parents": parents})
+
+
+# ---------------------------------------
+async def build_search_body(
+    queries: List[str],
+    size: int,
+    search_type: str = "any",
+    search_after: Optional[List] = None,
+    filters: Optional[Dict[str, List[str]]] = None,
+    date_range: Optional[Dict[str, str]] = None,
+    parents_only: bool = False,
+    from_offset: Optional[int] = None,
+    view: Optional[str] = None,
+    include_aggs: bool = True,
+    pit_id: Optional[str] = None,
+    highlight: bool = True,
+    list_id: Optional[str] = None
+) -> Tuple[Dict[str, Any], bool]:
+    """
+    The ES request body of search_elasticsearch. Returns (search_body,
+    highlight_disabled); highlight_disabled is True when highlighting was asked
+    for but is currently switched off (see build_highlight).
+    """
+    query_body = build_query_body(queries, search_type, filters, date_range, parents_only, list_id)
 
     search_body = {
         "size": size,
-        "sort": [
-            {"DocumentDate": "desc"},
-            {"_id": "asc"}
-        ],
-        "track_total_hits": True,
+        "sort": SEARCH_SORT,
+        "track_total_hits": SEARCH_TOTAL_HITS_THRESHOLD,
         "query": query_body,
-        "highlight": {
-            "type":"unified",
-            "fields": {
-                "Text": {
-                "fragment_size":250,
-
-                "number_of_fragments":5,
-                "boundary_scanner":"sentence"
-                }
-            },
-            "pre_tags": ["<mark>"],
-            "post_tags": ["</mark>"]
-        }
         }
 
-    print(search_body)
+    highlight_body = await build_highlight(size) if highlight else None
+    if highlight_body:
+        search_body["highlight"] = highlight_body
+
+    search_body.update(build_source_projection(view))
 
     if from_offset is not None and from_offset>=0:
         search_body["from"]=from_offset
@@ -321,175 +655,530 @@ async def search_elasticsearch(
         search_body["search_after"] = search_after
 
 # add agrregation for doc
-    
-    search_body["aggs"]={
-        "doctype_counts":{
-            "terms":{
-                "field": "DocType.keyword",
-                "size":100
-            }
-        },
-        #  added for branch type
-         "branchtype_counts":{
-            "terms":{
-                "field": "Branch.keyword",
-                "size":100
-            }
-        },
+    if include_aggs:
+        search_body["aggs"] = FACET_AGGS
+    else:
+        # page fetch on an unchanged query: facets and exact totals come from /search/facets
+        search_body["track_total_hits"] = False
 
-          "extensiontype_counts":{
-            "terms":{
-                "field": "FileExtension.keyword",
-                "size":100
-            }  }
+    if pit_id:
+        search_body["pit"] = {"id": pit_id, "keep_alive": SEARCH_PIT_KEEP_ALIVE}
 
+    return search_body, highlight and highlight_body is None
 
-    }
 
-    
+def process_search_response(data: Dict[str, Any], pit_id: Optional[str] = None, highlight_disabled: bool = False):
+    """
+    Turns the ES response of a build_search_body search into search_elasticsearch's
+    return tuple (hits, last sort value, facet counts, total, PIT id).
+    """
+    raw_hits = data.get("hits", {}).get("hits", [])
+    print(f"there is raw hits {len(raw_hits)}")
+    total_hits={"value": 0, "relation": "eq"}
+    hits_total=data.get("hits", {}).get("total", [])
+    if isinstance(hits_total,dict):
+        total_hits={"value": hits_total.get("value",0), "relation": hits_total.get("relation", "eq")}
+        print(f"there is toatal_hits {total_hits}")
+
+
+    # Process highlights
+    processed_hits = []
+    for hit in raw_hits:
+        source = hit.get("_source",{})  #safe access
+
+        # Text itself is never fetched; use the server-side preview
+        if TEXT_PREVIEW_FIELD:
+            text_preview = source.pop(TEXT_PREVIEW_FIELD, None) or ""
+        else:
+            text_preview = ((hit.get("fields") or {}).get("text_preview") or [""])[0] or ""
+
+        # no highlight when the hit matched on a keyword field, or highlighting was off
+        highlight_list = (hit.get("highlight") or {}).get("Text", [])
+        source["Text"]=text_preview[:TEXT_PREVIEW_CHARS]
+        if highlight_disabled:
+            source["highlight_degraded"] = True
+        
+        if highlight_list:
+            # chnaged
+            source["highlighted_text"] = highlight_list[0]
+        else:
+            source["highlighted_text"] = source.get("Text", "")
+
+        
+        if source.get("IsAttachment")=="False":
+            attachment_path=source.get("Attachments","") or ""
+            if attachment_path:
+                # Use a tuple of delimiters to split the string
+                split_result = re.split(r',|@@@@',attachment_path)
+                # Filter out any empty strings and count the non-empty parts
+                a_count = len([x.strip() for x in split_result if x.strip()])
+            else:
+                a_count=0
+            source["a_count"]=a_count
+        
+        processed_hit = {
+            **hit,
+            "_source": source
+        }
+        processed_hit.pop("fields", None)
+        processed_hits.append(processed_hit)
+
+    last_sort_value = raw_hits[-1].get("sort") if raw_hits else None
+
+
+
+    doc_type_counts, branch_type_counts, extension_type_counts = parse_facet_counts(data)
+
+    # Print the resulting doc_type_counts dictionary
+    print(doc_type_counts)
+
+
+    return processed_hits, last_sort_value,doc_type_counts,branch_type_counts,extension_type_counts,total_hits,data.get("pit_id", pit_id)
+
+
+def record_highlight_rejection(error_text: str) -> None:
+    # Should not happen with max_analyzed_offset set; back off so only this request pays twice
+    logger.error(f"Elasticsearch rejected highlighting, disabling it for {HIGHLIGHT_BACKOFF}s: {error_text[:500]}")
+    highlight_state["rejected"] += 1
+    highlight_state["disabled_until"] = monotonic() + HIGHLIGHT_BACKOFF
+
+
+# ---------------------------------------
+async def search_elasticsearch(
+    queries: List[str],
+    size: int,
+    search_type: str = "any",
+    search_after: Optional[List] = None,
+    filters: Optional[Dict[str, List[str]]] = None,
+    date_range: Optional[Dict[str, str]] = None,
+    parents_only: bool =False,
+    from_offset: Optional[int] = None,  # ★ 1. Add the new 'from_offset' parameter
+    view: Optional[str] = None,
+    include_aggs: bool = True,
+    pit_id: Optional[str] = None,
+    highlight: bool = True,
+    list_id: Optional[str] = None
+) -> Tuple[List[dict], Optional[List]]:
+    """
+    Performs a search against Elasticsearch with pagination using search_after.
+    Only the fields of `view` (see VIEW_SOURCE_FIELDS) are fetched; `Text` is
+    replaced by its first TEXT_PREVIEW_CHARS characters, computed server-side.
+    The total is ES's {"value", "relation"}: exact up to SEARCH_TOTAL_HITS_THRESHOLD,
+    a lower bound ("gte") above it. With include_aggs=False the facet
+    aggregations and the total are skipped (empty dicts and a total of 0 are
+    returned in their place).
+    With `pit_id` the search runs against that point-in-time; the (possibly
+    refreshed) PIT id is returned as the last tuple element.
+    highlight=False skips highlighting (fetch it later via /search/highlights).
+    """
+    search_body, highlight_disabled = await build_search_body(
+        queries, size, search_type, search_after, filters, date_range, parents_only, from_offset, view,
+        include_aggs=include_aggs, pit_id=pit_id, highlight=highlight, list_id=list_id
+    )
+    print(search_body)
 
     try:
-        async with httpx.AsyncClient(timeout=10.0) as client:
-            print("before sending to es")
-            url = f"{idx_url}/_search"
-            print("after sending to es")
+        client = get_es_client()
+        print("before sending to es")
+        # PIT searches must not name the index
+        url = f"{ES_HOST.rstrip('/')}/_search" if pit_id else f"{idx_url}/_search"
+        print("after sending to es")
+        response = await client.post(url, json=search_body)
+
+
+        highlight_state["requests"] += 1
+
+        print(f"the status code is {response.status_code}")
+        if "highlight" in search_body and is_highlight_rejection(response):
+            record_highlight_rejection(response.text)
+            highlight_disabled = True
+            search_body.pop("highlight", None)
             response = await client.post(url, json=search_body)
 
+        if highlight_disabled:
+            highlight_state["degraded"] += 1
 
-            # new
-            highlight_disabled=False  
+        if pit_id and response.status_code == 404:
+            raise expired_snapshot_error()
 
-            print(f"the status code is {response.status_code}")
-            if response.status_code == 400:
-                print("hello")
-                logger.warning("Elasticsearch highlight limit reached")
-                highlight_disabled=True
+        if response.status_code != 200:
+            logger.error(f"Elasticsearch error: {response.status_code} - {response.text}")
+            raise HTTPException(
+                status_code=500,
+                detail=f"Elasticsearch responded with status code {response.status_code}: {response.text}"
+            )
 
+        return process_search_response(response.json(), pit_id, highlight_disabled)
 
-                # remove highlight and retry
-                search_body.pop("highlight",None)
-                response = await client.post(url, json=search_body)
+    except HTTPException:
+        raise
+    except httpx.RequestError as e:
+        logger.error(f"Elasticsearch connection error: {str(e)}")
+        raise HTTPException(status_code=503, detail="Elasticsearch is unavailable")
+    except Exception as e:
+        logger.exception("Unexpected error during Elasticsearch query")
+        raise HTTPException(status_code=500, detail="Internal Server Error")
 
-                if response.status_code !=200:
 
-                    print("error")
-                    logger.error(f"Elasticsearch error: {response.status_code} - {response.text}")
-                    print("error")
+# ---------------------------------------
+async def invalidate_caches_if_index_changed() -> None:
+    """
+    Clears the result and facet caches when the index's write counters moved since
+    the last check. Does nothing unless SEARCH_CACHE_REFRESH_CHECK is set.
+    """
+    if SEARCH_CACHE_REFRESH_CHECK <= 0:
+        return
+    now = monotonic()
+    if now - _index_generation["checked_at"] < SEARCH_CACHE_REFRESH_CHECK:
+        return
+    _index_generation["checked_at"] = now
 
+    try:
+        client = get_es_client()
+        response = await client.get(f"{idx_url}/_stats/indexing", params={"filter_path": "_all.primaries.indexing"})
+    except httpx.RequestError as e:
+        logger.warning(f"Could not read index stats for cache invalidation: {e}")
+        return
+    if response.status_code != 200:
+        logger.warning(f"Could not read index stats for cache invalidation: {response.status_code} - {response.text}")
+        return
+
+    indexing = response.json().get("_all", {}).get("primaries", {}).get("indexing", {})
+    generation = indexing.get("index_total", 0) + indexing.get("delete_total", 0)
+    if _index_generation["value"] is not None and generation != _index_generation["value"]:
+        logger.info("Index changed since last check, clearing search caches")
+        result_cache.clear()
+        facet_cache.clear()
+        page_index.clear()
+        count_cache.clear()
+        highlight_cache.clear()
+    _index_generation["value"] = generation
+
+
+def search_result_key(
+    queries: List[str],
+    size: int,
+    search_type: str = "any",
+    search_after: Optional[List] = None,
+    filters: Optional[Dict[str, List[str]]] = None,
+    date_range: Optional[Dict[str, str]] = None,
+    parents_only: bool = False,
+    from_offset: Optional[int] = None,
+    view: Optional[str] = None,
+    include_aggs: bool = True,
+    pit_id: Optional[str] = None,
+    highlight: bool = True,
+    list_id: Optional[str] = None
+) -> str:
+    """result_cache key of a search_elasticsearch call."""
+    return query_fingerprint(
+        normalize_search_params(queries, search_type, filters, date_range, parents_only, list_id),
+        size=size, search_after=search_after, from_offset=from_offset, view=view, include_aggs=include_aggs,
+        pit_id=pit_id, highlight=highlight,
+    )
+
+
+async def cached_search_elasticsearch(
+    queries: List[str],
+    size: int,
+    search_type: str = "any",
+    search_after: Optional[List] = None,
+    filters: Optional[Dict[str, List[str]]] = None,
+    date_range: Optional[Dict[str, str]] = None,
+    parents_only: bool = False,
+    from_offset: Optional[int] = None,
+    view: Optional[str] = None,
+    include_aggs: bool = True,
+    pit_id: Optional[str] = None,
+    highlight: bool = True,
+    list_id: Optional[str] = None
+):
+    """
+    search_elasticsearch behind the in-process result cache. A repeat of the same
+    query and page skips both the ES round-trip and the hit post-processing.
+    """
+    await invalidate_caches_if_index_changed()
+
+    key = search_result_key(
+        queries, size, search_type, search_after, filters, date_range, parents_only, from_offset, view,
+        include_aggs=include_aggs, pit_id=pit_id, highlight=highlight, list_id=list_id
+    )
+    result = result_cache.get(key)
+    if result is not None:
+        return result
 
+    result = await search_elasticsearch(
+        queries, size, search_type, search_after, filters, date_range, parents_only, from_offset, view,
+        include_aggs=include_aggs, pit_id=pit_id, highlight=highlight, list_id=list_id
+    )
+    result_cache.set(key, result)
+    return result
 
+
+# ---------------------------------------
+async def resolve_page_search_after(
+    fingerprint: str,
+    page: int,
+    size: int,
+    query_body: Dict[str, Any],
+    pit_id: Optional[str] = None,
+) -> Tuple[bool, Optional[List]]:
+    """
+    Returns (exists, search_after) for 1-based `page` of a query. Starts from the
+    nearest page boundary already in the page index and scans forward fetching
+    only sort values (no _source, highlights, aggs or totals), recording every
+    boundary it passes. `exists` is False when the pages before `page` are not
+    all full, i.e. the result set ends before it.
+    """
+    # Sort values (incl. the implicit _shard_doc tiebreaker) are only valid in their own PIT snapshot
+    index_key = (fingerprint, size, pit_id)
+    boundaries: Dict[int, Optional[List]] = dict(page_index.get(index_key) or {1: None})
+    if page in boundaries:
+        return True, boundaries[page]
+
+    known_page = max(p for p in boundaries if p < page)
+    search_after = boundaries[known_page]
+    pages_per_chunk = max(1, PAGE_SCAN_CHUNK // size)
+    client = get_es_client()
+    try:
+        while known_page < page:
+            chunk_pages = min(pages_per_chunk, page - known_page)
+            scan_body = {
+                "size": chunk_pages * size,
+                "query": query_body,
+                "sort": SEARCH_SORT,
+                "_source": False,
+                "track_total_hits": False,
+            }
+            if search_after:
+                scan_body["search_after"] = search_after
+            if pit_id:
+                scan_body["pit"] = {"id": pit_id, "keep_alive": SEARCH_PIT_KEEP_ALIVE}
+                url = f"{ES_HOST.rstrip('/')}/_search"
+            else:
+                url = f"{idx_url}/_search"
+            response = await client.post(url, json=scan_body, params={"filter_path": "hits.hits.sort,pit_id"})
+            if pit_id and response.status_code == 404:
+                raise expired_snapshot_error()
             if response.status_code != 200:
-                logger.error(f"Elasticsearch error: {response.status_code} - {response.text}")
+                logger.error(f"Elasticsearch error while scanning page boundaries: {response.status_code} - {response.text}")
                 raise HTTPException(
                     status_code=500,
                     detail=f"Elasticsearch responded with status code {response.status_code}: {response.text}"
                 )
+            hits = response.json().get("hits", {}).get("hits", [])
+            for i in range(1, chunk_pages + 1):
+                if len(hits) < i * size:
+                    break
+                boundaries[known_page + i] = hits[i * size - 1]["sort"]
+            if len(hits) < chunk_pages * size:
+                break  # the result set ends before `page`
+            known_page += chunk_pages
+            search_after = boundaries[known_page]
+    except httpx.RequestError as e:
+        logger.error(f"Elasticsearch connection error: {str(e)}")
+        raise HTTPException(status_code=503, detail="Elasticsearch is unavailable")
+    finally:
+        page_index.set(index_key, boundaries)
+
+    return page in boundaries, boundaries.get(page)
 
-        data = response.json()
-        raw_hits = data.get("hits", {}).get("hits", [])
-        print(f"there is raw hits {len(raw_hits)}")
-        total_hits=0
-        hits_total=data.get("hits", {}).get("total", [])
-        if isinstance(hits_total,dict):
-            total_hits=hits_total.get("value",0)
-            print(f"there is toatal_hits {total_hits}")
-
-
-        # Process highlights
-        processed_hits = []
-        for hit in raw_hits:
-            source = hit.get("_source",{})  #safe access
-
-            text_full=source.get('Text') or ""
-
-            # if we retried highlight might be missing
-            highlight_list = (hit.get("highlight") or {}).get("Text", [])
-            source["Text"]=text_full[:100]
-            
-            if highlight_list:
-                # chnaged
-                source["highlighted_text"] = highlight_list[0]
-            else:
-                source["highlighted_text"] = source.get("Text", "")
-
-            
-            if source.get("IsAttachment")=="False":
-                attachment_path=source.get("Attachments","") or ""
-                if attachment_path:
-                    # Use a tuple of delimiters to split the string
-                    split_result = re.split(r',|@@@@',attachment_path)
-                    # Filter out any empty strings and count the non-empty parts
-                    a_count = len([x.strip() for x in split_result if x.strip()])
-                else:
-                    a_count=0
-                source["a_count"]=a_count
-            
-            processed_hit = {
-                **hit,
-                "_source": source
-            }
-            processed_hits.append(processed_hit)
 
-        last_sort_value = raw_hits[-1]["sort"] if raw_hits else None
+def expired_snapshot_error() -> HTTPException:
+    # ES answers 404 for searches on a closed or expired point-in-time
+    return HTTPException(status_code=410, detail="The consistent result snapshot has expired; search again without the cursor.")
 
 
+def record_page_boundary(fingerprint: str, size: int, page: int, search_after: Optional[List], pit_id: Optional[str] = None) -> None:
+    index_key = (fingerprint, size, pit_id)
+    boundaries = page_index.get(index_key) or {1: None}
+    if page not in boundaries:
+        page_index.set(index_key, {**boundaries, page: search_after})
 
-        # extracting and formatting aggrefgation results
-        doc_type_counts={}
-        branch_type_counts={}
-        extension_type_counts={}
-        # Check if 'aggregations' key exists in the response
-        if "aggregations" in data:
-            # Extract the bucket results from the 'doctype_counts' aggregation
-            doctype_counts = data["aggregations"]["doctype_counts"]
-            branchtype_counts=data["aggregations"]["branchtype_counts"]
-            extensiontype_counts=data["aggregations"]["extensiontype_counts"]
-            # Iterate over each bucket and store the counts in doc_type_counts
-            for bucket in doctype_counts.get("buckets", []):
-                key = bucket.get("key")
-                doc_count = bucket.get("doc_count")
-                
-                if key is not None and doc_count is not None:
-                    doc_type_counts[key] = doc_count
 
-            for bucket in branchtype_counts.get("buckets",[]):
-                key = bucket.get("key")
-                branch_count=bucket.get("doc_count")
+# ---------------------------------------
+async def search_facets(
+    queries: List[str],
+    search_type: str = "any",
+    filters: Optional[Dict[str, List[str]]] = None,
+    date_range: Optional[Dict[str, str]] = None,
+    parents_only: bool = False,
+    list_id: Optional[str] = None,
+) -> Dict[str, Any]:
+    """
+    Runs only the facet aggregations and the (thresholded) total for a query
+    (size 0, no highlighting) and returns them in the /search response shape.
+    """
+    search_body = {
+        "size": 0,
+        "track_total_hits": SEARCH_TOTAL_HITS_THRESHOLD,
+        "query": build_query_body(queries, search_type, filters, date_range, parents_only, list_id),
+        "aggs": FACET_AGGS,
+    }
+    try:
+        client = get_es_client()
+        response = await client.post(f"{idx_url}/_search", json=search_body)
+    except httpx.RequestError as e:
+        logger.error(f"Elasticsearch connection error: {str(e)}")
+        raise HTTPException(status_code=503, detail="Elasticsearch is unavailable")
 
-                if key is not None and branch_count is not None:
-                    branch_type_counts[key]=branch_count
+    if response.status_code != 200:
+        logger.error(f"Elasticsearch error: {response.status_code} - {response.text}")
+        raise HTTPException(
+            status_code=500,
+            detail=f"Elasticsearch responded with status code {response.status_code}: {response.text}"
+        )
 
-            for bucket in extensiontype_counts.get("buckets",[]):
-                key = bucket.get("key")
-                extension_count=bucket.get("doc_count")
+    data = response.json()
+    doctype_counts, branchtype_counts, extensiontype_counts = parse_facet_counts(data)
+    hits_total = data.get("hits", {}).get("total", {})
+    return {
+        "aggregations": {
+            "doctype_counts": doctype_counts,
+            "branchtype_counts": branchtype_counts,
+            "extensiontype_counts": extensiontype_counts
+        },
+        "total": hits_total.get("value", 0) if isinstance(hits_total, dict) else 0,
+        "total_relation": hits_total.get("relation", "eq") if isinstance(hits_total, dict) else "eq"
+    }
 
-                if key is not None and extension_count is not None:
-                    extension_type_counts[key]=extension_count
 
+async def count_documents(query_body: Dict[str, Any]) -> int:
+    """Exact number of documents matching `query_body` (_count: no sorting, scoring or fetching)."""
+    try:
+        client = get_es_client()
+        response = await client.post(f"{idx_url}/_count", json={"query": query_body}, timeout=30.0)
+    except httpx.RequestError as e:
+        logger.error(f"Elasticsearch connection error: {str(e)}")
+        raise HTTPException(status_code=503, detail="Elasticsearch is unavailable")
 
+    if response.status_code != 200:
+        logger.error(f"Elasticsearch error: {response.status_code} - {response.text}")
+        raise HTTPException(
+            status_code=500,
+            detail=f"Elasticsearch responded with status code {response.status_code}: {response.text}"
+        )
+    return response.json().get("count", 0)
 
-        # Print the resulting doc_type_counts dictionary
-        print(doc_type_counts)
 
+async def cached_count(fingerprint: str, query_body: Dict[str, Any]) -> Tuple[int, bool]:
+    """Returns (exact count, came from cache) for a query fingerprint."""
+    count = count_cache.get(fingerprint)
+    if count is not None:
+        return count, True
+    count = await count_documents(query_body)
+    count_cache.set(fingerprint, count)
+    return count, False
 
-        return processed_hits, last_sort_value,doc_type_counts,branch_type_counts,extension_type_counts,total_hits
 
+# ---------------------------------------
+async def open_point_in_time(keep_alive: str = EXPORT_PIT_KEEP_ALIVE) -> str:
+    """
+    Opens a point-in-time on the index so an export (or a paginated session)
+    sees one consistent snapshot.
+    """
+    try:
+        client = get_es_client()
+        response = await client.post(f"{idx_url}/_pit", params={"keep_alive": keep_alive})
     except httpx.RequestError as e:
         logger.error(f"Elasticsearch connection error: {str(e)}")
         raise HTTPException(status_code=503, detail="Elasticsearch is unavailable")
+
+    if response.status_code != 200:
+        logger.error(f"Elasticsearch error opening PIT: {response.status_code} - {response.text}")
+        raise HTTPException(
+            status_code=500,
+            detail=f"Elasticsearch responded with status code {response.status_code}: {response.text}"
+        )
+    return response.json()["id"]
+
+
+async def close_point_in_time(pit_id: str) -> None:
+    try:
+        client = get_es_client()
+        await client.request("DELETE", f"{ES_HOST.rstrip('/')}/_pit", json={"id": pit_id})
     except Exception as e:
-        logger.exception("Unexpected error during Elasticsearch query")
-        raise HTTPException(status_code=500, detail="Internal Server Error")
+        # The PIT expires on its own after keep_alive, so this is only a courtesy
+        logger.warning(f"Could not close point-in-time: {e}")
+
+
+async def export_elasticsearch(
+    pit_id: str,
+    query_body: Dict[str, Any],
+    source_fields: List[str],
+    batch_size: int = EXPORT_BATCH_SIZE,
+) -> AsyncGenerator[str, None]:
+    """
+    Streams every hit of `query_body` as NDJSON using a point-in-time and search_after.
+
+    No highlights, aggregations or total counting; only `source_fields` are fetched.
+    The next batch is requested only after the previous one has been handed to the
+    client, so memory stays at one batch however large the result set is.
+    Errors after streaming has started are reported as a final {"error": ...} line.
+    """
+    client = get_es_client()
+    search_url = f"{ES_HOST.rstrip('/')}/_search"
+    search_after = None
+    exported = 0
+    try:
+        while True:
+            search_body = {
+                "size": batch_size,
+                "query": query_body,
+                "_source": source_fields,
+                "pit": {"id": pit_id, "keep_alive": EXPORT_PIT_KEEP_ALIVE},
+                "sort": [
+                    {"DocumentDate": "desc"},
+                    {"_shard_doc": "asc"}
+                ],
+                "track_total_hits": False,
+            }
+            if search_after:
+                search_body["search_after"] = search_after
+
+            response = await client.post(search_url, json=search_body, timeout=60.0)
+            if response.status_code != 200:
+                logger.error(f"Elasticsearch error during export: {response.status_code} - {response.text}")
+                yield json.dumps({"error": f"Elasticsearch responded with status code {response.status_code}"}) + "\n"
+                return
+
+            data = response.json()
+            pit_id = data.get("pit_id", pit_id)  # ES may hand back a refreshed PIT id
+            hits = data.get("hits", {}).get("hits", [])
+            if not hits:
+                break
+
+            yield "".join(json.dumps(hit.get("_source", {})) + "\n" for hit in hits)
+            exported += len(hits)
+
+            if len(hits) < batch_size:
+                break
+            search_after = hits[-1]["sort"]
+
+        logger.info(f"Export finished: {exported} documents")
+    except httpx.RequestError as e:
+        logger.error(f"Elasticsearch connection error during export: {str(e)}")
+        yield json.dumps({"error": "Elasticsearch is unavailable"}) + "\n"
+    finally:
+        await close_point_in_time(pit_id)
 
 
 # ---------------------------------------
+def check_paging_params(from_offset: Any, search_after: Any) -> None:
+    """Rejects malformed `from` / `search_after` values of a search request with a 400."""
+    if from_offset is not None and (not isinstance(from_offset, int) or isinstance(from_offset, bool) or from_offset < 0):
+        raise HTTPException(status_code=400, detail="from must be a non-negative integer.")
+    if search_after is not None and not isinstance(search_after, list):
+        raise HTTPException(status_code=400, detail="search_after must be a list of sort values.")
+
+
 @app.post("/search")
 async def stream_or_paginate_search(
     payload: Dict[str, Any] = Body(...)
 ):
     """
     Handles search requests: 
-    - Streams full results if stream=True 
+    - Streams every matching document as NDJSON if stream=True (PIT + search_after export)
     - Else paginated fetch (one batch at a time)
     """
     queries = payload.get("queries", [])
@@ -501,7 +1190,26 @@ async def stream_or_paginate_search(
     stream = payload.get("stream", False)       # Optional, default False
     parents_only = bool(payload.get("parents_only",False))
 
-    from_offset = payload.get("from")  # ** new**
+    from_offset = payload.get("from")  # legacy; aligned offsets are served as page jumps
+    cursor = payload.get("cursor")  # opaque next_cursor from a previous response
+    page = payload.get("page")  # 1-based page to jump to (with a cursor: within the cursor's snapshot)
+    consistent = bool(payload.get("consistent", False))  # page through one point-in-time snapshot
+    highlight = bool(payload.get("highlight", True))  # false: fetch fragments later via /search/highlights
+    totals = payload.get("totals", "approximate")  # "exact" replaces a lower-bound total with the exact count
+    view = payload.get("view")  # grid / card / table, controls which fields are fetched
+    # None (default): run facets only when they are not cached for this query yet
+    include_aggs = payload.get("include_aggs")
+    # Preview prefetch (if PREVIEW_PREFETCH_URL is set); a new page for the same
+    # session_id cancels the previous page's pending prefetches
+    prefetch = bool(payload.get("prefetch", True))
+    session_id = payload.get("session_id")
+    # Bulk list mode: "list" stores the identifiers and searches them (the response
+    # carries the list_id to reuse), "list_id" refers to an already stored list
+    list_id = payload.get("list_id")
+    if payload.get("list"):
+        list_id, _ = await store_bulk_list(payload["list"])
+    elif list_id:
+        await get_bulk_list_terms(list_id)  # 404 for unknown or expired lists, which would match nothing
 
 
 
@@ -509,7 +1217,7 @@ async def stream_or_paginate_search(
     # An empty search (no queries, no filters, no date range) would be a very
     # expensive "match_all" query. Instead of erroring, we return a valid but
     # empty response, which is cleaner for the frontend.
-    if not queries and not filters and not date_range:
+    if not queries and not filters and not date_range and not list_id:
         return JSONResponse(content={
             "documents": [],
             "next_search_after": None,
@@ -518,57 +1226,751 @@ async def stream_or_paginate_search(
                 "branchtype_counts": {},
                 "extensiontype_counts": {}
             },
-            "total": 0
+            "total": 0,
+            "total_relation": "eq",
+            "query_fingerprint": query_fingerprint(
+                normalize_search_params(queries, search_type, filters, date_range, parents_only, list_id)
+            ),
+            "page": page,
+            "next_cursor": None,
+            "list_id": None
         })
     
     
     if not isinstance(size, int) or size <= 0:
         size = 100  # Fallback safe default
 
-    if stream:
-        # Full streaming mode
-        async def document_generator() -> AsyncGenerator[str, None]:
-            nonlocal search_after
-            first = True
-            yield "["
-            while True:
-                hits, search_after = await search_elasticsearch(
-                    queries, size, search_type, search_after, filters, date_range, parents_only
-                )
-                if not hits:
-                    break
-                for hit in hits:
-                    doc_json = hit["_source"]
-                    doc_str = f"{'' if first else ','}{json.dumps(doc_json)}"
-                    yield doc_str
-                    first = False
-                if search_after is None:
-                    break
-            yield "]"
+    if view is not None and view not in VIEW_SOURCE_FIELDS:
+        raise HTTPException(status_code=400, detail=f"Invalid view. Use one of {list(VIEW_SOURCE_FIELDS)}.")
+    if totals not in TOTALS_MODES:
+        raise HTTPException(status_code=400, detail=f"Invalid totals. Use one of {list(TOTALS_MODES)}.")
 
-        return StreamingResponse(document_generator(), media_type="application/json")
+    if stream:
+        # Bulk export mode: NDJSON over a point-in-time, one ES batch in memory at a time
+        fields = payload.get("fields") or EXPORT_SOURCE_FIELDS
+        source_fields = [f for f in fields if f in EXPORT_SOURCE_FIELDS]
+        if not source_fields:
+            raise HTTPException(status_code=400, detail=f"No exportable fields requested. Allowed: {EXPORT_SOURCE_FIELDS}")
+
+        query_body = build_query_body(queries, search_type, filters, date_range, parents_only, list_id)
+        # Open the PIT before responding so ES errors still surface as a proper status code
+        pit_id = await open_point_in_time()
+        return StreamingResponse(
+            export_elasticsearch(pit_id, query_body, source_fields),
+            media_type="application/x-ndjson",
+            headers={"Content-Disposition": 'attachment; filename="search_export.ndjson"'}
+        )
 
     else:
         # Paginated mode
         print("abcd")
-        hits, last_sort_value,doctype_counts,branchtype_counts,extensiontype_counts,hits_total = await search_elasticsearch(
-            queries, size, search_type, search_after, filters, date_range, parents_only, from_offset
-        )
+        normalized = normalize_search_params(queries, search_type, filters, date_range, parents_only, list_id)
+        fingerprint = query_fingerprint(normalized)
+        query_registry.set(fingerprint, normalized)
+
+        pit_id = None
+        if cursor:
+            try:
+                state = decode_cursor(cursor)
+            except InvalidCursor as e:
+                raise HTTPException(status_code=400, detail=f"Invalid cursor: {e}")
+            if state.get("fp") != fingerprint:
+                raise HTTPException(status_code=400, detail="Cursor belongs to a different query.")
+            size, pit_id = state.get("size", size), state.get("pit")
+            from_offset = None
+            if page is not None and page != state.get("page"):
+                # Page jump inside the cursor's snapshot: reuse its PIT instead of opening another
+                if not isinstance(page, int) or page < 1:
+                    raise HTTPException(status_code=400, detail="page must be a positive integer.")
+                search_after = None
+                cursor = None
+            else:
+                search_after, page = state.get("sa"), state.get("page")
+        else:
+            check_paging_params(from_offset, search_after)
+            if from_offset is not None and page is None:
+                if from_offset % size == 0:
+                    page = from_offset // size + 1
+                elif from_offset + size > MAX_RESULT_WINDOW:
+                    raise HTTPException(status_code=400, detail="Deep offsets must be multiples of size; use page or cursor.")
+            if page is not None:
+                if not isinstance(page, int) or page < 1:
+                    raise HTTPException(status_code=400, detail="page must be a positive integer.")
+                from_offset = None
+            elif not search_after and from_offset is None:
+                page = 1
+            if consistent:
+                pit_id = await open_point_in_time(SEARCH_PIT_KEEP_ALIVE)
+
+        page_exists = True
+        if page is not None and not cursor:
+            page_exists, search_after = await resolve_page_search_after(
+                fingerprint, page, size, build_query_body(queries, search_type, filters, date_range, parents_only, list_id), pit_id
+            )
+
+        facets = facet_cache.get(fingerprint) if not include_aggs else None
+        if include_aggs is None:
+            include_aggs = facets is None
+
+        if page_exists:
+            hits, last_sort_value,doctype_counts,branchtype_counts,extensiontype_counts,hits_total,pit_id = await cached_search_elasticsearch(
+                queries, size, search_type, search_after, filters, date_range, parents_only, from_offset, view,
+                include_aggs=bool(include_aggs), pit_id=pit_id, highlight=highlight, list_id=list_id
+            )
+        else:
+            # Past the last page: nothing to fetch (facets, if wanted, come from /search/facets)
+            hits, last_sort_value, doctype_counts, branchtype_counts, extensiontype_counts = [], None, {}, {}, {}
+            hits_total = {"value": 0, "relation": "eq"}
+            include_aggs = False
+
+        next_cursor = None
+        if last_sort_value and len(hits) == size:
+            if page is not None:
+                record_page_boundary(fingerprint, size, page + 1, last_sort_value, pit_id)
+            next_cursor = encode_cursor({
+                "fp": fingerprint, "sa": last_sort_value, "page": page + 1 if page is not None else None,
+                "size": size, "pit": pit_id,
+            })
+        elif pit_id:
+            # Last page of a consistent listing: nothing refers to the snapshot any more
+            await close_point_in_time(pit_id)
+
+        if include_aggs:
+            facets = {
+                "aggregations": {
+                    "doctype_counts": doctype_counts,
+                    "branchtype_counts": branchtype_counts,
+                    "extensiontype_counts": extensiontype_counts
+                },
+                "total": hits_total["value"],
+                "total_relation": hits_total["relation"]
+            }
+            facet_cache.set(fingerprint, facets)
+
+        total = facets["total"] if facets else None
+        total_relation = facets.get("total_relation", "eq") if facets else None
+        # a lower bound, or no total at all (facets neither computed nor cached)
+        if totals == "exact" and total_relation != "eq":
+            total, _ = await cached_count(fingerprint, build_query_body(queries, search_type, filters, date_range, parents_only, list_id))
+            total_relation = "eq"
+            if facets:
+                facets = {**facets, "total": total, "total_relation": total_relation}
+                facet_cache.set(fingerprint, facets)
+
+        # _id lets the UI ask /search/highlights for the rows it shows
+        documents = [{**hit["_source"], "_id": hit.get("_id")} for hit in hits]
+
+        background = None
+        if PREVIEW_PREFETCH_URL and prefetch:
+            prefetch_paths = select_prefetch_paths(documents)
+            if prefetch_paths or session_id:
+                background = BackgroundTask(request_preview_prefetch, session_id, prefetch_paths)
 
-        documents = [hit["_source"] for hit in hits]
-        
         print("total count")
         print(hits_total)
-        return JSONResponse(content={
+        return JSONResponse(background=background, content={
             "documents": documents,
             "next_search_after": last_sort_value,
-            "aggregations":{
+            "aggregations": facets["aggregations"] if facets else {
+                "doctype_counts": {},
+                "branchtype_counts": {},
+                "extensiontype_counts": {}
+            },
+            # None when include_aggs=false and the facets were not cached (unless totals="exact"): ask /search/facets
+            "total": total,
+            # "gte": total is a lower bound (SEARCH_TOTAL_HITS_THRESHOLD); exact figure from /search/count
+            "total_relation": total_relation,
+            "query_fingerprint": fingerprint,
+            "page": page,
+            "next_cursor": next_cursor,
+            "list_id": list_id
+
+        })
+
+
+# ---------------------------------------
+@app.post("/search/facets")
+async def get_search_facets(payload: Dict[str, Any] = Body(...)):
+    """
+    Returns facet counts and the total (a lower bound above SEARCH_TOTAL_HITS_THRESHOLD,
+    see total_relation) for a query, cached by query fingerprint.
+    Takes the same queries/search_type/filters/date_range/parents_only as /search.
+    """
+    queries = payload.get("queries", [])
+    search_type = payload.get("search_type", "any")
+    filters = payload.get("filters", {})
+    date_range = payload.get("date_range", {})
+    parents_only = bool(payload.get("parents_only",False))
+    list_id = payload.get("list_id")  # stored bulk list (see /search/lists)
+    if list_id:
+        await get_bulk_list_terms(list_id)  # 404 for expired lists instead of silently matching nothing
+
+    fingerprint = query_fingerprint(
+        normalize_search_params(queries, search_type, filters, date_range, parents_only, list_id)
+    )
+    # Same guard as /search: an empty search would aggregate over the whole index (match_all)
+    if not queries and not filters and not date_range and not list_id:
+        return JSONResponse(content={
+            "aggregations": {"doctype_counts": {}, "branchtype_counts": {}, "extensiontype_counts": {}},
+            "total": 0,
+            "total_relation": "eq",
+            "query_fingerprint": fingerprint,
+            "cached": False,
+        })
+
+    await invalidate_caches_if_index_changed()
+    facets = facet_cache.get(fingerprint)
+    cached = facets is not None
+    if not cached:
+        facets = await search_facets(queries, search_type, filters, date_range, parents_only, list_id)
+        facet_cache.set(fingerprint, facets)
+
+    return JSONResponse(content={**facets, "query_fingerprint": fingerprint, "cached": cached})
+
+
+# ---------------------------------------
+@app.post("/search/count")
+async def get_search_count(payload: Dict[str, Any] = Body(...)):
+    """
+    Exact number of matching documents, for when the pagination widget needs
+    more than the lower bound /search reports. Cached by query fingerprint.
+    """
+    queries = payload.get("queries", [])
+    search_type = payload.get("search_type", "any")
+    filters = payload.get("filters", {})
+    date_range = payload.get("date_range", {})
+    parents_only = bool(payload.get("parents_only",False))
+    list_id = payload.get("list_id")  # stored bulk list (see /search/lists)
+    if list_id:
+        await get_bulk_list_terms(list_id)  # 404 for expired lists instead of silently matching nothing
+
+    await invalidate_caches_if_index_changed()
+    fingerprint = query_fingerprint(
+        normalize_search_params(queries, search_type, filters, date_range, parents_only, list_id)
+    )
+    # Same guard as /search: an empty search would count the whole index
+    if not queries and not filters and not date_range and not list_id:
+        return JSONResponse(content={"count": 0, "query_fingerprint": fingerprint, "cached": False})
+    count, cached = await cached_count(
+        fingerprint, build_query_body(queries, search_type, filters, date_range, parents_only, list_id)
+    )
+    return JSONResponse(content={"count": count, "query_fingerprint": fingerprint, "cached": cached})
+
+
+# ---------------------------------------
+async def store_bulk_list(terms: Any) -> Tuple[str, int]:
+    """Stores a bulk list in BULK_LIST_INDEX (idempotently) and returns (list_id, term count)."""
+    if not isinstance(terms, list):
+        raise HTTPException(status_code=400, detail="list must be an array of identifiers.")
+    terms = normalize_list_terms(terms)
+    if not terms:
+        raise HTTPException(status_code=400, detail="list is empty.")
+    if len(terms) > BULK_LIST_MAX_TERMS:
+        raise HTTPException(status_code=400, detail=f"A list holds at most {BULK_LIST_MAX_TERMS} identifiers.")
+
+    list_id = bulk_list_id(terms)
+    try:
+        client = get_es_client()
+        # an upsert, so storing a list that already exists renews its created_at
+        response = await client.post(
+            f"{ES_HOST}{BULK_LIST_INDEX}/_update/{list_id}",
+            json={
+                "doc": {BULK_LIST_TERMS_PATH: terms, "created_at": datetime.now(timezone.utc).isoformat()},
+                "doc_as_upsert": True,
+            },
+        )
+    except httpx.RequestError as e:
+        logger.error(f"Elasticsearch connection error: {str(e)}")
+        raise HTTPException(status_code=503, detail="Elasticsearch is unavailable")
+    if response.status_code not in (200, 201):
+        logger.error(f"Elasticsearch error while storing list: {response.status_code} - {response.text}")
+        raise HTTPException(status_code=500, detail=f"Could not store the list: {response.status_code}")
+    list_terms_cache.set(list_id, terms)
+    list_touch_cache.set(list_id, True)
+    return list_id, len(terms)
+
+
+def unknown_list_error() -> HTTPException:
+    return HTTPException(status_code=404, detail="Unknown or expired list_id; store the list again with /search/lists.")
+
+
+async def touch_bulk_list(list_id: str) -> None:
+    """
+    Renews the created_at of a list that is being used, so the cleanup does not
+    remove it, and raises 404 if the list is gone. Rate-limited per list.
+    """
+    if list_touch_cache.get(list_id) is not None:
+        return
+    try:
+        client = get_es_client()
+        response = await client.post(
+            f"{ES_HOST}{BULK_LIST_INDEX}/_update/{list_id}",
+            json={"doc": {"created_at": datetime.now(timezone.utc).isoformat()}},
+        )
+    except httpx.RequestError as e:
+        logger.error(f"Elasticsearch connection error: {str(e)}")
+        raise HTTPException(status_code=503, detail="Elasticsearch is unavailable")
+    if response.status_code == 404:
+        # the terms lookup would silently match nothing
+        list_terms_cache.pop(list_id)
+        raise unknown_list_error()
+    if response.status_code != 200:
+        logger.error(f"Elasticsearch error while renewing list: {response.status_code} - {response.text}")
+        raise HTTPException(status_code=500, detail=f"Could not read the list: {response.status_code}")
+    list_touch_cache.set(list_id, True)
+
+
+async def get_bulk_list_terms(list_id: str) -> List[str]:
+    """Terms of a stored list; 404 if it does not exist (any more). Also renews the list."""
+    if not isinstance(list_id, str) or not re.fullmatch(r"[0-9a-f]{32}", list_id):
+        raise HTTPException(status_code=400, detail="Invalid list_id.")
+    terms = list_terms_cache.get(list_id)
+    if terms is not None:
+        await touch_bulk_list(list_id)
+        return terms
+    try:
+        client = get_es_client()
+        response = await client.get(f"{ES_HOST}{BULK_LIST_INDEX}/_doc/{list_id}")
+    except httpx.RequestError as e:
+        logger.error(f"Elasticsearch connection error: {str(e)}")
+        raise HTTPException(status_code=503, detail="Elasticsearch is unavailable")
+    if response.status_code == 404:
+        raise unknown_list_error()
+    if response.status_code != 200:
+        logger.error(f"Elasticsearch error while reading list: {response.status_code} - {response.text}")
+        raise HTTPException(status_code=500, detail=f"Could not read the list: {response.status_code}")
+    terms = response.json().get("_source", {}).get(BULK_LIST_TERMS_PATH, [])
+    await touch_bulk_list(list_id)
+    list_terms_cache.set(list_id, terms)
+    return terms
+
+
+async def remove_expired_bulk_lists() -> None:
+    """Deletes the stored lists older than BULK_LIST_TTL (by their created_at)."""
+    try:
+        client = get_es_client()
+        response = await client.post(
+            f"{ES_HOST}{BULK_LIST_INDEX}/_delete_by_query",
+            params={"conflicts": "proceed"},
+            json={"query": {"range": {"created_at": {"lt": f"now-{BULK_LIST_TTL}s"}}}},
+        )
+    except httpx.RequestError as e:
+        logger.warning(f"Bulk list cleanup failed, Elasticsearch is unavailable: {e}")
+        return
+    if response.status_code == 404:
+        return  # no list stored yet
+    if response.status_code != 200:
+        logger.warning(f"Bulk list cleanup failed: {response.status_code} - {response.text[:200]}")
+        return
+    deleted = response.json().get("deleted", 0)
+    if deleted:
+        logger.info(f"Removed {deleted} expired bulk lists")
+
+
+async def bulk_list_cleanup_loop() -> None:
+    while True:
+        try:
+            await remove_expired_bulk_lists()
+        except Exception:
+            logger.exception("Bulk list cleanup failed")
+        await asyncio.sleep(BULK_LIST_CLEANUP_INTERVAL)
+
+
+@app.post("/search/lists")
+async def create_bulk_list(payload: Dict[str, Any] = Body(...)):
+    """
+    Stores a list of identifiers (phone numbers, IMEIs, e-mail addresses ...) for
+    bulk list searches: pass the returned list_id to /search, /search/facets,
+    /search/count or /search/lists/{list_id}/counts. Lists are content-addressed,
+    so posting the same identifiers again returns the same id (and keeps the
+    list from expiring, see BULK_LIST_TTL).
+    """
+    list_id, count = await store_bulk_list(payload.get("terms"))
+    return JSONResponse(content={"list_id": list_id, "count": count, "fields": BULK_LIST_FIELDS})
+
+
+@app.post("/search/lists/{list_id}/counts")
+async def get_bulk_list_counts(list_id: str, payload: Dict[str, Any] = Body(default={})):
+    """
+    Number of matching documents per identifier of a stored list, from one
+    size-0 search with a terms aggregation per BULK_LIST_FIELDS field (restricted
+    to the list's values). Optional queries/filters/date_range/parents_only
+    narrow the documents counted, as in /search. Identifiers without a match
+    are reported with 0.
+    """
+    terms = await get_bulk_list_terms(list_id)
+    if len(terms) > BULK_LIST_COUNTS_MAX_TERMS:
+        raise HTTPException(
+            status_code=400,
+            detail=f"Per-identifier counts are available for lists of at most {BULK_LIST_COUNTS_MAX_TERMS} identifiers "
+                   f"(this list has {len(terms)}); search the list or count its matches with /search/count instead.",
+        )
+    query_body = build_query_body(
+        payload.get("queries", []), payload.get("search_type", "any"), payload.get("filters", {}),
+        payload.get("date_range", {}), bool(payload.get("parents_only", False)), list_id
+    )
+    search_body = {
+        "size": 0,
+        "track_total_hits": False,
+        "query": query_body,
+        "aggs": {
+            field: {"terms": {"field": field, "include": terms, "size": len(terms)}}
+            for field in BULK_LIST_FIELDS
+        },
+    }
+    try:
+        client = get_es_client()
+        response = await client.post(f"{idx_url}/_search", json=search_body)
+    except httpx.RequestError as e:
+        logger.error(f"Elasticsearch connection error: {str(e)}")
+        raise HTTPException(status_code=503, detail="Elasticsearch is unavailable")
+    if response.status_code != 200:
+        logger.error(f"Elasticsearch error: {response.status_code} - {response.text}")
+        raise HTTPException(
+            status_code=500,
+            detail=f"Elasticsearch responded with status code {response.status_code}: {response.text}"
+        )
+
+    aggregations = response.json().get("aggregations", {})
+    counts = {term: 0 for term in terms}
+    by_field = {}
+    for field in BULK_LIST_FIELDS:
+        buckets = aggregations.get(field, {}).get("buckets", [])
+        by_field[field] = {bucket["key"]: bucket["doc_count"] for bucket in buckets}
+        for bucket in buckets:
+            # a document holding the identifier in two fields is counted for both
+            counts[bucket["key"]] = counts.get(bucket["key"], 0) + bucket["doc_count"]
+    return JSONResponse(content={
+        "list_id": list_id,
+        "counts": counts,
+        "by_field": by_field,
+        "matched_terms": sum(1 for c in counts.values() if c),
+    })
+
+
+# ---------------------------------------
+async def fetch_highlights(normalized: Dict[str, Any], ids: List[str]) -> Dict[str, Optional[str]]:
+    """First highlight fragment of each document in `ids` for the query in `normalized`."""
+    query_body = build_query_body(
+        normalized["queries"], normalized["search_type"], normalized["filters"],
+        normalized["date_range"], normalized["parents_only"], normalized.get("list_id")
+    )
+    search_body = {
+        "size": len(ids),
+        "query": {"bool": {"filter": [{"ids": {"values": ids}}], "must": [query_body]}},
+        "_source": False,
+        "track_total_hits": False,
+    }
+    highlight = await build_highlight(len(ids))
+    if not highlight:
+        return {doc_id: None for doc_id in ids}
+    search_body["highlight"] = highlight
+
+    try:
+        client = get_es_client()
+        response = await client.post(f"{idx_url}/_search", json=search_body, params={"filter_path": "hits.hits._id,hits.hits.highlight"})
+    except httpx.RequestError as e:
+        logger.error(f"Elasticsearch connection error: {str(e)}")
+        raise HTTPException(status_code=503, detail="Elasticsearch is unavailable")
+    if response.status_code != 200:
+        logger.error(f"Elasticsearch error: {response.status_code} - {response.text}")
+        raise HTTPException(
+            status_code=500,
+            detail=f"Elasticsearch responded with status code {response.status_code}: {response.text}"
+        )
+
+    fragments: Dict[str, Optional[str]] = {doc_id: None for doc_id in ids}
+    for hit in response.json().get("hits", {}).get("hits", []):
+        text_fragments = (hit.get("highlight") or {}).get("Text", [])
+        fragments[hit["_id"]] = text_fragments[0] if text_fragments else None
+    return fragments
+
+
+@app.post("/search/highlights")
+async def get_search_highlights(payload: Dict[str, Any] = Body(...)):
+    """
+    Highlight fragments for some hits of an earlier /search (typically made with
+    "highlight": false). Takes the response's query_fingerprint and up to
+    HIGHLIGHT_BATCH_MAX `ids`; the query parameters may be sent along in case the
+    fingerprint has expired. Returns {"highlights": {_id: fragment or null}}.
+    """
+    fingerprint = payload.get("query_fingerprint")
+    ids = payload.get("ids") or []
+    if not isinstance(ids, list) or not all(isinstance(i, str) for i in ids):
+        raise HTTPException(status_code=400, detail="ids must be a list of document _id strings.")
+    if len(ids) > HIGHLIGHT_BATCH_MAX:
+        raise HTTPException(status_code=400, detail=f"At most {HIGHLIGHT_BATCH_MAX} ids per request.")
+
+    normalized = query_registry.get(fingerprint) if fingerprint else None
+    if normalized is None and ("queries" in payload or "list_id" in payload):
+        normalized = normalize_search_params(
+            payload.get("queries", []), payload.get("search_type", "any"), payload.get("filters", {}),
+            payload.get("date_range", {}), bool(payload.get("parents_only", False)), payload.get("list_id")
+        )
+        if fingerprint and query_fingerprint(normalized) != fingerprint:
+            raise HTTPException(status_code=400, detail="Query parameters do not match query_fingerprint.")
+        fingerprint = query_fingerprint(normalized)
+        query_registry.set(fingerprint, normalized)
+    if normalized is None:
+        raise HTTPException(status_code=404, detail="Unknown or expired query_fingerprint; resend the query parameters.")
+
+    await invalidate_caches_if_index_changed()
+    highlights: Dict[str, Optional[str]] = {}
+    missing = []
+    for doc_id in dict.fromkeys(ids):
+        cached = highlight_cache.get((fingerprint, doc_id))
+        if cached is None:
+            missing.append(doc_id)
+        else:
+            highlights[doc_id] = cached or None  # "" marks "no fragment"
+    if missing:
+        fetched = await fetch_highlights(normalized, missing)
+        for doc_id, fragment in fetched.items():
+            highlights[doc_id] = fragment
+            highlight_cache.set((fingerprint, doc_id), fragment or "")
+
+    return JSONResponse(content={"highlights": highlights, "query_fingerprint": fingerprint})
+
+
+# ---------------------------------------
+async def msearch(bodies: List[Dict[str, Any]]) -> List[Dict[str, Any]]:
+    """Runs `bodies` against the search index in one _msearch request; one response (or error) per body."""
+    header = json.dumps({"index": ES_INDEX})
+    lines = []
+    for search_body in bodies:
+        lines.append(header)
+        lines.append(json.dumps(search_body))
+    try:
+        client = get_es_client()
+        response = await client.post(
+            f"{ES_HOST}_msearch", content="\n".join(lines) + "\n",
+            headers={"Content-Type": "application/x-ndjson"},
+        )
+    except httpx.RequestError as e:
+        logger.error(f"Elasticsearch connection error: {str(e)}")
+        raise HTTPException(status_code=503, detail="Elasticsearch is unavailable")
+    if response.status_code != 200:
+        logger.error(f"Elasticsearch error: {response.status_code} - {response.text}")
+        raise HTTPException(
+            status_code=500,
+            detail=f"Elasticsearch responded with status code {response.status_code}: {response.text}"
+        )
+    return response.json().get("responses", [])
+
+
+async def prepare_batch_item(spec: Dict[str, Any]) -> Dict[str, Any]:
+    """
+    Validates one /search/batch spec and returns either its finished "result"
+    (empty search, cache hit) or the ES "body" to run plus what is needed to
+    turn the response into a result. Raises HTTPException for invalid specs.
+    """
+    if not isinstance(spec, dict):
+        raise HTTPException(status_code=400, detail="Each search must be an object.")
+    kind = spec.get("type", "search")
+    if kind not in BATCH_SEARCH_TYPES:
+        raise HTTPException(status_code=400, detail=f"Invalid type. Use one of {list(BATCH_SEARCH_TYPES)}.")
+    if kind == "attachments":
+        return {"type": kind, "body": await build_attachment_link_query(spec)}
+
+    queries = spec.get("queries", [])
+    search_type = spec.get("search_type", "any")
+    filters = spec.get("filters", {})
+    date_range = spec.get("date_range", {})
+    parents_only = bool(spec.get("parents_only", False))
+    list_id = spec.get("list_id")
+    if list_id:
+        await get_bulk_list_terms(list_id)
+    normalized = normalize_search_params(queries, search_type, filters, date_range, parents_only, list_id)
+    fingerprint = query_fingerprint(normalized)
+    query_body = build_query_body(queries, search_type, filters, date_range, parents_only, list_id)
+    item = {"type": kind, "fingerprint": fingerprint}
+    empty_search = not queries and not filters and not date_range and not list_id
+
+    if kind == "count" and empty_search:
+        return {**item, "result": {"count": 0, "query_fingerprint": fingerprint, "cached": False}}
+    if kind == "count":
+        count = count_cache.get(fingerprint)
+        if count is not None:
+            return {**item, "result": {"count": count, "query_fingerprint": fingerprint, "cached": True}}
+        return {**item, "body": {"size": 0, "track_total_hits": True, "query": query_body}}
+
+    if empty_search:
+        return {**item, "result": {
+            "documents": [], "next_search_after": None,
+            "aggregations": {"doctype_counts": {}, "branchtype_counts": {}, "extensiontype_counts": {}},
+            "total": 0, "total_relation": "eq", "query_fingerprint": fingerprint,
+        }}
+    size = spec.get("size", 100)
+    if not isinstance(size, int) or size <= 0:
+        size = 100
+    view = spec.get("view")
+    if view is not None and view not in VIEW_SOURCE_FIELDS:
+        raise HTTPException(status_code=400, detail=f"Invalid view. Use one of {list(VIEW_SOURCE_FIELDS)}.")
+    from_offset = spec.get("from")
+    search_after = spec.get("search_after")
+    check_paging_params(from_offset, search_after)
+    if from_offset is not None and from_offset + size > MAX_RESULT_WINDOW:
+        raise HTTPException(status_code=400, detail=f"from + size must not exceed {MAX_RESULT_WINDOW}; use /search with a cursor.")
+    highlight = bool(spec.get("highlight", True))
+    include_aggs = spec.get("include_aggs")
+    if include_aggs is None:
+        include_aggs = facet_cache.get(fingerprint) is None
+    query_registry.set(fingerprint, normalized)
+
+    search_args = (queries, size, search_type, search_after, filters, date_range, parents_only, from_offset, view)
+    search_kwargs = {"include_aggs": bool(include_aggs), "highlight": highlight, "list_id": list_id}
+    item.update(key=search_result_key(*search_args, **search_kwargs), include_aggs=bool(include_aggs))
+    cached = result_cache.get(item["key"])
+    if cached is not None:
+        return {**item, "result": batch_search_result(item, cached)}
+    search_body, highlight_disabled = await build_search_body(*search_args, **search_kwargs)
+    return {**item, "body": search_body, "highlight_disabled": highlight_disabled}
+
+
+def batch_search_result(item: Dict[str, Any], result: tuple) -> Dict[str, Any]:
+    """The /search-shaped response of a batch "search" item from search_elasticsearch's tuple."""
+    hits, last_sort_value, doctype_counts, branchtype_counts, extensiontype_counts, hits_total, _ = result
+    fingerprint = item["fingerprint"]
+    if item["include_aggs"]:
+        facets = {
+            "aggregations": {
                 "doctype_counts": doctype_counts,
                 "branchtype_counts": branchtype_counts,
-                "extensiontype_counts":extensiontype_counts
+                "extensiontype_counts": extensiontype_counts
             },
-            "total":hits_total
+            "total": hits_total["value"],
+            "total_relation": hits_total["relation"]
+        }
+        facet_cache.set(fingerprint, facets)
+    else:
+        facets = facet_cache.get(fingerprint)
+    return {
+        "documents": [{**hit["_source"], "_id": hit.get("_id")} for hit in hits],
+        "next_search_after": last_sort_value,
+        "aggregations": facets["aggregations"] if facets else {
+            "doctype_counts": {}, "branchtype_counts": {}, "extensiontype_counts": {}
+        },
+        "total": facets["total"] if facets else None,
+        "total_relation": facets.get("total_relation", "eq") if facets else None,
+        "query_fingerprint": fingerprint,
+    }
 
-        })
+
+def finish_batch_item(item: Dict[str, Any], data: Dict[str, Any]) -> Dict[str, Any]:
+    if item["type"] == "attachments":
+        return {"documents": process_attachment_hits(data.get("hits", {}).get("hits", [])), "next_search_after": None}
+    if item["type"] == "count":
+        count = data.get("hits", {}).get("total", {}).get("value", 0)
+        count_cache.set(item["fingerprint"], count)
+        return {"count": count, "query_fingerprint": item["fingerprint"], "cached": False}
+    result = process_search_response(data, None, item["highlight_disabled"])
+    result_cache.set(item["key"], result)
+    return batch_search_result(item, result)
 
 
+def finish_batch_item_safely(index: int, item: Dict[str, Any], data: Dict[str, Any]) -> Dict[str, Any]:
+    try:
+        return {"status": 200, **finish_batch_item(item, data)}
+    except Exception as e:
+        logger.exception(f"Could not process batch item {index}")
+        return {"status": 500, "error": f"Internal Server Error: {e}"}
+
+
+@app.post("/search/batch")
+async def batch_search(payload: Dict[str, Any] = Body(...)):
+    """
+    Runs several searches of one screen in a single _msearch round-trip. Takes
+    {"searches": [spec, ...]} with up to SEARCH_BATCH_MAX specs, each with a
+    "type" and that type's /search-style parameters:
+
+    - "search" (default): a result page like /search (size, search_after or
+      from, view, highlight, include_aggs, list_id ...). Cursors and page jumps
+      stay with /search.
+    - "attachments": the /handle-attachment-link lookup (app_id, parent_app_id,
+      is_attachment).
+    - "count": the exact number of matches, like /search/count.
+
+    Returns {"results": [...]} in the order of the specs. Every result carries
+    a "status"; failed items have an "error" instead of data and do not fail
+    the rest of the batch. Results come from and go to the same caches as the
+    single-search endpoints.
+    """
+    specs = payload.get("searches")
+    if not isinstance(specs, list) or not specs:
+        raise HTTPException(status_code=400, detail="searches must be a non-empty list.")
+    if len(specs) > SEARCH_BATCH_MAX:
+        raise HTTPException(status_code=400, detail=f"At most {SEARCH_BATCH_MAX} searches per batch.")
+
+    await invalidate_caches_if_index_changed()
+    results: List[Optional[Dict[str, Any]]] = [None] * len(specs)
+    pending = []
+    for i, spec in enumerate(specs):
+        try:
+            item = await prepare_batch_item(spec)
+        except HTTPException as e:
+            results[i] = {"status": e.status_code, "error": e.detail}
+            continue
+        except Exception as e:
+            logger.exception(f"Could not prepare batch item {i}")
+            results[i] = {"status": 500, "error": f"Internal Server Error: {e}"}
+            continue
+        if "result" in item:
+            results[i] = {"status": 200, **item["result"]}
+        else:
+            pending.append((i, item))
+
+    retry, rejection = [], None
+    if pending:
+        responses = await msearch([item["body"] for _, item in pending])
+        highlight_state["requests"] += sum(1 for _, item in pending if item["type"] != "count")
+        for (i, item), data in zip(pending, responses):
+            status = data.get("status", 200)
+            if "error" in data and "highlight" in item["body"] and is_highlight_error(status, json.dumps(data["error"])):
+                retry.append((i, item))
+                rejection = data["error"]
+            elif "error" in data:
+                logger.error(f"Elasticsearch error in batch item {i}: {status} - {data['error']}")
+                results[i] = {"status": 500, "error": f"Elasticsearch responded with status code {status}: {json.dumps(data['error'])}"}
+            else:
+                results[i] = finish_batch_item_safely(i, item, data)
+
+    if retry:
+        record_highlight_rejection(json.dumps(rejection))
+        for _, item in retry:
+            item["body"].pop("highlight", None)
+            item["highlight_disabled"] = True
+        responses = await msearch([item["body"] for _, item in retry])
+        for (i, item), data in zip(retry, responses):
+            if "error" in data:
+                results[i] = {"status": 500, "error": f"Elasticsearch responded with status code {data.get('status')}: {json.dumps(data['error'])}"}
+            else:
+                results[i] = finish_batch_item_safely(i, item, data)
+    highlight_state["degraded"] += sum(
+        1 for _, item in pending if item["type"] == "search" and item["highlight_disabled"]
+    )
+
+    return JSONResponse(content={"results": results})
+
+
+# ---------------------------------------
+@app.get("/search/cache")
+async def get_search_cache_stats():
+    """Hit/miss counters and sizes of the in-process search caches."""
+    return JSONResponse(content={
+        "results": result_cache.stats(),
+        "facets": facet_cache.stats(),
+        "page_index": page_index.stats(),
+        "counts": count_cache.stats(),
+        "highlights": highlight_cache.stats(),
+        "highlighting": {k: v for k, v in highlight_state.items() if k != "disabled_until"}
+    })
+
+
+@app.delete("/search/cache")
+async def clear_search_cache():
+    result_cache.clear()
+    facet_cache.clear()
+    page_index.clear()
+    count_cache.clear()
+    highlight_cache.clear()
+    return JSONResponse(content={"cleared": True})
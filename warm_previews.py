@@ -0,0 +1,259 @@
+"""
+Offline bulk preview generation.
+
+Converts every DOC/DOCX/PPT/PPTX file that is missing from the preview cache,
+so the first viewer of a freshly ingested batch no longer waits for
+LibreOffice. Files come from walking ALLOWED_DOCUMENT_ROOTS (or the given
+directories) or from an Elasticsearch query. Conversions go through the same
+pool and cache as the document service (main5.py), so the usual
+LIBREOFFICE_* / PREVIEW_CACHE_* environment variables apply.
+
+It is meant to run next to the live service, e.g. during ingest. Share
+PREVIEW_CACHE_DIR with the service, that is where the warmed previews must
+land. LIBREOFFICE_PROFILE_DIR may be shared too: each process gets its own
+<pid>_worker_<i> profiles under it. Do not reuse the service's
+LIBREOFFICE_WORKERS value on the same host; the two pools add up, so size
+--jobs / LIBREOFFICE_WORKERS for what the service leaves free.
+
+Runs are resumable: converted files are found in the cache and skipped, and
+failures are recorded in a state file so a rerun skips them too unless
+--retry-failed is given.
+
+    python warm_previews.py --walk --jobs 4
+    python warm_previews.py --es-query '{"range": {"IngestionDate": {"gte": "now-1d"}}}'
+"""
+
+import argparse
+import asyncio
+import json
+import logging
+import os
+import sys
+import time
+from pathlib import Path
+from typing import AsyncIterator, Dict, List, Optional, Set
+
+from fastapi import HTTPException
+
+import main5
+from conversion_pool import ConversionPoolBusy
+from es_client import close_es_client, get_es_client, init_es_client
+
+
+logger = logging.getLogger("warm_previews")
+
+CONVERTIBLE_EXTENSIONS = {".doc", ".docx", ".ppt", ".pptx"}
+ES_PAGE_SIZE = 1000
+# A full conversion queue is retried (after BUSY_RETRY_DELAY, doubling) rather than recorded as a failure
+BUSY_RETRIES = 5
+BUSY_RETRY_DELAY = 1.0
+TIMEOUT_ERROR = "timed out"
+
+
+def walk_roots(roots: List[Path]) -> List[Path]:
+    found = []
+    for root in roots:
+        for dirpath, _dirnames, filenames in os.walk(root):
+            for name in filenames:
+                if Path(name).suffix.lower() in CONVERTIBLE_EXTENSIONS:
+                    found.append(Path(dirpath) / name)
+    return found
+
+
+async def query_system_paths(query: Dict) -> AsyncIterator[str]:
+    """Pages through every hit of `query` with a point-in-time and search_after."""
+    client = get_es_client()
+    response = await client.post(f"{main5.ES_HOST}{main5.ES_INDEX}/_pit", params={"keep_alive": "2m"})
+    response.raise_for_status()
+    pit_id = response.json()["id"]
+    search_after = None
+    try:
+        while True:
+            body = {
+                "query": query,
+                "_source": ["SystemPath"],
+                "size": ES_PAGE_SIZE,
+                "pit": {"id": pit_id, "keep_alive": "2m"},
+                "sort": [{"_shard_doc": "asc"}],
+            }
+            if search_after:
+                body["search_after"] = search_after
+            response = await client.post(f"{main5.ES_HOST}_search", json=body, timeout=30.0)
+            response.raise_for_status()
+            data = response.json()
+            pit_id = data.get("pit_id", pit_id)
+            hits = data.get("hits", {}).get("hits", [])
+            for hit in hits:
+                system_path = hit.get("_source", {}).get("SystemPath")
+                if system_path and Path(system_path).suffix.lower() in CONVERTIBLE_EXTENSIONS:
+                    yield system_path
+            if len(hits) < ES_PAGE_SIZE:
+                break
+            search_after = hits[-1]["sort"]
+    finally:
+        await client.request("DELETE", f"{main5.ES_HOST}_pit", json={"id": pit_id})
+
+
+def load_failures(state_file: Path) -> Dict[str, str]:
+    if not state_file.is_file():
+        return {}
+    failures = {}
+    with open(state_file, encoding="utf-8") as f:
+        for line in f:
+            try:
+                record = json.loads(line)
+            except json.JSONDecodeError:
+                continue
+            if record.get("error") == TIMEOUT_ERROR:
+                continue  # transient; older runs recorded these too
+            failures[record["key"]] = record["error"]
+    return failures
+
+
+class Progress:
+    def __init__(self, total: int):
+        self.total = total
+        self.converted = 0
+        self.skipped = 0
+        self.failed: Dict[str, str] = {}
+        self.started = time.monotonic()
+
+    @property
+    def done(self) -> int:
+        return self.converted + self.skipped + len(self.failed)
+
+    def report(self, force: bool = False) -> None:
+        if force or self.done % 10 == 0:
+            elapsed = time.monotonic() - self.started
+            rate = self.converted / elapsed if elapsed else 0.0
+            logger.info(
+                f"[{self.done}/{self.total}] converted={self.converted} skipped={self.skipped} "
+                f"failed={len(self.failed)} ({rate:.2f} conversions/s)"
+            )
+
+
+async def warm_one(path_str: str, kind_override: Optional[str], timeout: float, progress: Progress,
+                   known_failures: Dict[str, str], retry_failed: bool, state, dry_run: bool) -> None:
+    try:
+        source_file = await asyncio.to_thread(main5.is_path_secure_and_valid, path_str, main5.ALLOWED_DOCUMENT_ROOTS)
+    except HTTPException as e:
+        progress.failed[path_str] = f"{e.status_code}: {e.detail}"
+        return
+
+    kind = main5.preview_kind_for(source_file)
+    if kind is None:
+        progress.skipped += 1
+        return
+    if kind != "pdf" and kind_override:
+        kind = kind_override
+    key = await main5.preview_key(source_file, kind)
+    if await asyncio.to_thread(main5.preview_cache.lookup, key) is not None:
+        progress.skipped += 1
+        return
+    if key in known_failures and not retry_failed:
+        progress.skipped += 1
+        return
+    if dry_run:
+        print(f"{kind}\t{source_file}")
+        progress.skipped += 1
+        return
+
+    try:
+        delay = BUSY_RETRY_DELAY
+        for attempt in range(BUSY_RETRIES + 1):
+            try:
+                await asyncio.wait_for(main5.get_cached_preview(source_file, kind, priority=main5.PREFETCH_PRIORITY), timeout)
+                break
+            except ConversionPoolBusy:
+                if attempt == BUSY_RETRIES:
+                    raise
+                await asyncio.sleep(delay)
+                delay *= 2
+        progress.converted += 1
+    except (ConversionPoolBusy, asyncio.TimeoutError) as e:
+        # Transient: reported, but not written to the state file, so the next run tries again
+        progress.failed[str(source_file)] = TIMEOUT_ERROR if isinstance(e, asyncio.TimeoutError) else "conversion queue full"
+    except Exception as e:
+        error = str(e)[:300]
+        progress.failed[str(source_file)] = error
+        state.write(json.dumps({"key": key, "path": str(source_file), "kind": kind, "error": error}) + "\n")
+        state.flush()
+    finally:
+        progress.report()
+
+
+async def run(args: argparse.Namespace) -> int:
+    if not main5.LIBREOFFICE_PATH:
+        logger.error("LibreOffice binary not found; set LIBREOFFICE_PATH.")
+        return 2
+
+    # Per-file timeout for the LibreOffice step; the whole file (incl. queueing) gets a bit more
+    main5.HTML_CONVERSION_TIMEOUT = main5.PDF_CONVERSION_TIMEOUT = args.timeout
+    known_failures = load_failures(args.state)
+
+    await init_es_client()
+    # profiles are per process (see conversion_pool), so this never touches the service's soffice profiles
+    await main5.conversion_pool.start()
+    try:
+        if args.es_query:
+            paths: List[str] = [p async for p in query_system_paths(json.loads(args.es_query))]
+        else:
+            roots = [Path(r).resolve() for r in args.roots] or main5.ALLOWED_DOCUMENT_ROOTS
+            paths = [str(p) for p in await asyncio.to_thread(walk_roots, roots)]
+        seen: Set[str] = set()
+        paths = [p for p in paths if not (p in seen or seen.add(p))]
+        logger.info(f"{len(paths)} candidate files, {len(known_failures)} known failures in {args.state}")
+
+        progress = Progress(len(paths))
+        kind_override = "html" if args.images == "inline" else "html-linked"
+        # More jobs than the pool queues would only be answered with ConversionPoolBusy
+        jobs = max(1, min(args.jobs, main5.LIBREOFFICE_MAX_QUEUE))
+        if jobs != args.jobs:
+            logger.warning(f"--jobs capped at {jobs} (LIBREOFFICE_MAX_QUEUE)")
+        pending: asyncio.Queue = asyncio.Queue()
+        for path_str in paths:
+            pending.put_nowait(path_str)
+
+        async def worker() -> None:
+            while True:
+                try:
+                    path_str = pending.get_nowait()
+                except asyncio.QueueEmpty:
+                    return
+                await warm_one(path_str, kind_override, args.timeout * 2, progress,
+                               known_failures, args.retry_failed, state, args.dry_run)
+
+        with open(args.state, "a", encoding="utf-8") as state:
+            await asyncio.gather(*(worker() for _ in range(jobs)))
+        progress.report(force=True)
+    finally:
+        await main5.conversion_pool.stop()
+        await close_es_client()
+
+    if progress.failed:
+        print(f"\n{len(progress.failed)} file(s) failed:", file=sys.stderr)
+        for path_str, error in sorted(progress.failed.items()):
+            print(f"  {path_str}: {error}", file=sys.stderr)
+        return 1
+    return 0
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description="Convert documents missing from the preview cache.")
+    source = parser.add_mutually_exclusive_group()
+    source.add_argument("--walk", nargs="*", dest="roots", metavar="DIR", default=[],
+                        help="walk these directories (default: ALLOWED_DOCUMENT_ROOTS)")
+    source.add_argument("--es-query", help="Elasticsearch query clause (JSON) selecting the documents")
+    parser.add_argument("--jobs", type=int, default=main5.LIBREOFFICE_WORKERS, help="files converted in parallel (at most LIBREOFFICE_MAX_QUEUE)")
+    parser.add_argument("--timeout", type=float, default=main5.PDF_CONVERSION_TIMEOUT, help="per-file conversion timeout in seconds")
+    parser.add_argument("--images", choices=main5.HTML_PREVIEW_IMAGE_MODES, default=main5.HTML_PREVIEW_IMAGES,
+                        help="image mode of the DOC/DOCX previews to build")
+    parser.add_argument("--state", type=Path, default=Path("warm_previews.failed.jsonl"), help="failure log used for resume")
+    parser.add_argument("--retry-failed", action="store_true", help="retry files that failed in an earlier run")
+    parser.add_argument("--dry-run", action="store_true", help="only list what would be converted")
+    args = parser.parse_args()
+    sys.exit(asyncio.run(run(args)))
+
+
+if __name__ == "__main__":
+    main()
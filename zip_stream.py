@@ -0,0 +1,232 @@
+"""
+Streaming ZIP writer for bundle downloads.
+
+The archive is produced chunk by chunk while the files are read: each entry's
+local header and compressed data are handed to the client as soon as they
+exist, followed by a data descriptor (the archive is never seeked back into),
+and the central directory comes last. Memory use is a few read-ahead chunks
+plus the compressor state, regardless of how many files are bundled or how
+large they are. ZIP64 records are written automatically for large entries and
+archives.
+"""
+
+import asyncio
+import functools
+import io
+import logging
+import zipfile
+from concurrent.futures import Executor
+from pathlib import Path
+from typing import AsyncIterator, Callable, Dict, Iterable, List, NamedTuple, Optional, Set
+
+
+logger = logging.getLogger(__name__)
+
+ZIP_CHUNK_SIZE = 1024 * 1024
+
+# Compression policy. "auto" stores formats that are already compressed and
+# deflates text-like content; "store" skips compression entirely (fastest, for
+# very large bundles); "deflate" compresses everything like before.
+COMPRESSION_MODES = ("auto", "store", "deflate")
+STORED_EXTENSIONS = {
+    "jpg", "jpeg", "png", "gif", "webp", "heic", "heif", "tif", "tiff",
+    "mp3", "m4a", "aac", "ogg", "opus", "wma", "amr",
+    "mp4", "m4v", "mov", "avi", "mkv", "wmv", "3gp", "webm",
+    "pdf", "docx", "xlsx", "pptx", "odt", "ods", "odp", "epub",
+    "zip", "gz", "tgz", "bz2", "xz", "7z", "rar", "jar", "apk", "cab", "zst",
+}
+DEFLATE_EXTENSIONS = {
+    "txt", "csv", "tsv", "log", "xml", "html", "htm", "json", "eml", "msg", "vcf",
+    "rtf", "md", "sql", "js", "css", "doc", "xls", "ppt", "bmp", "wav", "svg",
+}
+# Leading bytes of formats that are compressed already
+COMPRESSED_MAGIC = (
+    b"PK\x03\x04", b"%PDF", b"\xff\xd8\xff", b"\x89PNG", b"GIF8", b"\x1f\x8b",
+    b"7z\xbc\xaf\x27\x1c", b"Rar!", b"BZh", b"\xfd7zXZ", b"\x28\xb5\x2f\xfd", b"ID3", b"OggS",
+)
+
+
+class ZipStreamError(RuntimeError):
+    """Raised when a file fails while its entry is being written; the archive is unusable."""
+
+
+class BundleFile(NamedTuple):
+    path: Path
+    arcname: str
+    extension: Optional[str] = None  # indexed FileExtension, falls back to the path suffix
+
+
+def choose_compression(extension: Optional[str], head: bytes, mode: str = "auto") -> int:
+    """
+    Picks ZIP_STORED or ZIP_DEFLATED for one file from its extension and, when the
+    extension is unknown, its first bytes.
+    """
+    if mode == "store":
+        return zipfile.ZIP_STORED
+    if mode == "deflate":
+        return zipfile.ZIP_DEFLATED
+
+    ext = (extension or "").lower().lstrip(".")
+    if ext in STORED_EXTENSIONS:
+        return zipfile.ZIP_STORED
+    if ext in DEFLATE_EXTENSIONS:
+        return zipfile.ZIP_DEFLATED
+    if head.startswith(COMPRESSED_MAGIC):
+        return zipfile.ZIP_STORED
+    # Unknown type: deflate it only if it looks like text
+    return zipfile.ZIP_DEFLATED if b"\x00" not in head[:8192] else zipfile.ZIP_STORED
+
+
+def _set_compress_level(zinfo: zipfile.ZipInfo, level: int) -> None:
+    # ZipInfo only has a public compress_level from Python 3.13 on
+    if hasattr(zinfo, "compress_level"):
+        zinfo.compress_level = level
+    else:
+        zinfo._compresslevel = level
+
+
+class _StreamSink(io.RawIOBase):
+    """Unseekable write target that just collects what zipfile writes until drained."""
+
+    def __init__(self):
+        super().__init__()
+        self._chunks: List[bytes] = []
+
+    def writable(self) -> bool:
+        return True
+
+    def write(self, data) -> int:
+        self._chunks.append(bytes(data))
+        return len(data)
+
+    def drain(self) -> bytes:
+        data = b"".join(self._chunks)
+        self._chunks = []
+        return data
+
+
+def unique_arcname(name: str, used: Set[str]) -> str:
+    """Returns `name`, or `name (2).ext`, `name (3).ext`... if it is already in the archive."""
+    candidate = name
+    stem, dot, ext = name.rpartition(".")
+    if not dot:
+        stem, ext = name, ""
+    counter = 2
+    while candidate in used:
+        candidate = f"{stem} ({counter}){dot}{ext}"
+        counter += 1
+    used.add(candidate)
+    return candidate
+
+
+async def iter_zip_stream(
+    files: Iterable[BundleFile],
+    mode: str = "auto",
+    compresslevel: int = 6,
+    executor: Optional[Executor] = None,
+    read_ahead: int = 4,
+    chunk_size: int = ZIP_CHUNK_SIZE,
+    chunks_per_file: int = 2,
+    on_file_done: Optional[Callable[[int], None]] = None,
+) -> AsyncIterator[bytes]:
+    """
+    Yields a ZIP archive of `files` as a stream of bytes, compressing each entry
+    according to `mode` (see choose_compression). Files that cannot be opened
+    are logged and left out; a read error in the middle of a file raises
+    ZipStreamError, since the entry can no longer be completed correctly.
+
+    File I/O runs on `executor`: up to `read_ahead` upcoming files are opened,
+    stat'ed and read concurrently into small bounded queues (at most
+    `chunks_per_file` chunks each), while the compression stage consumes them
+    in archive order, also off the event loop.
+
+    `on_file_done`, if given, is called with the number of files processed so
+    far (written or skipped) after each one, for progress reporting.
+    """
+    loop = asyncio.get_running_loop()
+    files = list(files)
+    queues: Dict[int, asyncio.Queue] = {}
+    readers: Dict[int, asyncio.Task] = {}
+
+    async def read_file(index: int) -> None:
+        # Always ends with an exception or the b"" end marker on the queue, so
+        # the consumer never waits for a reader that has died
+        queue = queues[index]
+        path, arcname, _extension = files[index]
+        src = None
+        try:
+            src = await loop.run_in_executor(executor, open, path, "rb")
+            zinfo = await loop.run_in_executor(
+                executor, functools.partial(zipfile.ZipInfo.from_file, path, arcname, strict_timestamps=False)
+            )
+            await queue.put(zinfo)
+            while True:
+                chunk = await loop.run_in_executor(executor, src.read, chunk_size)
+                await queue.put(chunk)  # waits while the compression stage is behind
+                if not chunk:
+                    break
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            await queue.put(e)
+        finally:
+            if src is not None:
+                try:
+                    await loop.run_in_executor(executor, src.close)
+                except Exception:
+                    src.close()
+
+    def start_reader(index: int) -> None:
+        if index < len(files) and index not in readers:
+            queues[index] = asyncio.Queue(maxsize=chunks_per_file)
+            readers[index] = asyncio.create_task(read_file(index))
+
+    sink = _StreamSink()
+    zf = zipfile.ZipFile(sink, "w", allowZip64=True)
+    try:
+        for index, (path, arcname, extension) in enumerate(files):
+            for ahead in range(index, index + read_ahead):
+                start_reader(ahead)
+            queue = queues[index]
+
+            zinfo = await queue.get()
+            chunk = await queue.get() if isinstance(zinfo, zipfile.ZipInfo) else zinfo
+            if isinstance(chunk, Exception):
+                logger.error(f"Skipping file {path}: {chunk}")
+                del queues[index]
+                readers.pop(index, None)
+                if on_file_done:
+                    on_file_done(index + 1)
+                continue
+
+            zinfo.compress_type = choose_compression(extension or Path(path).suffix, chunk, mode)
+            if zinfo.compress_type == zipfile.ZIP_DEFLATED:
+                _set_compress_level(zinfo, compresslevel)
+            # zinfo.file_size comes from stat(), so zipfile switches to ZIP64 on its own when needed
+            dest = zf.open(zinfo, "w")
+            while chunk:
+                await loop.run_in_executor(executor, dest.write, chunk)
+                data = sink.drain()
+                if data:
+                    yield data
+                chunk = await queue.get()
+                if isinstance(chunk, Exception):
+                    # The entry's header and part of its data are already out; rather
+                    # than finish it with a valid CRC over truncated content, abort
+                    # the archive so the download visibly fails
+                    logger.error(f"Read error in {path}, aborting the archive: {chunk}")
+                    raise ZipStreamError(f"Could not read {arcname}: {chunk}") from chunk
+            await loop.run_in_executor(executor, dest.close)
+            del queues[index]
+            readers.pop(index, None)
+            if on_file_done:
+                on_file_done(index + 1)
+            data = sink.drain()
+            if data:
+                yield data
+
+        zf.close()
+        yield sink.drain()  # central directory
+    finally:
+        for task in readers.values():
+            task.cancel()